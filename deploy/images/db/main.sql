@@ -84,6 +84,8 @@ CREATE TABLE local_ega.main (
        vault_file_size           BIGINT,
        vault_file_checksum       VARCHAR(128) NULL, -- NOT NULL,
        vault_file_checksum_type  checksum_algorithm,
+       vault_file_archived_checksum      VARCHAR(128) NULL, -- Checksum of the (encrypted) vault file
+       vault_file_archived_checksum_type checksum_algorithm,
        
        -- Encryption/Decryption
        encryption_method         VARCHAR REFERENCES local_ega.vault_encryption (mode), -- ON DELETE CASCADE,
@@ -100,6 +102,7 @@ CREATE TABLE local_ega.main (
        last_modified             TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT clock_timestamp()
 );
 CREATE UNIQUE INDEX file_id_idx ON local_ega.main(id);
+CREATE INDEX file_header_idx ON local_ega.main(md5(header)); -- to find re-submissions of the same file
 
 -- When there is an updated, remember the timestamp
 CREATE FUNCTION main_updated()
@@ -112,6 +115,43 @@ $main_updated$ LANGUAGE plpgsql;
 
 CREATE TRIGGER main_updated AFTER UPDATE ON local_ega.main FOR EACH ROW EXECUTE PROCEDURE main_updated();
 
+-- ##################################################
+--               INGESTION CHECKPOINTS
+-- ##################################################
+-- How far the copy to the vault went, for a file in ingestion.
+-- An interrupted ingestion is resumed from there, if the inbox file did not change.
+CREATE TABLE local_ega.ingestion_checkpoints (
+       file_id        INTEGER NOT NULL REFERENCES local_ega.main(id) ON DELETE CASCADE, PRIMARY KEY(file_id),
+       header         TEXT NOT NULL,   -- Crypt4GH header of the inbox file
+       inbox_filesize BIGINT NOT NULL,
+       state          JSONB NOT NULL,  -- partial file size if POSIX, upload id and uploaded parts if S3
+       last_modified  TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT clock_timestamp()
+);
+
+-- ##################################################
+--         CHECKSUMS OF THE ORIGINAL CONTENT
+-- ##################################################
+-- All the checksums computed by the verification, one per algorithm.
+-- The main one is also in vault_file_checksum.
+CREATE TABLE local_ega.vault_file_checksums (
+       file_id        INTEGER NOT NULL REFERENCES local_ega.main(id) ON DELETE CASCADE,
+       checksum_type  checksum_algorithm NOT NULL,
+       checksum       VARCHAR(128) NOT NULL,
+       PRIMARY KEY(file_id, checksum_type)
+);
+
+-- ##################################################
+--                 VAULT SCRUBBING
+-- ##################################################
+-- The last file checked by a scrubber, to continue from there after a restart.
+-- It goes back to 0 when a pass over all the files is done.
+CREATE TABLE local_ega.scrub_progress (
+       name           TEXT NOT NULL, PRIMARY KEY(name),
+       file_id        INTEGER NOT NULL DEFAULT 0,
+       passes         INTEGER NOT NULL DEFAULT 0,  -- completed passes
+       last_modified  TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT clock_timestamp()
+);
+
 -- ##################################################
 --                      ERRORS
 -- ##################################################
@@ -143,6 +183,8 @@ SELECT id,
        vault_file_size                          AS vault_filesize,
        vault_file_checksum                      AS unencrypted_checksum,
        vault_file_checksum_type                 AS unencrypted_checksum_type,
+       vault_file_archived_checksum             AS vault_checksum,
+       vault_file_archived_checksum_type        AS vault_checksum_type,
        stable_id,
        header,  -- Crypt4gh specific
        version,
@@ -153,8 +195,10 @@ SELECT id,
 FROM local_ega.main;
 
 -- Insert into main
+-- The initial status can be given, to save an extra update (and commit)
 CREATE FUNCTION insert_file(inpath        local_ega.main.submission_file_path%TYPE,
-			    eid           local_ega.main.submission_user%TYPE)
+			    eid           local_ega.main.submission_user%TYPE,
+			    init_status   local_ega.main.status%TYPE DEFAULT 'INIT')
 RETURNS local_ega.main.id%TYPE AS $insert_file$
     #variable_conflict use_column
     DECLARE
@@ -174,7 +218,7 @@ RETURNS local_ega.main.id%TYPE AS $insert_file$
 			   	    submission_file_extension,
 			  	    status,
 			  	    encryption_method) -- hard-code the vault_encryption
-	VALUES(inpath,eid,file_ext,'INIT','CRYPT4GH') RETURNING local_ega.main.id
+	VALUES(inpath,eid,file_ext,init_status,'CRYPT4GH') RETURNING local_ega.main.id
 	INTO file_id;
 	RETURN file_id;
     END;
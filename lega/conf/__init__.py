@@ -147,6 +147,8 @@ class Configuration(configparser.ConfigParser):
     def _convert(self, value, conv):
         """Convert value properly to ``str``, ``float`` or ``int``, also consider ``bool`` type."""
         if conv == bool:
+            if isinstance(value, bool):  # a default value
+                return value
             assert value, "Can not convert an empty value"
             val = value.lower()
             if val in ('y', 'yes', 't', 'true', 'on', '1'):
@@ -6,7 +6,9 @@
 The header is stored in the database and the remainder is sent to the backend storage:
 either a regular file system or an S3 object store.
 
-It is possible to start several workers.
+It is possible to start several workers, and each worker can ingest
+several files concurrently (see the ``workers`` option in the
+``[ingestion]`` section).
 
 When a message is consumed, it must at least contain the following fields:
 
@@ -15,25 +17,266 @@ When a message is consumed, it must at least contain the following fields:
 
 Upon completion, a message is sent to the local exchange with the
 routing key :``archived``.
+
+In fused mode (``fused_verify`` in the ``[ingestion]`` section), the
+body is also decrypted and checksummed while it is copied to the vault.
+Unless the ``read_back`` policy requires the vault file to be read
+again by the verification step, a message is then sent directly with
+the routing key :``completed``.
+
+The progress of the copy to the vault is checkpointed in the database.
+If a worker dies while copying, the message is delivered again, and the
+next worker resumes the copy where it was checkpointed, provided the
+inbox file did not change in the meantime. Otherwise, or if the
+ingestion fails, the partial copy is removed from the vault.
+
+When the ``deduplicate`` option of the ``[ingestion]`` section is on,
+a file submitted again, byte for byte, is not copied nor verified again: the
+new submission points to the vault file of the already verified one,
+and a message is sent directly with the routing key :``completed``.
+
+The files of the different users are ingested in a fair order, and the
+vault copies can be limited in bandwidth, per user and per worker (see
+the ``fair_scheduling``, ``user_rate`` and ``worker_rate`` options).
 """
 
 import sys
 import logging
+import random
+from queue import Queue, Empty
+from threading import Thread
 from functools import partial
 
 from legacryptor.crypt4gh import get_header
 
 from .conf import CONF
 from .utils import db, exceptions, sanitize_user_id, storage
-from .utils.amqp import consume, publish, get_connection
+from .utils.checksum import ChecksumReader
+from .utils.amqp import consume, publish, get_connection, ThreadSafeChannel
+from .utils.scheduling import Throttle, parse_weights
+from .verify import get_records, checksum_body, completed_message
 
 LOG = logging.getLogger(__name__)
 
 
+class _Pipe():
+    """Bounded in-memory pipe: the chunks written by one thread are read, as a file, by another one."""
+
+    def __init__(self, maxsize=4):
+        """Initialize the pipe, holding at most ``maxsize`` chunks."""
+        self.queue = Queue(maxsize)
+        self.buf = b''
+        self.eof = False
+        self.abandoned = False
+        self.pos = 0
+
+    def write(self, data):
+        """Push a chunk. Ignored if the reader has given up."""
+        if not self.abandoned:
+            self.queue.put(bytes(data))
+
+    def close(self):
+        """Signal the end of the stream."""
+        if not self.abandoned:
+            self.queue.put(None)
+
+    def read(self, size=-1):
+        """Read up to ``size`` bytes, blocking until they are written."""
+        while not self.eof and (size < 0 or len(self.buf) < size):
+            chunk = self.queue.get()
+            if chunk is None:
+                self.eof = True
+            else:
+                self.buf += chunk
+        if size < 0:
+            size = len(self.buf)
+        data, self.buf = self.buf[:size], self.buf[size:]
+        self.pos += len(data)
+        return data
+
+    def tell(self):
+        """Return the number of bytes read."""
+        return self.pos
+
+    def abandon(self):
+        """Stop reading, and unblock the writer."""
+        self.abandoned = True
+        try:
+            while True:
+                self.queue.get_nowait()
+        except Empty:
+            pass
+
+
+class _StreamVerifier():
+    """Decrypt and checksum, in a separate thread, the body written to its pipe."""
+
+    def __init__(self, record, chunk_size, algos=()):
+        """Start the decryption thread, computing the checksums for ``algos`` too."""
+        self.pipe = _Pipe()
+        self.checksums = None
+        self.error = None
+        self.thread = Thread(target=self._run, args=(record, chunk_size, algos), daemon=True)
+        self.thread.start()
+
+    def _run(self, record, chunk_size, algos):
+        try:
+            self.checksums = checksum_body(record, self.pipe, chunk_size, algos=algos)
+        except Exception as e:
+            self.error = e
+        finally:
+            self.pipe.abandon()
+
+    def result(self):
+        """Wait for the decryption to finish and return the checksums of the original content, sha256 first, or raise its error."""
+        self.pipe.close()
+        self.thread.join()
+        if self.error:
+            raise self.error
+        return self.checksums
+
+
+def _read_back_required(read_back):
+    """Decide if the vault file must be read again by the verification step.
+
+    ``read_back`` is the fraction of the files to read back: 0 for never, 1 for always.
+    """
+    return read_back >= 1 or random.random() < read_back
+
+
+def _resume_state(fs, target, checkpoint, header_hex, inbox_size):
+    """Return the storage state to resume the copy to ``target`` from, or None.
+
+    The inbox file must have the same header and size as when the checkpoint was recorded.
+    """
+    if checkpoint is None:
+        return None
+    _, header, size, state = checkpoint
+    if header != header_hex or size != inbox_size:
+        LOG.info('The inbox file has changed since the interrupted ingestion: starting afresh')
+        return None
+    if not fs.resumable(target, state):
+        LOG.info('The vault has lost the interrupted copy: starting afresh')
+        return None
+    return state
+
+
+class _VaultCopy():
+    """Copy of an inbox file to the vault, checkpointed in the database.
+
+    An abandoned copy is not resumed: what it left in the vault is removed, with its checkpoint.
+    """
+
+    def __init__(self, fs, file_id, checkpoint=None):
+        """Prepare the copy for ``file_id``, or the continuation of the interrupted one, from its ``checkpoint``."""
+        self.fs = fs
+        self.file_id = file_id
+        self.location = fs.location(file_id)
+        self.state = checkpoint[3] if checkpoint else None
+        self.pending = checkpoint is not None  # something in the vault, not archived yet
+
+    def _save(self, header_hex, inbox_size, state):
+        db.set_checkpoint(self.file_id, header_hex, inbox_size, state)
+        self.state = state
+
+    def copy(self, fileobj, resume, header_hex, inbox_size, size):
+        """Copy ``fileobj`` to the vault, continuing after ``resume``, and return the size of the vault file."""
+        self.pending = True
+        return self.fs.copy(fileobj, self.location, resume=resume,
+                            checkpoint=partial(self._save, header_hex, inbox_size), size=size)
+
+    def archived(self):
+        """Keep the vault file: it belongs to the archived file now."""
+        self.pending = False
+
+    def abandon(self):
+        """Remove the partial vault file, and the checkpoint."""
+        if not self.pending:
+            return
+        self.pending = False
+        LOG.info(f'Removing the abandoned copy to {self.location} (file_id: {self.file_id})')
+        try:
+            self.fs.abandon(self.location, self.state)
+            if self.state is not None:
+                db.delete_checkpoint(self.file_id)
+        except Exception as e:
+            LOG.error(f'Could not remove the abandoned copy to {self.location}: {e!r}')
+
+    def restart(self, file_id):
+        """Abandon the copy, for a new one for ``file_id``."""
+        self.abandon()
+        self.file_id = file_id
+        self.location = self.fs.location(file_id)
+        self.state = None
+
+
+def _skip(body, resume, chunk_size=1 << 22):
+    """Advance ``body`` past the bytes already in the vault, when resuming an interrupted copy from ``resume``.
+
+    They are read when checksummed, and skipped otherwise.
+    """
+    size = resume['size'] if resume else 0
+    if not isinstance(body, ChecksumReader):
+        body.seek(size, 1)
+        return
+    while size > 0:
+        data = body.read(min(size, chunk_size))
+        if not data:
+            break
+        size -= len(data)
+
+
+def _find_duplicate(infile, header_hex, body_size, file_id):
+    """Return the verified file with the same header and body as ``infile``, or None.
+
+    The body is only read, to be checksummed, if there is a verified file with the same header and size.
+    The submission of the same file that the insertion of ``file_id`` just disabled is found too.
+    """
+    duplicate = db.get_duplicate(header_hex, body_size, file_id)
+    if duplicate is None:
+        return None
+    _, _, vault_checksum, vault_checksum_type, _, _ = duplicate
+    start = infile.tell()
+    body = ChecksumReader(infile, algos=[vault_checksum_type.lower()])
+    while body.read(1 << 22):
+        pass
+    infile.seek(start)
+    if body.checksums()[0]['value'] != vault_checksum:
+        LOG.info('Same header and size, but a different body: not a duplicate')
+        return None
+    return duplicate
+
+
+def _archive_duplicate(infile, body_size, channel, data):
+    """Archive the file as a new submission of an identical verified file, if there is one.
+
+    Returns whether it was archived: the completed message is then sent.
+    """
+    duplicate = _find_duplicate(infile, data['header'], body_size, data['file_id'])
+    if duplicate is None:
+        return False
+    duplicate_id, target, vault_checksum, vault_checksum_type, digest, digests = duplicate
+    LOG.info(f'Same file as file_id {duplicate_id}: reusing {target}')
+    checksums = [{'algorithm': vault_checksum_type.lower(), 'value': vault_checksum}]
+    digests = digests or [{'algorithm': 'sha256', 'value': digest}]  # All the checksums of the original content, sha256 first
+    db.set_archived(data['file_id'], target, body_size, checksums[0], data['header'], True, digests[0], digests)
+    data['vault_path'] = target
+    data['vault_checksums'] = checksums
+    publish(completed_message(data, digest, digests), channel, 'lega', 'completed')
+    return True
+
+
 @db.catch_error
 @db.crypt4gh_to_user_errors
-def work(fs, inbox_fs, channel, data):
-    """Read a message, split the header and send the remainder to the backend store."""
+def work(fs, inbox_fs, channel, vault_checksums, read_back, deduplicate, throttle, redelivered, data):
+    """Read a message, split the header and send the remainder to the backend store.
+
+    If ``read_back`` is not None, the fused mode is on, and ``read_back`` is the read-back policy.
+    If ``deduplicate`` is true, a file already archived and verified is not copied again.
+    The copy to the vault is within the bandwidth limits of ``throttle``.
+    Only a ``redelivered`` message can continue an interrupted ingestion.
+    A copy that is not continued, or that failed, is removed from the vault.
+    """
     filepath = data['filepath']
     LOG.info(f"Processing {filepath}")
 
@@ -45,12 +288,24 @@ def work(fs, inbox_fs, channel, data):
     org_msg = data.copy()
     data['org_msg'] = org_msg
 
-    # Insert in database
-    file_id = db.insert_file(filepath, user_id)
+    # Continue an interrupted ingestion of that file, or insert in database, directly in progress (saves a round trip)
+    checkpoint = db.get_checkpoint(filepath, user_id) if redelivered else None
+    file_id = checkpoint[0] if checkpoint else db.insert_file(filepath, user_id, 'IN_INGESTION')
     data['file_id'] = file_id  # must be there: database error uses it
 
-    # Instantiate the inbox backend
-    inbox = inbox_fs(user_id)
+    vault_copy = _VaultCopy(fs, file_id, checkpoint)
+    try:
+        return _ingest(vault_copy, inbox_fs(user_id), channel, vault_checksums, read_back, deduplicate, throttle, checkpoint, data)
+    except Exception:
+        vault_copy.abandon()  # the message is not delivered again after an error: nothing will resume it
+        raise
+
+
+def _ingest(vault_copy, inbox, channel, vault_checksums, read_back, deduplicate, throttle, checkpoint, data):
+    """Copy the body of the inbox file to the vault, through ``vault_copy`` (see :func:`work`)."""
+    filepath = data['filepath']
+    user_id = sanitize_user_id(data['user'])
+    org_msg = data['org_msg']
     LOG.info("Inbox backend: %s", inbox)
 
     # Check if file is in inbox
@@ -59,9 +314,6 @@ def work(fs, inbox_fs, channel, data):
 
     # Ok, we have the file in the inbox
 
-    # Record in database
-    db.mark_in_progress(file_id)
-
     # Sending a progress message to CentralEGA
     org_msg['status'] = 'PROCESSING'
     LOG.debug(f'Sending message to CentralEGA: {data}')
@@ -71,20 +323,63 @@ def work(fs, inbox_fs, channel, data):
     # Strip the header out and copy the rest of the file to the vault
     LOG.debug('Opening %s', filepath)
     with inbox.open(filepath, 'rb') as infile:
-        LOG.debug(f'Reading header | file_id: {file_id}')
+        LOG.debug(f'Reading header | file_id: {data["file_id"]}')
         beginning, header = get_header(infile)
 
-        header_hex = (beginning+header).hex()
+        header_hex = (beginning+header).hex()  # stored in the database when archived
         data['header'] = header_hex
-        db.store_header(file_id, header_hex)  # header bytes will be .hex()
-
-        target = fs.location(file_id)
-        LOG.info(f'[{fs.__class__.__name__}] Moving the rest of {filepath} to {target}')
-        target_size = fs.copy(infile, target)  # It will copy the rest only
+        body_start = infile.tell()
+        infile.seek(0, 2)
+        inbox_size = infile.tell()
+        infile.seek(body_start)
+
+        resume = _resume_state(vault_copy.fs, vault_copy.location, checkpoint, header_hex, inbox_size)
+        if checkpoint and resume is None:
+            data['file_id'] = db.insert_file(filepath, user_id, 'IN_INGESTION')
+            vault_copy.restart(data['file_id'])
+        target = vault_copy.location
+
+        if deduplicate and not resume and _archive_duplicate(infile, inbox_size - body_start, channel, data):
+            return None  # nothing more for the verification step
+
+        # Fused mode: decrypting while copying, unless the vault file will be read back anyway
+        verifier = None
+        if read_back is not None and not _read_back_required(read_back):
+            records, _ = get_records(header)  # might raise exception
+            algos = [algo.strip() for algo in CONF.get_value('quality_control', 'checksums', default='sha256').split(',') if algo.strip()]
+            verifier = _StreamVerifier(records[0], CONF.get_value('vault', 'chunk_size', conv=int, default=1 << 22), algos)
+
+        LOG.info(f'[{vault_copy.fs.__class__.__name__}] Moving the rest of {filepath} to {target}')
+        # Checksumming while copying, so that the vault file is not read again.
+        # Without checksums, the file is passed as-is, and can be copied without going through python.
+        if vault_checksums or verifier:
+            body = ChecksumReader(infile, algos=vault_checksums, tee=verifier.pipe.write if verifier else None)
+        else:
+            body = infile
+        try:
+            _skip(body, resume)
+            target_size = vault_copy.copy(throttle.wrap(body, user_id), resume,  # It will copy the rest only
+                                          header_hex, inbox_size, inbox_size - body_start)
+        except Exception:
+            if verifier:
+                verifier.pipe.close()  # let the decryption thread finish
+            raise
+        unencrypted_checksums = verifier.result() if verifier else []  # raises the decryption errors
+        checksums = body.checksums() if vault_checksums else []
 
         LOG.info(f'Vault copying completed. Updating database')
-        db.set_archived(file_id, target, target_size)
+        # One update for the header, the vault information and the status
+        db.set_archived(data['file_id'], target, target_size, checksums[0] if checksums else None,
+                        header_hex, verifier is not None, unencrypted_checksums[0] if verifier else None, unencrypted_checksums)
+        vault_copy.archived()
         data['vault_path'] = target
+        data['vault_checksums'] = checksums
+
+    if verifier:
+        digest = unencrypted_checksums[0]['value']
+        LOG.info('Verification completed while copying [sha256: %s]', digest)
+        publish(completed_message(data, digest, unencrypted_checksums), channel, 'lega', 'completed')
+        return None  # nothing more for the verification step
 
     LOG.debug(f"Reply message: {data}")
     return data
@@ -99,11 +394,35 @@ def main(args=None):
 
     inbox_fs = getattr(storage, CONF.get_value('inbox', 'driver', default='FileStorage'))
     fs = getattr(storage, CONF.get_value('vault', 'driver', default='FileStorage'))
+    workers = CONF.get_value('ingestion', 'workers', conv=int, default=1)
+    fair = CONF.get_value('ingestion', 'fair_scheduling', conv=bool, default=False)
     broker = get_connection('broker')
-    do_work = partial(work, fs('vault', 'lega'), partial(inbox_fs, 'inbox'), broker.channel())
+    channel = broker.channel()
+    if workers > 1 or fair:  # the work runs outside the connection thread
+        channel = ThreadSafeChannel(broker, channel)
+    vault_checksums = [algo.strip() for algo in CONF.get_value('vault', 'checksums', default='sha256').split(',') if algo.strip()]
+    read_back = None
+    if CONF.get_value('ingestion', 'fused_verify', conv=bool, default=False):
+        policy = CONF.get_value('ingestion', 'read_back', default='never')
+        read_back = float({'never': 0, 'always': 1}.get(policy, policy))
+    deduplicate = CONF.get_value('ingestion', 'deduplicate', conv=bool, default=False)
+    throttle = Throttle(CONF.get_value('ingestion', 'user_rate', conv=int, default=0),
+                        CONF.get_value('ingestion', 'worker_rate', conv=int, default=0))
+    vault = fs('vault', 'lega')
+    if getattr(vault, 'zero_copy', False) and (vault_checksums or read_back is not None):
+        LOG.warning('zero_copy is set, but the files are checksummed or verified while copied: '
+                    'they are copied through python (set [vault] checksums empty, and fused_verify off, to use it)')
+    do_work = partial(work, vault, partial(inbox_fs, 'inbox'), channel, vault_checksums, read_back, deduplicate, throttle)
 
     # upstream link configured in local broker
-    consume(do_work, broker, 'files', 'archived')
+    if fair:
+        consume(do_work, broker, 'files', 'archived', workers=workers,
+                fair_key=lambda data: sanitize_user_id(data.get('user', '')),
+                weights=parse_weights(CONF.get_value('ingestion', 'user_weights', default='')),
+                prefetch=CONF.get_value('ingestion', 'prefetch', conv=int, default=100),
+                redelivered=True)
+    else:
+        consume(do_work, broker, 'files', 'archived', workers=workers, redelivered=True)
 
 
 if __name__ == '__main__':
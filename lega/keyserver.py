@@ -9,24 +9,57 @@ import logging
 import time
 import datetime
 import asyncio
+import heapq
+import hashlib
+import multiprocessing
+import pickle
+import signal
+import socket
+import struct
+import uuid
+from collections import OrderedDict
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 from pathlib import Path
 import ssl
 
 from aiohttp import web
 import pgpy
+from legacryptor import exceptions as crypt_exc
 
 from .conf import CONF, KeysConfiguration
+from .utils.crypt4gh import UnlockedKeys, header_key_id, decrypt_header
+from .utils.exceptions import PGPKeyError
+from .utils.metrics import Registry, Counter, Gauge, Histogram, CONTENT_TYPE
 
 LOG = logging.getLogger(__name__)
 routes = web.RouteTableDef()
 
+METRICS = Registry()
+REQUESTS = METRICS.register(Counter('keyserver_requests_total', 'Requests, by route and status.', ('route', 'status')))
+REQUEST_DURATION = METRICS.register(Histogram('keyserver_request_duration_seconds', 'Request durations, by route.', ('route',)))
+CACHE_LOOKUPS = METRICS.register(Counter('keyserver_cache_lookups_total', 'Key lookups in the cache, by result (hit, miss or expired).',
+                                         ('result',)))
+CACHE_EVICTIONS = METRICS.register(Counter('keyserver_cache_evictions_total', 'Keys evicted from the cache, by reason (lru or expired).',
+                                           ('reason',)))
+KEYS = METRICS.register(Gauge('keyserver_keys', 'Keys in the cache.', lambda: len(_cache.store) if _cache is not None else 0))
+UNLOCKS = METRICS.register(Counter('keyserver_unlocks_total', 'Key unlocks, by status (done or failed).', ('status',)))
+UNLOCK_DURATION = METRICS.register(Histogram('keyserver_unlock_duration_seconds', 'Key unlock durations, S2K derivations included.',
+                                             buckets=(0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)))
+HEADERS = METRICS.register(Counter('keyserver_decrypted_headers_total', 'Headers decrypted, by result (ok or error).', ('result',)))
+
 
 class Cache:
-    """In memory cache."""
+    """In memory cache, of at most ``max_size`` keys, the least recently used being evicted first.
+
+    The keys expire at the given date and time, or after ``ttl`` seconds by default (None for no expiry).
+    The expired keys are evicted when requested, and by :meth:`sweep`, in the order of their expiry.
+    """
 
     def __init__(self, max_size=10, ttl=None):
         """Initialize cache."""
-        self.store = dict()
+        self.store = OrderedDict()  # from the least to the most recently used
+        self.expiries = []  # heap of (expire, keyid). Outdated when the key is evicted or set again.
         self.max_size = max_size
         self.ttl = ttl
         self.FMT = '%d/%b/%y %H:%M:%S'
@@ -35,31 +68,86 @@ class Cache:
 
     def set(self, keyid, key, ttl=None):
         """Assign in the store to the the key the value, its ttl."""
-        self._check_limit()
-        ttl = self.ttl if not ttl else self._parse_date_time(ttl)
         assert key.is_protected and key.is_unlocked, "The PGPKey must be protected and unlocked"
-        key.protect(self.key, pgpy.constants.SymmetricKeyAlgorithm.AES256, pgpy.constants.HashAlgorithm.SHA256)  # re-protect
-        self.store[keyid] = (bytes(key.pubkey), bytes(key), str(key.pubkey), str(key), ttl)
+        self.put(keyid, self.prepare(key), ttl=ttl)
+
+    def prepare(self, key):
+        """Re-protect the unlocked ``key``, and return its cache entry, without storing it.
+
+        This is the slow part (the S2K key derivation), and it does not use the store: it can run on another thread.
+        """
+        return _prepare_key(key, self.key)
+
+    def put(self, keyid, entry, ttl=None):
+        """Store the cache ``entry`` of a key, from :meth:`prepare`, with its ttl."""
+        if ttl:
+            expire = self._parse_date_time(ttl)
+        else:
+            expire = time.time() + self.ttl if self.ttl else None
+        pubkey, privkey, pubkey_armored, privkey_armored, responses = entry
+        self.store.pop(keyid, None)
+        self._check_limit()
+        self.store[keyid] = (pubkey, privkey, pubkey_armored, privkey_armored, expire, responses)
+        if expire:
+            heapq.heappush(self.expiries, (expire, keyid))
+            if len(self.expiries) > 2 * len(self.store) + 16:  # too many outdated entries
+                self._rebuild_expiries()
 
     def get(self, keyid, key_type, key_format=None):
         """Retrieve value based on key."""
         data = self.store.get(keyid)
         if not data:
+            CACHE_LOOKUPS.inc('miss')
             return None
-        pubkey, privkey, pubkey_armored, privkey_armored, expire = data
+        pubkey, privkey, pubkey_armored, privkey_armored, expire, _ = data
         if expire and time.time() > expire:
             del self.store[keyid]
+            CACHE_LOOKUPS.inc('expired')
+            CACHE_EVICTIONS.inc('expired')
             return None
+        CACHE_LOOKUPS.inc('hit')
+        self.store.move_to_end(keyid)
         if key_type == 'public':
             return pubkey_armored if key_format == 'armored' else pubkey
         if key_type == 'private':
             return privkey_armored if key_format == 'armored' else privkey
         return None
 
+    def get_response(self, keyid, key_type, key_format=None):
+        """Retrieve the response body for the key, with its ETag and its expiry (or None), or None."""
+        if self.get(keyid, key_type) is None:  # evicts it, if expired
+            return None
+        _, _, _, _, expire, responses = self.store[keyid]
+        body, etag = responses[(key_type, key_format)]
+        return body, etag, expire
+
+    def sweep(self, now=None):
+        """Evict the expired keys, and return how many were evicted."""
+        now = now or time.time()
+        count = 0
+        while self.expiries and self.expiries[0][0] <= now:
+            expire, keyid = heapq.heappop(self.expiries)
+            data = self.store.get(keyid)
+            if data and data[4] == expire:  # not outdated
+                del self.store[keyid]
+                count += 1
+        if count:
+            LOG.debug(f'Evicted {count} expired keys')
+            CACHE_EVICTIONS.inc('expired', amount=count)
+        return count
+
+    def next_expiry(self):
+        """Return when the next key expires, or None."""
+        return self.expiries[0][0] if self.expiries else None
+
+    def _rebuild_expiries(self):
+        self.expiries = [(data[4], keyid) for keyid, data in self.store.items() if data[4]]
+        heapq.heapify(self.expiries)
+
     def check_ttl(self):
         """Check ttl for all keys."""
         keys = []
-        for key, (_, _, _, _, expire) in self.store.items():
+        for key, (_, _, _, _, expire, _) in self.store.items():
             if expire and time.time() < expire:
                 keys.append({"keyID": key, "ttl": self._time_delta(expire)})
             if expire is None:
@@ -85,34 +173,354 @@ class Cache:
         return time.mktime(datetime.datetime.strptime(date_time, self.FMT).timetuple())
 
     def _check_limit(self):
-        """Check if current cache size exceeds maximum cache size and pop the oldest item in this case."""
-        if len(self.store) >= self.max_size:
-            self.store.popitem(last=False)
+        """Check if current cache size exceeds maximum cache size and pop the least recently used items in this case."""
+        while len(self.store) >= self.max_size:
+            keyid, _ = self.store.popitem(last=False)
+            LOG.debug(f'Evicted key {keyid}: cache full')
+            CACHE_EVICTIONS.inc('lru')
 
     def clear(self):
         """Clear all cache."""
         self.store.clear()
+        self.expiries.clear()
+
+
+async def sweep_expired(cache, interval):
+    """Evict the expired keys from the ``cache``, when they expire, and at least every ``interval`` seconds."""
+    while True:
+        next_expiry = cache.next_expiry()
+        delay = interval if next_expiry is None else min(interval, max(next_expiry - time.time(), 0))
+        await asyncio.sleep(delay)
+        cache.sweep()
+
+
+def _prepare_key(key, password):
+    """Re-protect the unlocked ``key`` with ``password``, and return its cache entry."""
+    key.protect(password, pgpy.constants.SymmetricKeyAlgorithm.AES256, pgpy.constants.HashAlgorithm.SHA256)  # re-protect
+    pubkey, privkey, pubkey_armored, privkey_armored = bytes(key.pubkey), bytes(key), str(key.pubkey), str(key)
+    responses = {('public', None): pubkey, ('private', None): privkey,
+                 ('public', 'armored'): pubkey_armored.encode(), ('private', 'armored'): privkey_armored.encode()}
+    # The response bodies, and their strong ETags, are computed once
+    responses = {k: (body, '"' + hashlib.sha256(body).hexdigest()[:32] + '"') for k, body in responses.items()}
+    return pubkey, privkey, pubkey_armored, privkey_armored, responses
 
 
 _cache = None   # key IDs are uppercase
 _active = None  # will be a KeyID (not a key name)
+_unlocker = None  # executor for the key unlocks (the default one if None)
+_decryptor = None  # executor for the header decryptions (the default one if None)
+_unlocked = None  # unlocked copies of the cached keys, for the header decryptions
+_jobs = OrderedDict()  # the unlock requests, by job ID, from the oldest
+MAX_JOBS = 100  # finished jobs beyond that are forgotten
 
 ####################################
 # Caching the keys
 ####################################
 
 
-def _unlock_key(name, active=None, path=None, expire=None, passphrase=None, **kwargs):
-    """Unlock a key and loading it in the cache."""
+def _read_key(path, passphrase, password):
+    """Load and unlock a key, re-protect it with ``password``, and return its key ID and cache entry.
+
+    This is blocking (two S2K key derivations), so it runs in an executor.
+    It does not touch the cache, nor any global: it can run in another process.
+    """
     key, _ = pgpy.PGPKey.from_file(path)
-    assert not key.is_public, f"The key {name} should be private"
+    assert not key.is_public, f"The key {path} should be private"
     with key.unlock(passphrase) as k:
-        key_id = k.fingerprint.keyid.upper()
-        LOG.debug(f'Activating key: {key_id} ({name})')
-        _cache.set(key_id, k, ttl=expire)
-        if active and name == active:
+        return k.fingerprint.keyid.upper(), _prepare_key(k, password)
+
+
+def _record_job(job):
+    """Record an unlock job, forgetting the oldest finished ones."""
+    _jobs[job['id']] = job
+    for job_id in [i for i, j in _jobs.items() if j['finished']][:max(len(_jobs) - MAX_JOBS, 0)]:
+        del _jobs[job_id]
+    return job
+
+
+def _new_job(name):
+    """Record a new unlock job.
+
+    Its ID is unique across the worker processes: the jobs of all of them are shared.
+    """
+    return _record_job({'id': uuid.uuid4().hex, 'name': name, 'status': 'queued', 'key_id': None, 'error': None,
+                        'submitted': time.time(), 'started': None, 'finished': None})
+
+
+async def _unlock_job(job, path=None, expire=None, passphrase=None, active=None, executor=None, **kwargs):
+    """Unlock a key in the ``executor`` (by default, the unlock one), and load it in the cache, on the event loop.
+
+    With several processes, the job, and then the key, are shared with the other ones.
+    """
+    loop = asyncio.get_event_loop()
+    job.update(status='unlocking', started=time.time())
+    _share(job)
+    entry = None
+    try:
+        key_id, entry = await loop.run_in_executor(executor or _unlocker, _read_key, path, passphrase, _cache.key)
+        LOG.debug(f'Activating key: {key_id} ({job["name"]})')
+        _cache.put(key_id, entry, ttl=expire)
+        if active and job['name'] == active:
             global _active
             _active = key_id
+        job.update(status='done', key_id=key_id)
+    except Exception as e:
+        LOG.error(f'Could not unlock the key {job["name"]}: {e!r}')
+        job.update(status='failed', error=str(e) or repr(e))
+        entry = None
+    job['finished'] = time.time()
+    UNLOCKS.inc(job['status'])
+    UNLOCK_DURATION.observe(job['finished'] - job['started'])
+    _share(job, entry, expire, bool(active) and job['name'] == active)
+
+
+async def load_keys(store, jobs, executor):
+    """Unlock the keys of the ``store``, one per job, concurrently in the ``executor``.
+
+    The keys are served as soon as they are loaded.
+    """
+    await asyncio.gather(*(_unlock_job(job, executor=executor, **dict(store.items(job['name'])))  # includes defaults
+                           for job in jobs))
+    failed = [job['name'] for job in jobs if job['status'] == 'failed']
+    LOG.info(f'Loaded {len(jobs) - len(failed)} keys' + (f', failed: {", ".join(failed)}' if failed else ''))
+
+
+def _unlocked_keys():
+    """Return the unlocked copies of the cached keys: at most one per cached key."""
+    global _unlocked
+    if _unlocked is None:
+        _unlocked = UnlockedKeys(max_size=_cache.max_size)
+    return _unlocked
+
+
+def _decrypt_headers(batch, password):
+    """Decrypt the headers of the ``batch``, and return the records, or the error, for each one.
+
+    The batch has, for each header, its key ID, the armored key from the cache (None if not found) and the header.
+    The keys are unlocked once, and kept unlocked: it runs in the executor.
+    """
+    keys = _unlocked_keys()
+    results = []
+    for key_id, armored, header in batch:
+        try:
+            if key_id is None:
+                raise crypt_exc.InvalidFormatError('Invalid header: no key ID')
+            if armored is None:
+                raise PGPKeyError(f'Key {key_id} not found')
+            with keys.use(key_id, armored, password) as key:
+                records = decrypt_header(key, header)
+            results.append({'key_id': key_id, 'records': [r.as_dict() for r in records]})
+            HEADERS.inc('ok')
+        except (PGPKeyError, crypt_exc.InvalidFormatError) as e:
+            results.append({'key_id': key_id, 'error': getattr(e, 'msg', str(e)), 'type': type(e).__name__})
+            HEADERS.inc('error')
+    return results
+
+
+####################################
+# Several worker processes
+####################################
+
+_broadcast = None  # with several processes, shares the unlock jobs of this one with the others
+
+
+def _send(writer, message):
+    """Send a ``message`` to another process."""
+    data = pickle.dumps(message)
+    writer.write(struct.pack('!I', len(data)) + data)
+
+
+async def _receive(reader):
+    """Receive a message from another process."""
+    size, = struct.unpack('!I', await reader.readexactly(4))
+    return pickle.loads(await reader.readexactly(size))
+
+
+def _share(job, entry=None, ttl=None, active=False):
+    """Send the record of an unlock ``job``, and the key it unlocked, to the other processes, if any."""
+    if _broadcast is not None:
+        _broadcast((dict(job), entry, ttl, active))
+
+
+def _apply_job(app, job, entry, ttl, active):
+    """Record an unlock job from another process, and load its key, if it succeeded.
+
+    The supervisor loads the keys of the store: its jobs update the startup jobs of this worker instead.
+    """
+    if entry is not None:
+        LOG.debug(f'Activating key: {job["key_id"]} ({job["name"]}), from another process')
+        _cache.put(job['key_id'], entry, ttl=ttl)
+        if active:
+            global _active
+            _active = job['key_id']
+    for loading in app['loading']:
+        if loading['name'] == job['name'] and not loading['finished']:
+            loading.update(job, id=loading['id'])
+            return
+    _record_job(job)
+
+
+async def _follow(app, channel):
+    """Apply the unlock jobs of the other processes, and share the ones of this worker, through the supervisor."""
+    reader, writer = await asyncio.open_connection(sock=channel)
+    global _broadcast
+    _broadcast = partial(_send, writer)
+    try:
+        while True:
+            _apply_job(app, *(await _receive(reader)))
+    except asyncio.IncompleteReadError:
+        LOG.error('Lost the connection to the supervisor')
+
+
+class _Relay():
+    """Connections of the supervisor to the workers, relaying the unlock jobs of each worker to the others."""
+
+    def __init__(self):
+        """Initialize the relay, without workers."""
+        self.writers = []
+        self.keys = OrderedDict()  # key ID -> the last message with that key, for the workers started again
+        self.tasks = []
+
+    def broadcast(self, message, source=None):
+        """Send the ``message`` to all the workers, but its ``source``, and remember the key it has, if any."""
+        job, entry = message[0], message[1]
+        if entry is not None:
+            self.keys.pop(job['key_id'], None)
+            self.keys[job['key_id']] = message
+        for writer in self.writers:
+            if writer is not source:
+                _send(writer, message)
+
+    async def _relay(self, reader, source):
+        try:
+            while True:
+                self.broadcast(await _receive(reader), source=source)
+        except asyncio.IncompleteReadError:
+            LOG.error('A worker process exited')
+        self.writers.remove(source)
+
+    async def connect(self, channel):
+        """Connect to a worker, and send it the keys loaded so far."""
+        reader, writer = await asyncio.open_connection(sock=channel)
+        for message in self.keys.values():
+            _send(writer, message)
+        self.writers.append(writer)
+        self.tasks.append(asyncio.ensure_future(self._relay(reader, writer)))
+
+    async def wait(self):
+        """Wait for the workers to exit."""
+        while self.tasks:
+            await self.tasks.pop(0)
+
+    def close(self):
+        """Stop relaying."""
+        for task in self.tasks:
+            task.cancel()
+
+
+async def _supervise(store, loader, channels, respawn=None, interval=1):
+    """Load the keys of the ``store`` once, for all the workers, and relay the unlock jobs of each worker to the others.
+
+    If given, ``respawn`` is called every ``interval`` seconds, and returns the channels to the workers started again
+    since the last call. They first get the keys loaded so far.
+    The ``loader`` executor is shut down once the keys are loaded, before more workers are forked.
+    """
+    relay = _Relay()
+
+    async def load():
+        try:
+            await load_keys(store, jobs, loader)
+        finally:
+            loader.shutdown(wait=False)  # only used at startup
+
+    async def watch():
+        while True:
+            await asyncio.sleep(interval)
+            for channel in respawn():
+                await relay.connect(channel)
+
+    global _broadcast
+    _broadcast = relay.broadcast
+    for channel in channels:
+        await relay.connect(channel)
+    jobs = [_new_job(section) for section in store.sections()]
+    try:
+        await asyncio.gather(load(), *([watch()] if respawn is not None else []))
+        await relay.wait()
+    finally:
+        relay.close()
+
+
+def _reuse_port_socket(host, port, reuse_port=True):
+    """Return a socket bound to ``host`` and ``port``, which other processes can bind too (SO_REUSEPORT), unless not ``reuse_port``."""
+    sock = socket.socket(socket.AF_INET6 if ':' in host else socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((host, port))
+    return sock
+
+
+def _worker(serve, channel, inherited):
+    """Run ``serve`` in a worker process, with its ``channel`` to the supervisor."""
+    # Forked from the running supervisor loop, when started again: its signal handling is not for this process
+    signal.set_wakeup_fd(-1)
+    signal.signal(signal.SIGINT, signal.default_int_handler)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    for sock in inherited:  # the channels of the other workers
+        sock.close()
+    serve(channel=channel)
+
+
+def _run_workers(count, store, loader, serve, metrics_port=0):
+    """Fork ``count`` worker processes running ``serve``, and supervise them.
+
+    The keys are loaded once, in the ``loader`` executor of the supervisor, and sent to the workers.
+    A worker exiting is started again.
+    If ``metrics_port`` is set, the ``i``-th worker also listens on ``metrics_port + i``, to be scraped separately.
+    """
+    context = multiprocessing.get_context('fork')
+    processes, channels = [None] * count, [None] * count
+
+    def spawn(i):
+        channel, child_channel = socket.socketpair()
+        inherited = [c for c in channels if c is not None]  # the channels of the other workers
+        worker_serve = partial(serve, metrics_port=metrics_port + i) if metrics_port else serve
+        process = context.Process(target=_worker, args=(worker_serve, child_channel, inherited), name=f'keyserver-{i + 1}')
+        process.start()
+        child_channel.close()
+        processes[i], channels[i] = process, channel
+        return channel
+
+    def respawn():
+        started = []
+        for i, process in enumerate(processes):
+            if not process.is_alive():
+                LOG.error(f'Worker {process.name} exited (code {process.exitcode}): starting it again')
+                process.join()
+                started.append(spawn(i))
+        return started
+
+    for i in range(count):
+        spawn(i)
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    executor = loader()
+    supervisor = loop.create_task(_supervise(store, executor, list(channels), respawn=respawn))
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, supervisor.cancel)
+    try:
+        loop.run_until_complete(supervisor)
+    except asyncio.CancelledError:
+        pass
+    finally:
+        executor.shutdown(wait=False)
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.join()
+        loop.close()
 
 
 ####################################
@@ -120,6 +528,54 @@ def _unlock_key(name, active=None, path=None, expire=None, passphrase=None, **kw
 ####################################
 
 
+def _route(request):
+    """Return the route of the request, without its variable parts, to label the metrics."""
+    route = request.match_info.route
+    if route.resource is None:
+        return 'unmatched'
+    info = route.resource.get_info()
+    return info.get('formatter') or info.get('path') or 'unknown'
+
+
+@web.middleware
+async def measure(request, handler):
+    """Count the requests, and time them, by route."""
+    start = time.monotonic()
+    status = 500
+    try:
+        response = await handler(request)
+        status = response.status
+        return response
+    except web.HTTPException as e:
+        status = e.status
+        raise
+    finally:
+        route = _route(request)
+        REQUESTS.inc(route, str(status))
+        REQUEST_DURATION.observe(time.monotonic() - start, route)
+
+
+def _key_response(request, key_id, key_type):
+    """Return the response for the cached key, or None.
+
+    The clients can keep the key and revalidate it with If-None-Match: they then get a 304 if it did not change.
+    """
+    key_format = 'armored' if request.content_type == 'text/plain' else None
+    found = _cache.get_response(key_id, key_type, key_format=key_format)
+    if found is None:
+        return None
+    body, etag, expire = found
+    if expire:
+        cache_control = f'private, max-age={max(int(expire - time.time()), 0)}'
+    else:
+        cache_control = 'private, no-cache'  # no expiry, but can be replaced: always revalidate
+    headers = {'ETag': etag, 'Cache-Control': cache_control}
+    if_none_match = request.headers.get('If-None-Match')
+    if if_none_match and any(tag.strip() in (etag, 'W/' + etag, '*') for tag in if_none_match.split(',')):
+        return web.Response(status=304, headers=headers)
+    return web.Response(body=body, headers=headers)
+
+
 @routes.get('/active/{key_type}')
 async def retrieve_active_key(request):
     """Retrieve the active key from the cache and serve it via HTTPS."""
@@ -127,12 +583,11 @@ async def retrieve_active_key(request):
     LOG.debug(f'Requesting active ({key_type}) key')
     if key_type not in ('public', 'private'):
         return web.HTTPForbidden()  # web.HTTPBadRequest()
-    key_format = 'armored' if request.content_type == 'text/plain' else None
     if _active is None:
         return web.HTTPNotFound()
-    k = _cache.get(_active, key_type, key_format=key_format)
-    if k:
-        return web.Response(body=k)  # web.Response(text=k.hex())
+    response = _key_response(request, _active, key_type)
+    if response is not None:
+        return response
     else:
         LOG.warn(f"Requested active ({key_type}) key not found.")
         return web.HTTPNotFound()
@@ -147,32 +602,79 @@ async def retrieve_key(request):
     if key_type not in ('public', 'private'):
         return web.HTTPForbidden()  # web.HTTPBadRequest()
     key_id = requested_id[-16:].upper()
-    key_format = 'armored' if request.content_type == 'text/plain' else None
     LOG.debug(f'Requested {key_type.upper()} key with ID {requested_id}')
-    k = _cache.get(key_id, key_type, key_format=key_format)
-    if k:
-        return web.Response(body=k)  # web.Response(text=value.hex())
+    response = _key_response(request, key_id, key_type)
+    if response is not None:
+        return response
     else:
         LOG.warn(f"Requested key {requested_id} not found.")
         return web.HTTPNotFound()
 
 
+async def decrypt_headers(request):
+    """Decrypt a batch of Crypt4GH headers with the cached keys, and return their records.
+
+    Only routed when the ``decrypt_headers`` option of the ``[keyserver]`` section is on.
+
+    POST request takes the form:
+    {"headers": ["<hex>", ...]}, with the encrypted part of each header (after its first 16 bytes).
+
+    The response has, in the same order, the key ID and the records of each header, or the error.
+    """
+    try:
+        headers = [bytes.fromhex(h) for h in (await request.json())['headers']]
+    except (ValueError, KeyError, TypeError):
+        return web.HTTPBadRequest()
+    LOG.debug(f'Decrypting {len(headers)} headers')
+    batch = []
+    for header in headers:
+        try:
+            key_id = header_key_id(header)
+        except crypt_exc.InvalidFormatError:
+            key_id = None
+        armored = _cache.get(key_id, 'private', 'armored') if key_id else None
+        if armored is None and key_id:
+            _unlocked_keys().invalidate(key_id)  # evicted or expired
+        batch.append((key_id, armored, header))
+    results = await request.app.loop.run_in_executor(_decryptor, _decrypt_headers, batch, _cache.key)
+    return web.json_response({'results': results})
+
+
 @routes.post('/admin/unlock')
 async def unlock_key(request):
     """Unlock a key via a POST request.
 
     POST request takes the form:
     {"private": "path/to/file.sec", "passphrase": "pass", "expire": "30/MAR/18 08:00:00"}
+
+    The key is unlocked in the background: the response is the job, and its progress is at the Location URL.
     """
     key_info = await request.json()
-    LOG.debug(f'Admin unlocking: {key_info}')
+    LOG.debug(f'Admin unlocking: {key_info.get("path")}')
     if all(k in key_info for k in("path", "passphrase", "expire")):
-        _unlock_key('whichname?', **key_info)
-        return web.HTTPAccepted()
+        job = _new_job(key_info.pop('name', 'whichname?'))
+        _share(job)  # its Location can be polled on any worker
+        request.app.loop.create_task(_unlock_job(job, **key_info))
+        return web.json_response(job, status=202, headers={'Location': f'/admin/unlock/{job["id"]}'})
     else:
         return web.HTTPBadRequest()
 
 
+@routes.get('/admin/unlock')
+async def unlock_jobs(request):
+    """Return the recent unlock jobs, and their progress."""
+    return web.json_response(list(_jobs.values()))
+
+
+@routes.get('/admin/unlock/{job_id}')
+async def unlock_job(request):
+    """Return an unlock job, and its progress: queued, unlocking, done or failed."""
+    job = _jobs.get(request.match_info['job_id'])
+    if job is None:
+        return web.HTTPNotFound()
+    return web.json_response(job)
+
+
 @routes.get('/health')
 async def healthcheck(request):
     """Return ok, health endpoint for service discovery.
@@ -183,6 +685,32 @@ async def healthcheck(request):
     return web.HTTPOk()
 
 
+@routes.get('/ready')
+async def readiness(request):
+    """Return the loaded key IDs, and whether all the keys of the store were loaded (200) or not yet (503).
+
+    The keys which failed to load do not hold the readiness up, but are reported.
+    """
+    jobs = request.app.get('loading', [])
+    loading = [job['name'] for job in jobs if not job['finished']]
+    status = {'ready': not loading,
+              'active': _active,
+              'keys': list(_cache.store) if _cache is not None else [],
+              'loading': loading,
+              'failed': [job['name'] for job in jobs if job['status'] == 'failed']}
+    return web.json_response(status, status=503 if loading else 200)
+
+
+@routes.get('/metrics')
+async def metrics(request):
+    """Return the metrics, in the Prometheus text format.
+
+    With several worker processes, each one has its own metrics, labelled with its pid,
+    and is scraped on its own port (see ``metrics_port``): the main port reaches any of them.
+    """
+    return web.Response(body=METRICS.render().encode(), headers={'Content-Type': CONTENT_TYPE})
+
+
 # TO BE REMOVED
 @routes.get('/admin/ttl')
 async def check_ttl(request):
@@ -195,8 +723,81 @@ async def check_ttl(request):
         return web.HTTPBadRequest()
 
 
+def _application(store, loader=None, channel=None):
+    """Return the keyserver application.
+
+    The keys of the ``store`` are loaded after the start, in the ``loader`` executor.
+    With several worker processes, they are received on the ``channel`` to the supervisor instead.
+    """
+    keyserver = web.Application(middlewares=[measure])
+    keyserver.router.add_routes(routes)
+    keyserver['store'] = store
+    keyserver['loading'] = [_new_job(section) for section in store.sections()]
+    global _unlocker, _decryptor
+    _unlocker = ThreadPoolExecutor(max_workers=CONF.get_value('keyserver', 'unlock_workers', conv=int, default=1),
+                                   thread_name_prefix='unlock')
+    if CONF.get_value('keyserver', 'decrypt_headers', conv=bool, default=False):
+        # Not behind the unlocks: a slow unlock does not hold the decryptions back, nor the other way round
+        _decryptor = ThreadPoolExecutor(max_workers=CONF.get_value('keyserver', 'decrypt_workers', conv=int, default=1),
+                                        thread_name_prefix='decrypt')
+        keyserver.router.add_post('/decrypt', decrypt_headers)
+
+    sweep_interval = CONF.get_value('keyserver', 'sweep_interval', conv=int, default=60)
+
+    async def start_sweeper(app):
+        app['sweeper'] = app.loop.create_task(sweep_expired(_cache, sweep_interval))
+
+    async def stop_sweeper(app):
+        app['sweeper'].cancel()
+
+    async def stop_unlocker(app):
+        _unlocker.shutdown(wait=False)
+        if _decryptor is not None:
+            _decryptor.shutdown(wait=False)
+
+    async def start_loading(app):
+        if channel is None:
+            app['loader'] = app.loop.create_task(load_keys(store, app['loading'], loader))
+            app['loader'].add_done_callback(lambda _: loader.shutdown(wait=False))  # only used at startup
+        else:
+            app['loader'] = app.loop.create_task(_follow(app, channel))
+
+    async def stop_loading(app):
+        app['loader'].cancel()
+
+    keyserver.on_startup.append(start_loading)
+    keyserver.on_startup.append(start_sweeper)
+    keyserver.on_cleanup.append(stop_sweeper)
+    keyserver.on_cleanup.append(stop_unlocker)
+    keyserver.on_cleanup.append(stop_loading)
+    return keyserver
+
+
+def _serve(host, port, sslcontext, store, channel=None, loader=None, metrics_port=None):
+    """Run the keyserver, alone (with a ``loader``), or as one of the worker processes (with a ``channel``).
+
+    A worker process also listens on its own ``metrics_port``, if given.
+    """
+    asyncio.set_event_loop(asyncio.new_event_loop())  # not the one of the parent process
+    if channel is not None:
+        METRICS.constant_labels['pid'] = str(os.getpid())
+    keyserver = _application(store, loader=loader, channel=channel)
+    LOG.info(f"Start keyserver on {host}:{port} (pid {os.getpid()})")
+    if channel is None:
+        web.run_app(keyserver, host=host, port=port, shutdown_timeout=0, ssl_context=sslcontext)
+    else:  # the kernel balances the connections between the workers' sockets
+        socks = [_reuse_port_socket(host, port)]
+        if metrics_port:  # this one reaches this worker only
+            LOG.info(f'Metrics of the worker on {host}:{metrics_port}')
+            socks.append(_reuse_port_socket(host, metrics_port, reuse_port=False))
+        web.run_app(keyserver, sock=socks, shutdown_timeout=0, ssl_context=sslcontext)
+
+
 def main(args=None):
-    """Run keyserver with configuration."""
+    """Run keyserver with configuration.
+
+    With ``--workers N``, or ``workers`` in the configuration, N worker processes serve the requests.
+    """
     if not args:
         args = sys.argv[1:]
 
@@ -204,6 +805,7 @@ def main(args=None):
 
     host = CONF.get_value('keyserver', 'host')  # fallbacks are in defaults.ini
     port = CONF.get_value('keyserver', 'port', conv=int)
+    workers = int(args[args.index('--workers') + 1]) if '--workers' in args else CONF.get_value('keyserver', 'workers', conv=int, default=1)
 
     # health_check_url = 'http://{}:{}{}'.format(host, port, CONF.get_value('keyserver', 'health_endpoint'))
     # status_check_url = 'http://{}:{}{}'.format(host, port, CONF.get_value('keyserver', 'status_endpoint'))
@@ -216,22 +818,19 @@ def main(args=None):
     sslcontext.check_hostname = False
     sslcontext.load_cert_chain(ssl_certfile, ssl_keyfile)
 
-    loop = asyncio.get_event_loop()
-
-    keyserver = web.Application(loop=loop)
-    keyserver.router.add_routes(routes)
-
     # Keystore
     store = KeysConfiguration(args)
     global _cache
-    _cache = Cache()
-    # Load all the keys in the store
-    for section in store.sections():
-        _unlock_key(section, **dict(store.items(section)))  # includes defaults
-    keyserver['store'] = store
-
-    LOG.info(f"Start keyserver on {host}:{port}")
-    web.run_app(keyserver, host=host, port=port, shutdown_timeout=0, ssl_context=sslcontext)
+    _cache = Cache(max_size=CONF.get_value('keyserver', 'cache_size', conv=int, default=1000),
+                   ttl=CONF.get_value('keyserver', 'cache_ttl', conv=int, default=0) or None)
+    # The keys of the store are loaded after the start, in parallel
+    loader = partial(ProcessPoolExecutor, max_workers=CONF.get_value('keyserver', 'load_workers', conv=int, default=0) or None)
+
+    if workers > 1:
+        _run_workers(workers, store, loader, partial(_serve, host, port, sslcontext, store),
+                     metrics_port=CONF.get_value('keyserver', 'metrics_port', conv=int, default=0))
+    else:
+        _serve(host, port, sslcontext, store, loader=loader())
 
 
 if __name__ == '__main__':
@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""This module re-checks, in the background, the files already in the vault.
+
+It walks the verified files (``COMPLETED`` or ``READY``), decrypts their
+vault file again and compares the checksum of the original content with
+the one recorded by the verification. A corrupted file is flagged as an
+error, in the database.
+
+The reads from the vault are rate-limited, so that scrubbing can run
+continuously next to the ingestion. The last checked file is recorded
+in the database, after each batch, and an interrupted pass continues
+from there.
+"""
+
+import sys
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from time import sleep
+
+from legacryptor import exceptions as crypt_exc
+
+from .conf import CONF
+from .utils import db, exceptions, storage
+from .utils.scheduling import Throttle
+from .verify import get_records, checksum_body
+
+LOG = logging.getLogger(__name__)
+
+# A vault file in any of those states is corrupted, and not just unavailable for a while
+CORRUPTION_ERRORS = (exceptions.VaultCorruption, crypt_exc.MDCError, crypt_exc.InvalidFormatError, FileNotFoundError)
+
+
+def scrub_file(mover, throttle, chunk_size, row):
+    """Decrypt the vault file of ``row`` and compare the checksum of its original content with the recorded one."""
+    file_id, vault_path, header, checksum, checksum_type = row
+    algo = checksum_type.lower()
+    LOG.debug(f'Scrubbing file_id {file_id}: {vault_path}')
+    records, _ = get_records(bytes.fromhex(header)[16:])  # might raise exception
+    with mover.open(vault_path, 'rb') as infile:
+        # One rate limit for all the workers
+        checksums = checksum_body(records[0], throttle.wrap(infile, 'vault'), chunk_size, algos=[algo])
+    if next(c['value'] for c in checksums if c['algorithm'] == algo) != checksum:
+        raise exceptions.VaultCorruption(algo, vault_path)
+
+
+def check(mover, throttle, chunk_size, row):
+    """Scrub one file, and flag it as an error in the database if it is corrupted.
+
+    Returns True if the file is intact, False if it is corrupted, and None if it could not be checked.
+    The files that could not be checked, for example when the keyserver is down, are checked again in the next pass.
+    """
+    file_id = row[0]
+    try:
+        scrub_file(mover, throttle, chunk_size, row)
+        return True
+    except CORRUPTION_ERRORS as e:
+        LOG.error(f'File_id {file_id} is corrupted: {e!r}')
+        db.set_error(file_id, e)
+        return False
+    except Exception as e:
+        LOG.error(f'Could not scrub file_id {file_id}: {e!r}')
+        return None
+
+
+def scrub_pass(do_check, pool, name, batch_size):
+    """Check all the verified files once, by batches, from the last checked one.
+
+    Returns the number of intact, corrupted and unchecked files.
+    """
+    position = db.get_scrub_position(name)
+    LOG.info(f'Scrubbing the vault from file_id {position}')
+    counts = {True: 0, False: 0, None: 0}
+    while True:
+        rows = db.get_scrub_batch(position, batch_size)
+        if not rows:
+            break
+        for result in pool.map(do_check, rows):
+            counts[result] += 1
+        position = rows[-1][0]
+        db.set_scrub_position(name, position)
+    db.set_scrub_position(name, position, completed=True)
+    LOG.info(f'Scrubbing pass completed: {counts[True]} intact, {counts[False]} corrupted, {counts[None]} unchecked')
+    return counts[True], counts[False], counts[None]
+
+
+def main(args=None):
+    """Run the vault scrubber."""
+    if not args:
+        args = sys.argv[1:]
+
+    CONF.setup(args)  # re-conf
+
+    store = getattr(storage, CONF.get_value('vault', 'driver', default='FileStorage'))
+    chunk_size = CONF.get_value('vault', 'chunk_size', conv=int, default=1 << 22)  # 4 MB
+    workers = CONF.get_value('scrub', 'workers', conv=int, default=2)
+    throttle = Throttle(user_rate=CONF.get_value('scrub', 'rate', conv=int, default=0))
+    name = CONF.get_value('scrub', 'name', default='vault')
+    batch_size = CONF.get_value('scrub', 'batch_size', conv=int, default=100)
+    interval = CONF.get_value('scrub', 'pass_interval', conv=int, default=86400)
+
+    do_check = partial(check, store('vault', 'lega'), throttle, chunk_size)
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='scrub') as pool:
+        while True:
+            scrub_pass(do_check, pool, name, batch_size)
+            sleep(interval)
+
+
+if __name__ == '__main__':
+    main()
@@ -4,8 +4,11 @@ import logging
 import pika
 import json
 import uuid
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
 
 from ..conf import CONF
+from .scheduling import FairExecutor
 
 LOG = logging.getLogger(__name__)
 
@@ -66,7 +69,36 @@ def publish(message, channel, exchange, routing, correlation_id=None):
                                                           delivery_mode=2))
 
 
-def consume(work, connection, from_queue, to_routing):
+class ThreadSafeChannel():
+    """Channel proxy, deferring ``basic_publish`` calls to the connection thread.
+
+    pika connections and channels are not thread-safe. When the work
+    is executed in a worker thread, the publications are scheduled on
+    the thread running the connection I/O loop.
+    """
+
+    def __init__(self, connection, channel):
+        """Wrap ``channel``, belonging to ``connection``."""
+        self.connection = connection
+        self.channel = channel
+
+    def basic_publish(self, **kwargs):
+        """Schedule a publication on the connection thread."""
+        self.connection.add_callback_threadsafe(partial(self.channel.basic_publish, **kwargs))
+
+
+def _executor(workers, fair_key, weights, prefetch):
+    """Return the pool of threads running the work, if any, and how many messages to prefetch."""
+    if fair_key is not None:
+        # The more messages, the fairer
+        return FairExecutor(workers, fair_key, weights, thread_name_prefix='worker'), max(prefetch or 0, workers)
+    if workers > 1:
+        return ThreadPoolExecutor(max_workers=workers, thread_name_prefix='worker'), workers  # One job per worker
+    return None, 1
+
+
+def consume(work, connection, from_queue, to_routing, workers=1, fair_key=None, weights=None, prefetch=None,
+            redelivered=False):
     """Blocking function, registering callback ``work`` to be called.
 
     from_broker must be a pair (from_connection: pika:Connection, from_queue: str)
@@ -78,31 +110,64 @@ def consume(work, connection, from_queue, to_routing):
     If the function ``work`` returns a non-None message, the latter is
     published to the `lega` exchange with ``to_routing`` as the
     routing key.
+
+    If ``workers`` is larger than 1, up to ``workers`` messages are
+    prefetched and ``work`` runs in a pool of threads. The answer is
+    then published, and the message acknowledged, on the connection
+    thread, once ``work`` is done.
+
+    If ``fair_key`` is given, up to ``prefetch`` messages are prefetched,
+    and the next message given to a worker is chosen fairly between the
+    keys of the messages, instead of first come, first served.
+    ``fair_key`` is called with the message, and ``weights`` gives the
+    share of each key (see :class:`FairExecutor`).
+
+    If ``redelivered`` is true, ``work`` is called with whether the
+    message was delivered before (and not acknowledged), then the message.
     """
     assert(from_queue)
+    assert workers > 0, "At least one worker is needed"
 
-    LOG.debug(f'Consuming message from {from_queue}')
+    LOG.debug(f'Consuming message from {from_queue} ({workers} worker(s))')
 
+    executor, prefetch_count = _executor(workers, fair_key, weights, prefetch)
     from_channel = connection.channel()
-    from_channel.basic_qos(prefetch_count=1)  # One job per worker
+    from_channel.basic_qos(prefetch_count=prefetch_count)
     to_channel = connection.channel()
 
+    def reply(answer, delivery_tag, correlation_id):
+        # Publish the answer
+        if answer:
+            assert(to_routing)
+            publish(answer, to_channel, 'lega', to_routing, correlation_id=correlation_id)
+
+        # Acknowledgment: Cancel the message resend in case MQ crashes
+        LOG.debug(f'Sending ACK for message {delivery_tag} (Correlation ID: {correlation_id})')
+        from_channel.basic_ack(delivery_tag=delivery_tag)
+
+    def threaded_work(data, delivery_tag, correlation_id, *args):
+        try:
+            answer = work(*args, data)  # Exceptions should be already caught
+        except Exception as e:
+            # Same as the single-threaded case: we stop, and the unacknowledged messages are redelivered
+            LOG.critical(f'Unhandled error for message {delivery_tag}: {e!r}')
+            connection.add_callback_threadsafe(from_channel.stop_consuming)
+            raise
+        connection.add_callback_threadsafe(partial(reply, answer, delivery_tag, correlation_id))
+
     def process_request(channel, method_frame, props, body):
         correlation_id = props.correlation_id
         message_id = method_frame.delivery_tag
         LOG.debug(f'Consuming message {message_id} (Correlation ID: {correlation_id})')
 
         # Process message in JSON format
-        answer = work(json.loads(body))  # Exceptions should be already caught
-
-        # Publish the answer
-        if answer:
-            assert(to_routing)
-            publish(answer, to_channel, 'lega', to_routing, correlation_id=props.correlation_id)
-
-        # Acknowledgment: Cancel the message resend in case MQ crashes
-        LOG.debug(f'Sending ACK for message {message_id} (Correlation ID: {correlation_id})')
-        channel.basic_ack(delivery_tag=method_frame.delivery_tag)
+        data = json.loads(body)
+        args = (method_frame.redelivered,) if redelivered else ()
+        if executor is None:
+            answer = work(*args, data)  # Exceptions should be already caught
+            reply(answer, message_id, correlation_id)
+        else:
+            executor.submit(threaded_work, data, message_id, correlation_id, *args)
 
     # Let's do this
     try:
@@ -111,4 +176,12 @@ def consume(work, connection, from_queue, to_routing):
     except KeyboardInterrupt:
         from_channel.stop_consuming()
     finally:
+        if executor is not None:
+            # Only the running work is waited for: the prefetched messages not started yet stay unacknowledged,
+            # and are redelivered
+            executor.shutdown(wait=True)
+            # The answers and acknowledgments of the finished work are queued on the connection: send them,
+            # else the messages are redelivered, and worked on again
+            if connection.is_open:
+                connection.process_data_events(time_limit=0)
         connection.close()
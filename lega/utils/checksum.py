@@ -3,6 +3,8 @@
 
 import logging
 import hashlib
+from queue import Queue
+from threading import Thread
 
 from .exceptions import UnsupportedHashAlgorithm, CompanionNotFound
 
@@ -12,11 +14,13 @@ LOG = logging.getLogger(__name__)
 _DIGEST = {
     'md5': hashlib.md5,
     'sha256': hashlib.sha256,
+    'sha384': hashlib.sha384,
+    'sha512': hashlib.sha512,
 }
 
 
 def supported_algorithms():
-    """Supported hashing algorithms, currently ``md5`` and ``sha256``."""
+    """Supported hashing algorithms, currently ``md5``, ``sha256``, ``sha384`` and ``sha512``."""
     return tuple(_DIGEST.keys())
 
 
@@ -28,6 +32,92 @@ def instantiate(algo):
         raise UnsupportedHashAlgorithm(algo)
 
 
+class ChecksumReader():
+    """Read-only file-object wrapper, counting the bytes and updating the digests of what is read through it.
+
+    It allows a single pass over a file, when copying it somewhere and computing its size and checksums.
+    If ``tee`` is given, it is also called with every chunk read.
+    """
+
+    def __init__(self, fileobj, algos=('sha256',), tee=None):
+        """Wrap ``fileobj`` and instantiate the ``algos`` digests."""
+        self.fileobj = fileobj
+        self.digests = [(algo, instantiate(algo)) for algo in algos]
+        self.tee = tee
+        self.size = 0
+
+    def read(self, size=-1):
+        """Read from the underlying file object, and update the counter and digests."""
+        data = self.fileobj.read(size)
+        self.size += len(data)
+        for _, m in self.digests:
+            m.update(data)
+        if self.tee and data:
+            self.tee(data)
+        return data
+
+    def readinto(self, b):
+        """Read into the pre-allocated ``b`` from the underlying file object, and update the counter and digests."""
+        n = self.fileobj.readinto(b)
+        if n:
+            self.size += n
+            chunk = memoryview(b)[:n]
+            for _, m in self.digests:
+                m.update(chunk)
+            if self.tee:
+                self.tee(chunk)
+        return n
+
+    def checksums(self):
+        """Return a list of ``{'algorithm': ..., 'value': ...}``, in the order of the given algorithms."""
+        return [{'algorithm': algo, 'value': m.hexdigest()} for algo, m in self.digests]
+
+
+class Digests():
+    """Digests of a stream, each updated in a thread of its own.
+
+    hashlib releases the GIL while hashing large chunks, so the digests use as many cores.
+    The chunks given to ``update`` must not be modified afterwards.
+    """
+
+    def __init__(self, algos, maxsize=8):
+        """Instantiate the ``algos`` digests, and start their threads, each with at most ``maxsize`` chunks waiting."""
+        self.digests = [(algo, instantiate(algo)) for algo in algos]
+        self.queues = [Queue(maxsize) for _ in self.digests]
+        self.threads = [Thread(target=self._run, args=(m, q), daemon=True) for (_, m), q in zip(self.digests, self.queues)]
+        self.closed = False
+        for t in self.threads:
+            t.start()
+
+    @staticmethod
+    def _run(m, queue):
+        while True:
+            data = queue.get()
+            if data is None:
+                break
+            m.update(data)
+
+    def update(self, data):
+        """Pass ``data`` to all the digests."""
+        for q in self.queues:
+            q.put(data)
+
+    def close(self):
+        """Wait for the digests to be up-to-date, and stop their threads."""
+        if self.closed:
+            return
+        self.closed = True
+        for q in self.queues:
+            q.put(None)
+        for t in self.threads:
+            t.join()
+
+    def checksums(self):
+        """Return a list of ``{'algorithm': ..., 'value': ...}``, in the order of the given algorithms."""
+        self.close()
+        return [{'algorithm': algo, 'value': m.hexdigest()} for algo, m in self.digests]
+
+
 def calculate(filepath, algo, bsize=8192):
     """Compute the checksum of the file-object ``f`` using the message digest ``m``."""
     try:
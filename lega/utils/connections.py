@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+
+"""Pool of keep-alive HTTP(S) connections to one server.
+
+The connections are reused between requests, so that the TCP and TLS
+handshakes only happen when a connection is opened, or re-opened after
+the server closed it.
+"""
+
+import ssl
+import queue
+import logging
+import threading
+from http.client import HTTPConnection, HTTPSConnection, HTTPException
+from urllib.parse import urlsplit
+from time import monotonic, sleep
+
+LOG = logging.getLogger(__name__)
+
+
+class ConnectionPool():
+    """Pool of at most ``size`` keep-alive connections to the server of ``url``.
+
+    ``connect_timeout`` applies to the handshakes and ``timeout`` to the responses.
+    A failed request is attempted ``nb_try`` times in total, waiting
+    ``try_interval`` seconds before the first retry and twice as long before each following one.
+    """
+
+    def __init__(self, url, size=4, connect_timeout=5, timeout=30, nb_try=3, try_interval=0.5, verify=True):
+        """Initialize the pool, without opening connections yet."""
+        parts = urlsplit(url)
+        self.scheme = parts.scheme
+        self.host = parts.hostname
+        self.port = parts.port
+        self.connect_timeout = connect_timeout
+        self.timeout = timeout
+        self.nb_try = max(nb_try, 1)
+        self.try_interval = try_interval
+        self.context = None
+        if self.scheme == 'https':
+            self.context = ssl.create_default_context()
+            if not verify:
+                self.context.check_hostname = False
+                self.context.verify_mode = ssl.CERT_NONE
+        self.idle = queue.LifoQueue()  # the most recently used first: the least likely to be closed by the server
+        self.slots = threading.BoundedSemaphore(size)
+        self.lock = threading.Lock()
+        self.counters = {'requests': 0, 'handshakes': 0, 'handshake_time': 0.0,
+                         'reused': 0, 'retries': 0, 'failures': 0, 'latency': 0.0, 'max_latency': 0.0}
+
+    def _count(self, **values):
+        with self.lock:
+            for k, v in values.items():
+                self.counters[k] += v
+
+    def _connect(self):
+        """Open a new connection, and time its handshake."""
+        if self.scheme == 'https':
+            conn = HTTPSConnection(self.host, self.port, timeout=self.connect_timeout, context=self.context)
+        else:
+            conn = HTTPConnection(self.host, self.port, timeout=self.connect_timeout)
+        start = monotonic()
+        conn.connect()
+        self._count(handshakes=1, handshake_time=monotonic() - start)
+        conn.sock.settimeout(self.timeout)
+        return conn
+
+    def _get_connection(self):
+        """Return an idle connection and True, or a new one and False."""
+        try:
+            return self.idle.get_nowait(), True
+        except queue.Empty:
+            return self._connect(), False
+
+    def _send(self, conn, method, path, headers, body):
+        try:
+            conn.request(method, path, body=body, headers=headers or {})
+            response = conn.getresponse()
+            return response, response.read()
+        except Exception:
+            conn.close()
+            raise
+
+    def _request(self, method, path, headers, body):
+        """Make one request, on an idle connection or on a new one."""
+        with self.slots:
+            conn, reused = self._get_connection()
+            try:
+                response, payload = self._send(conn, method, path, headers, body)
+            except (OSError, HTTPException) as e:
+                if not reused:
+                    raise
+                # The server probably closed the idle connection: once more, on a new one
+                LOG.debug(f'Idle connection to {self.host} lost ({e!r})')
+                conn, reused = self._connect(), False
+                response, payload = self._send(conn, method, path, headers, body)
+            if response.will_close:
+                conn.close()
+            else:
+                self.idle.put(conn)
+        return response, payload, reused
+
+    def request(self, method, path, headers=None, body=None):
+        """Send the request, with its ``body`` if any, and return the response and its payload.
+
+        The connection and protocol errors are retried.
+        """
+        backoff = self.try_interval
+        for count in range(1, self.nb_try + 1):
+            start = monotonic()
+            try:
+                response, payload, reused = self._request(method, path, headers, body)
+                latency = monotonic() - start
+                self._count(requests=1, reused=int(reused), latency=latency)
+                with self.lock:
+                    self.counters['max_latency'] = max(self.counters['max_latency'], latency)
+                return response, payload
+            except (OSError, HTTPException) as e:
+                self._count(failures=1)
+                if count == self.nb_try:
+                    LOG.error(f'Request to {self.host} failed after {count} attempts: {e!r}')
+                    raise
+                LOG.debug(f'Request to {self.host} failed ({e!r}): retrying in {backoff} seconds')
+                self._count(retries=1)
+                sleep(backoff)
+                backoff *= 2
+
+    def get(self, url, headers=None):
+        """Send a GET request for ``url``, on the server of the pool."""
+        parts = urlsplit(url)
+        path = parts.path + ('?' + parts.query if parts.query else '')
+        return self.request('GET', path or '/', headers)
+
+    def post(self, url, body, headers=None):
+        """Send a POST request for ``url``, with ``body``, on the server of the pool."""
+        parts = urlsplit(url)
+        path = parts.path + ('?' + parts.query if parts.query else '')
+        return self.request('POST', path or '/', headers, body)
+
+    def stats(self):
+        """Return the counters, with the average handshake and request durations."""
+        with self.lock:
+            stats = dict(self.counters)
+        stats['idle'] = self.idle.qsize()
+        stats['avg_handshake_time'] = stats['handshake_time'] / stats['handshakes'] if stats['handshakes'] else 0.0
+        stats['avg_latency'] = stats['latency'] / stats['requests'] if stats['requests'] else 0.0
+        return stats
+
+    def close(self):
+        """Close the idle connections."""
+        while True:
+            try:
+                self.idle.get_nowait().close()
+            except queue.Empty:
+                break
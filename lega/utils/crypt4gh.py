@@ -0,0 +1,266 @@
+# -*- coding: utf-8 -*-
+
+"""Crypt4GH header decryption with unlocked keys, and body decryption.
+
+See :doc:`the encryption format </encryption>`.
+The body starts with the sha256 checksum of the original content (the MDC),
+followed by the content encrypted with AES-256 in CTR mode.
+"""
+
+import io
+import struct
+import hashlib
+import logging
+import threading
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack, contextmanager
+from time import monotonic
+
+import pgpy
+from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+from cryptography.hazmat.backends import default_backend
+from legacryptor import exceptions as crypt_exc
+
+from .exceptions import PGPKeyError
+
+LOG = logging.getLogger(__name__)
+
+MDC_SIZE = 32  # sha256
+
+
+class Record():
+    """Section of the original file, with its session key, IV and counter offset."""
+
+    def __init__(self, session_key, iv, plaintext_start=0, plaintext_end=0xFFFFFFFFFFFFFFFF,
+                 ciphertext_start=0, ctr_offset=0, method=0):
+        """Initialize the record."""
+        self.session_key = session_key
+        self.iv = iv
+        self.plaintext_start = plaintext_start
+        self.plaintext_end = plaintext_end
+        self.ciphertext_start = ciphertext_start
+        self.ctr_offset = ctr_offset
+        self.method = method
+
+    def __repr__(self):
+        """Show the record, without the key material."""
+        return f'<Record {self.plaintext_start}|{self.plaintext_end}|{self.ciphertext_start}|{self.ctr_offset}|{self.method}>'
+
+    def as_dict(self):
+        """Return the record as a dictionary, serializable in JSON (the key material in hex)."""
+        return {'session_key': self.session_key.hex(), 'iv': self.iv.hex(),
+                'plaintext_start': self.plaintext_start, 'plaintext_end': self.plaintext_end,
+                'ciphertext_start': self.ciphertext_start, 'ctr_offset': self.ctr_offset, 'method': self.method}
+
+    @classmethod
+    def from_dict(cls, data):
+        """Return the record from its dictionary, from :meth:`as_dict`."""
+        return cls(bytes.fromhex(data['session_key']), bytes.fromhex(data['iv']),
+                   data['plaintext_start'], data['plaintext_end'], data['ciphertext_start'], data['ctr_offset'], data['method'])
+
+
+def _parse_records(data):
+    """Parse the decrypted part of the header."""
+    stream = io.BytesIO(data)
+    try:
+        count, = struct.unpack('<I', stream.read(4))
+        records = []
+        for _ in range(count):
+            plaintext_start, plaintext_end, ciphertext_start, ctr_offset, method = struct.unpack('<QQQQI', stream.read(36))
+            session_key, iv = stream.read(32), stream.read(16)
+            if len(iv) != 16:
+                raise ValueError('Truncated record')
+            records.append(Record(session_key, iv, plaintext_start, plaintext_end, ciphertext_start, ctr_offset, method))
+        return records
+    except (struct.error, ValueError) as e:
+        raise crypt_exc.InvalidFormatError(f'Invalid header records: {e}') from e
+
+
+def header_key_id(header):
+    """Return the ID of the key which encrypted the ``header``."""
+    try:
+        return next(iter(pgpy.PGPMessage.from_blob(header).encrypters))
+    except Exception as e:
+        raise crypt_exc.InvalidFormatError(f'Invalid header: {e!r}') from e
+
+
+def decrypt_header(key, header):
+    """Decrypt the encrypted part of the ``header`` with the unlocked private ``key``, and return its records."""
+    try:
+        message = pgpy.PGPMessage.from_blob(header)
+        data = key.decrypt(message).message
+    except Exception as e:
+        raise PGPKeyError(f'Could not decrypt the header: {e}') from e
+    if isinstance(data, str):  # literal data in text mode
+        data = data.encode()
+    return _parse_records(bytes(data))
+
+
+def body_decrypt(record, infile, process_output=None, chunk_size=4096, workers=1):
+    """Decrypt the body from ``infile`` with ``record``, passing the original content to ``process_output``, in chunks.
+
+    With several ``workers``, the chunks are decrypted in parallel, and passed in order.
+    The checksum of the original content is then compared to the MDC, and returned (sha256 digest).
+    """
+    if record.method != 0:
+        raise crypt_exc.InvalidFormatError(f'Unsupported encryption method: {record.method}')
+    mdc = bytes(infile.read(record.ciphertext_start)[:MDC_SIZE])
+    if workers > 1:
+        chunks = _parallel_decrypt(record, infile, chunk_size, workers)
+    else:
+        chunks = _decrypt(record, infile, chunk_size)
+    md = hashlib.sha256()
+    for plaintext in chunks:
+        md.update(plaintext)
+        if process_output:
+            process_output(plaintext)
+    if md.digest() != mdc:
+        raise crypt_exc.MDCError('Invalid MDC: the checksums of the original content do not match')
+    return mdc
+
+
+def _decryptor(record, offset):
+    """Return an AES-CTR decryptor, starting at the ``offset`` of the encrypted content."""
+    decryptor = Cipher(algorithms.AES(record.session_key), modes.CTR(_counter(record, offset - offset % 16)),
+                       backend=default_backend()).decryptor()
+    if offset % 16:  # within a block: skip the start of its key stream
+        decryptor.update(bytes(offset % 16))
+    return decryptor
+
+
+def _decrypt(record, infile, chunk_size):
+    """Decrypt the chunks of ``infile``, one by one."""
+    decryptor = _decryptor(record, 0)
+    while True:
+        data = infile.read(chunk_size)
+        if not data:
+            break
+        yield decryptor.update(data)
+
+
+def _decrypt_segment(record, offset, data):
+    decryptor = _decryptor(record, offset)
+    return decryptor.update(data) + decryptor.finalize()
+
+
+def _parallel_decrypt(record, infile, chunk_size, workers):
+    """Decrypt the chunks of ``infile`` on ``workers`` threads, and return them in order.
+
+    In CTR mode, each chunk is decrypted independently, from the counter at its offset.
+    OpenSSL does not hold the GIL, so the threads use as many cores.
+    At most twice as many chunks as workers are read ahead.
+    """
+    pending = deque()
+    offset = 0
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='decrypt') as pool:
+        try:
+            while True:
+                data = infile.read(chunk_size)
+                if data:
+                    pending.append(pool.submit(_decrypt_segment, record, offset, data))
+                    offset += len(data)
+                while pending and (not data or len(pending) > 2 * workers):
+                    yield pending.popleft().result()
+                if not data:
+                    break
+        finally:
+            for future in pending:  # on error, or when not consumed to the end
+                future.cancel()
+
+
+def _counter(record, offset):
+    """Return the CTR counter block for the plaintext ``offset`` (a multiple of 16) of ``record``."""
+    value = int.from_bytes(record.iv, 'big') + (offset + record.ctr_offset) // 16
+    return (value % (1 << 128)).to_bytes(16, 'big')
+
+
+class _UnlockedKey():
+    """Unlocked private key, locked again when dropped from the cache and no longer in use."""
+
+    def __init__(self, key, unlocked, expire):
+        """Initialize the entry, in use once (by the thread unlocking it)."""
+        self.key = key
+        self.unlocked = unlocked
+        self.expire = expire
+        self.users = 1
+        self.dropped = False
+
+
+class UnlockedKeys():
+    """Cache of unlocked private keys, by key ID.
+
+    It holds up to ``max_size`` keys, the least recently used being evicted first,
+    each for ``ttl`` seconds (None for no expiry).
+    The keys are counted while in use (see :meth:`use`): an evicted or invalidated key
+    is only locked again after its last use.
+    """
+
+    def __init__(self, max_size=10, ttl=None):
+        """Initialize the cache."""
+        self.max_size = max_size
+        self.ttl = ttl
+        self.keys = OrderedDict()  # key_id -> _UnlockedKey
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def use(self, key_id, armored, passphrase):
+        """Yield the unlocked key for ``key_id``, unlocking the ``armored`` private key if it is not cached.
+
+        ``armored`` can be a function returning it, then only called when the key is not cached.
+        """
+        entry = self._get(key_id)
+        if entry is None:
+            entry = self._unlock(key_id, armored() if callable(armored) else armored, passphrase)
+        try:
+            yield entry.key
+        finally:
+            with self.lock:
+                entry.users -= 1
+                if entry.dropped and not entry.users:
+                    entry.unlocked.close()  # clears the unlocked key material
+
+    def _get(self, key_id):
+        """Return the entry for ``key_id``, counted as in use, or None."""
+        with self.lock:
+            entry = self.keys.get(key_id)
+            if entry is None:
+                return None
+            if entry.expire is not None and entry.expire < monotonic():
+                LOG.debug(f'Unlocked key {key_id} expired')
+                self._drop(key_id)
+                return None
+            self.keys.move_to_end(key_id)
+            entry.users += 1
+            return entry
+
+    def _unlock(self, key_id, armored, passphrase):
+        """Unlock the ``armored`` private key, cache it, and return its entry, counted as in use."""
+        unlocked = ExitStack()
+        try:
+            key, _ = pgpy.PGPKey.from_blob(armored)
+            unlocked.enter_context(key.unlock(passphrase))
+        except Exception as e:
+            raise PGPKeyError(f'Could not unlock the key {key_id}: {e}') from e
+        entry = _UnlockedKey(key, unlocked, None if self.ttl is None else monotonic() + self.ttl)
+        with self.lock:
+            if key_id in self.keys:
+                self._drop(key_id)
+            self.keys[key_id] = entry
+            while len(self.keys) > self.max_size:
+                self._drop(next(iter(self.keys)))
+        LOG.debug(f'Unlocked key {key_id} cached')
+        return entry
+
+    def invalidate(self, key_id=None):
+        """Drop the key for ``key_id``, or all the keys."""
+        with self.lock:
+            for k in ([key_id] if key_id is not None else list(self.keys)):
+                if k in self.keys:
+                    self._drop(k)
+
+    def _drop(self, key_id):
+        entry = self.keys.pop(key_id)
+        entry.dropped = True
+        if not entry.users:  # else, locked again after its last use
+            entry.unlocked.close()  # clears the unlocked key material
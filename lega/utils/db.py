@@ -3,7 +3,9 @@
 """Database Connection."""
 
 import sys
+import json
 import traceback
+import threading
 from functools import wraps
 import logging
 import psycopg2
@@ -83,17 +85,17 @@ def _do_exit():
 ######################################
 #          "Classic" code            #
 ######################################
-_conn = None
+_local = threading.local()  # one connection per thread: each one runs its own transactions
 
 
 def cache_connection(func):
     """Cache the database connection decorator."""
     @wraps(func)
     def wrapper(*args, **kwargs):
-        global _conn
-        if _conn is None or _conn.closed:
-            _conn = func(*args, **kwargs)
-        return _conn
+        conn = getattr(_local, 'conn', None)
+        if conn is None or conn.closed:
+            conn = _local.conn = func(*args, **kwargs)
+        return conn
     return wrapper
 
 
@@ -110,13 +112,14 @@ def connect():
     return psycopg2.connect(**db_args)
 
 
-def insert_file(filename, user_id):
-    """Insert a new file entry and returns its id."""
+def insert_file(filename, user_id, status='INIT'):
+    """Insert a new file entry, with the given ``status``, and returns its id."""
     with connect() as conn:
         with conn.cursor() as cur:
-            cur.execute('SELECT local_ega.insert_file(%(filename)s,%(user_id)s);',
+            cur.execute('SELECT local_ega.insert_file(%(filename)s,%(user_id)s,%(status)s);',
                         {'filename': filename,
                          'user_id': user_id,
+                         'status': status,
                          })
             file_id = (cur.fetchone())[0]
             if file_id:
@@ -172,9 +175,36 @@ def mark_in_progress(file_id):
     return _set_status(file_id, 'IN_INGESTION')
 
 
-def mark_completed(file_id):
-    """Mark file as completed."""
-    return _set_status(file_id, 'COMPLETED')
+def mark_completed(file_id, unencrypted_checksum=None, checksums=None):
+    """Mark file as completed.
+
+    ``unencrypted_checksum`` is a dict with the ``algorithm`` and the ``value`` of the checksum of the original content.
+    ``checksums`` is a list of such dicts, all recorded in ``local_ega.vault_file_checksums``, in the same transaction.
+    """
+    if unencrypted_checksum is None:
+        return _set_status(file_id, 'COMPLETED')
+    assert file_id, 'Eh? No file_id?'
+    LOG.debug(f'Updating status file_id {file_id} with "COMPLETED"')
+    checksums = checksums or []
+    query = ('UPDATE local_ega.files '
+             'SET status = %(status)s, '
+             '    unencrypted_checksum = %(checksum)s, '
+             '    unencrypted_checksum_type = upper(%(checksum_type)s)::local_ega.checksum_algorithm '
+             'WHERE id = %(file_id)s;')
+    if checksums:
+        query += ('INSERT INTO local_ega.vault_file_checksums (file_id, checksum_type, checksum) '
+                  'SELECT %(file_id)s, upper(c.algorithm)::local_ega.checksum_algorithm, c.value '
+                  'FROM unnest(%(algorithms)s::text[], %(values)s::text[]) AS c(algorithm, value) '
+                  'ON CONFLICT (file_id, checksum_type) DO UPDATE SET checksum = EXCLUDED.checksum;')
+    with connect() as conn:
+        with conn.cursor() as cur:
+            cur.execute(query,
+                        {'status': 'COMPLETED',
+                         'file_id': file_id,
+                         'checksum': unencrypted_checksum['value'],
+                         'checksum_type': unencrypted_checksum['algorithm'],
+                         'algorithms': [c['algorithm'] for c in checksums],
+                         'values': [c['value'] for c in checksums]})
 
 
 def set_stable_id(file_id, stable_id):
@@ -206,29 +236,181 @@ def store_header(file_id, header):
                          'header': header})
 
 
-def set_archived(file_id, vault_path, vault_filesize):
-    """Archive ``file_id``."""
+def set_archived(file_id, vault_path, vault_filesize, vault_checksum=None, header=None, completed=False, unencrypted_checksum=None,
+                 checksums=None):
+    """Archive ``file_id``.
+
+    ``vault_checksum`` is a dict with the ``algorithm`` and the ``value`` of the checksum of the vault file.
+
+    In order to save round trips and commits, the ``header`` can be stored at the same time,
+    and the file can directly be marked as completed, when it was verified during ingestion.
+    The checksum of the original content is then given as ``unencrypted_checksum``,
+    and all its checksums can be recorded in ``local_ega.vault_file_checksums`` with ``checksums`` (see :func:`mark_completed`).
+    """
     assert file_id, 'Eh? No file_id?'
     assert vault_path, 'Eh? No vault name?'
-    LOG.debug(f'Setting status to archived for file_id {file_id}')
+    status = 'COMPLETED' if completed else 'ARCHIVED'
+    LOG.debug(f'Setting status to {status.lower()} for file_id {file_id}')
+    vault_checksum = vault_checksum or {}
+    unencrypted_checksum = unencrypted_checksum or {}
+    checksums = checksums or []
+    query = ('UPDATE local_ega.files '
+             'SET status = %(status)s, '
+             '    vault_path = %(vault_path)s, '
+             '    vault_filesize = %(vault_filesize)s, '
+             '    vault_checksum = %(vault_checksum)s, '
+             '    vault_checksum_type = upper(%(vault_checksum_type)s)::local_ega.checksum_algorithm, '
+             '    header = COALESCE(%(header)s, header), '
+             '    unencrypted_checksum = %(unencrypted_checksum)s, '
+             '    unencrypted_checksum_type = upper(%(unencrypted_checksum_type)s)::local_ega.checksum_algorithm '
+             'WHERE id = %(file_id)s; '
+             'DELETE FROM local_ega.ingestion_checkpoints WHERE file_id = %(file_id)s;')
+    if checksums:
+        query += ('INSERT INTO local_ega.vault_file_checksums (file_id, checksum_type, checksum) '
+                  'SELECT %(file_id)s, upper(c.algorithm)::local_ega.checksum_algorithm, c.value '
+                  'FROM unnest(%(algorithms)s::text[], %(values)s::text[]) AS c(algorithm, value) '
+                  'ON CONFLICT (file_id, checksum_type) DO UPDATE SET checksum = EXCLUDED.checksum;')
     with connect() as conn:
         with conn.cursor() as cur:
-            cur.execute('UPDATE local_ega.files '
-                        'SET status = %(status)s, '
-                        '    vault_path = %(vault_path)s, '
-                        '    vault_filesize = %(vault_filesize)s '
-                        'WHERE id = %(file_id)s;',
-                        {'status': 'ARCHIVED',
+            cur.execute(query,
+                        {'status': status,
                          'file_id': file_id,
                          'vault_path': vault_path,
-                         'vault_filesize': vault_filesize})
+                         'vault_filesize': vault_filesize,
+                         'vault_checksum': vault_checksum.get('value'),
+                         'vault_checksum_type': vault_checksum.get('algorithm'),
+                         'header': header,
+                         'unencrypted_checksum': unencrypted_checksum.get('value'),
+                         'unencrypted_checksum_type': unencrypted_checksum.get('algorithm'),
+                         'algorithms': [c['algorithm'] for c in checksums],
+                         'values': [c['value'] for c in checksums]})
+
+
+def get_duplicate(header, vault_filesize, file_id=None):
+    """Retrieve an archived and verified file, with the same ``header`` and vault file size.
+
+    Returns the file id, the vault path, the vault checksum, its type, the (sha256) checksum of the original content,
+    and all the recorded checksums of the original content (as a list of dicts with the ``algorithm`` and the ``value``,
+    sha256 first), or None.
+    Only the verified files have a checksum of the original content.
+    The disabled submissions are not reused: their vault file might be cleaned up.
+    Except the ones of the same path and user as ``file_id``: they were just disabled by its insertion,
+    and their vault file is then referenced by ``file_id``.
+    """
+    with connect() as conn:
+        with conn.cursor() as cur:
+            cur.execute('SELECT f.id, f.vault_path, f.vault_checksum, f.vault_checksum_type, f.unencrypted_checksum, '
+                        "       (SELECT json_agg(json_build_object('algorithm', lower(c.checksum_type::text), 'value', c.checksum) "
+                        '                        ORDER BY c.checksum_type <> %(checksum_type)s, c.checksum_type) '
+                        '        FROM local_ega.vault_file_checksums c WHERE c.file_id = f.id) '
+                        'FROM local_ega.files f '
+                        'WHERE md5(f.header) = md5(%(header)s) AND f.header = %(header)s AND '
+                        '      f.vault_filesize = %(vault_filesize)s AND '
+                        '      f.vault_checksum IS NOT NULL AND '
+                        '      f.unencrypted_checksum_type = %(checksum_type)s AND '
+                        '      (f.status NOT IN %(statuses)s OR '
+                        '       (f.status = %(disabled)s AND '
+                        '        (f.inbox_path, f.elixir_id) = (SELECT n.inbox_path, n.elixir_id '
+                        '                                       FROM local_ega.files n WHERE n.id = %(file_id)s))) AND '
+                        '      f.id IS DISTINCT FROM %(file_id)s '
+                        'ORDER BY f.id DESC LIMIT 1;',
+                        {'header': header,
+                         'vault_filesize': vault_filesize,
+                         'checksum_type': 'SHA256',
+                         'statuses': ('ERROR', 'DISABLED'),
+                         'disabled': 'DISABLED',
+                         'file_id': file_id})
+            return cur.fetchone()
+
+
+def get_checkpoint(filename, user_id):
+    """Retrieve the checkpoint of the latest interrupted ingestion of ``filename``, for ``user_id``.
+
+    Returns the file id, the header, the inbox file size and the storage state, or None.
+    """
+    with connect() as conn:
+        with conn.cursor() as cur:
+            cur.execute('SELECT f.id, c.header, c.inbox_filesize, c.state '
+                        'FROM local_ega.files f '
+                        'INNER JOIN local_ega.ingestion_checkpoints c ON c.file_id = f.id '
+                        'WHERE f.inbox_path = %(filename)s AND f.elixir_id = %(user_id)s AND f.status = %(status)s '
+                        'ORDER BY f.id DESC LIMIT 1;',
+                        {'filename': filename,
+                         'user_id': user_id,
+                         'status': 'IN_INGESTION'})
+            return cur.fetchone()
+
+
+def set_checkpoint(file_id, header, inbox_filesize, state):
+    """Record the storage ``state`` of the copy to the vault of ``file_id``."""
+    assert file_id, 'Eh? No file_id?'
+    LOG.debug(f'Checkpoint for file_id {file_id}: {state}')
+    with connect() as conn:
+        with conn.cursor() as cur:
+            cur.execute('INSERT INTO local_ega.ingestion_checkpoints (file_id, header, inbox_filesize, state) '
+                        'VALUES (%(file_id)s, %(header)s, %(inbox_filesize)s, %(state)s) '
+                        'ON CONFLICT (file_id) DO UPDATE SET state = EXCLUDED.state, last_modified = clock_timestamp();',
+                        {'file_id': file_id,
+                         'header': header,
+                         'inbox_filesize': inbox_filesize,
+                         'state': json.dumps(state)})
+
+
+def delete_checkpoint(file_id):
+    """Forget the checkpoint of the copy to the vault of ``file_id``."""
+    assert file_id, 'Eh? No file_id?'
+    LOG.debug(f'Deleting the checkpoint for file_id {file_id}')
+    with connect() as conn:
+        with conn.cursor() as cur:
+            cur.execute('DELETE FROM local_ega.ingestion_checkpoints WHERE file_id = %(file_id)s;', {'file_id': file_id})
+
+
+def get_scrub_batch(after_id, limit):
+    """Retrieve up to ``limit`` verified files, with an id greater than ``after_id``, in order.
+
+    Returns the file id, the vault path, the header and the checksum of the original content, with its type.
+    """
+    with connect() as conn:
+        with conn.cursor() as cur:
+            cur.execute('SELECT id, vault_path, header, unencrypted_checksum, unencrypted_checksum_type '
+                        'FROM local_ega.files '
+                        'WHERE id > %(after_id)s AND status IN %(statuses)s AND unencrypted_checksum IS NOT NULL '
+                        'ORDER BY id LIMIT %(limit)s;',
+                        {'after_id': after_id,
+                         'statuses': ('COMPLETED', 'READY'),
+                         'limit': limit})
+            return cur.fetchall()
+
+
+def get_scrub_position(name):
+    """Retrieve the last file id checked by the scrubber ``name``, or 0."""
+    with connect() as conn:
+        with conn.cursor() as cur:
+            cur.execute('SELECT file_id FROM local_ega.scrub_progress WHERE name = %(name)s;', {'name': name})
+            row = cur.fetchone()
+            return row[0] if row else 0
+
+
+def set_scrub_position(name, file_id, completed=False):
+    """Record the last file id checked by the scrubber ``name``.
+
+    A ``completed`` pass starts again from the first file.
+    """
+    with connect() as conn:
+        with conn.cursor() as cur:
+            cur.execute('INSERT INTO local_ega.scrub_progress (name, file_id, passes) '
+                        'VALUES (%(name)s, %(file_id)s, %(passes)s) '
+                        'ON CONFLICT (name) DO UPDATE SET file_id = EXCLUDED.file_id, '
+                        '                                 passes = scrub_progress.passes + EXCLUDED.passes, '
+                        '                                 last_modified = clock_timestamp();',
+                        {'name': name,
+                         'file_id': 0 if completed else file_id,
+                         'passes': int(completed)})
 
 
 ######################################
 #            Decorator               #
 ######################################
-_channel = None
-
 
 def catch_error(func):  # noqa: C901
     """Store the raised exception in the database decorator."""
@@ -264,10 +446,10 @@ def catch_error(func):  # noqa: C901
                     org_msg = data.pop('org_msg', None)  # should be there
                     org_msg['reason'] = str(cause)  # str = Informal
                     LOG.info(f'Sending user error to local broker: {org_msg}')
-                    global _channel
-                    if _channel is None:
-                        _channel = get_connection('broker').channel()
-                    publish(org_msg, _channel, 'cega', 'files.error')
+                    channel = getattr(_local, 'channel', None)
+                    if channel is None:  # pika connections are not thread-safe: one per thread
+                        channel = _local.channel = get_connection('broker').channel()
+                    publish(org_msg, channel, 'cega', 'files.error')
             except Exception as e2:
                 LOG.error(f'While treating "{e}", we caught "{e2!r}"')
                 print(repr(e), 'caused', repr(e2), file=sys.stderr)
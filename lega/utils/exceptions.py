@@ -123,6 +123,23 @@ class KeyserverError(Exception):
 # Any other exception is caught by us
 #############################################################################
 
+class VaultCorruption(Exception):
+    """Raised when an archived file does not have the recorded checksum anymore."""
+
+    def __init__(self, algo, vault_path):
+        """Initialize VaultCorruption Exception."""
+        self.algo = algo
+        self.vault_path = vault_path
+
+    def __str__(self):
+        """Return readable informal exception description."""
+        return 'Corrupted vault file'
+
+    def __repr__(self):
+        """Return the algorithm of the mismatching checksum, with the vault path."""
+        return f'Corrupted vault file: invalid {self.algo} checksum of the original content for {self.vault_path}'
+
+
 class AlreadyProcessed(Warning):
     """Raised when a file has already been processed."""
 
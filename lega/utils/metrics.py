@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+
+"""In-process counters and latency histograms, exposed in the Prometheus text format.
+
+The updates only take a lock and an addition: they can be called from the request handlers.
+"""
+
+import threading
+from bisect import bisect_left
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def _escape(value):
+    return str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+
+def _sample(name, labels, value):
+    """Return the line of a sample."""
+    if labels:
+        name += '{' + ','.join(f'{k}="{_escape(v)}"' for k, v in labels.items()) + '}'
+    return f'{name} {float(value)!r}'
+
+
+class Counter():
+    """Counter, by the values of its ``labels``."""
+
+    kind = 'counter'
+
+    def __init__(self, name, documentation, labels=()):
+        """Initialize the counter, without samples."""
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self.values = {}  # label values -> count
+        self.lock = threading.Lock()
+
+    def inc(self, *label_values, amount=1):
+        """Add ``amount`` to the count for the ``label_values``."""
+        with self.lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def get(self, *label_values):
+        """Return the count for the ``label_values``."""
+        with self.lock:
+            return self.values.get(label_values, 0)
+
+    def samples(self):
+        """Return the samples, as (name, labels, value)."""
+        with self.lock:
+            values = list(self.values.items())
+        return [(self.name, dict(zip(self.labels, label_values)), value) for label_values, value in values]
+
+
+class Gauge():
+    """Value read when collected, from ``function``."""
+
+    kind = 'gauge'
+
+    def __init__(self, name, documentation, function):
+        """Initialize the gauge."""
+        self.name = name
+        self.documentation = documentation
+        self.function = function
+
+    def samples(self):
+        """Return the sample, as (name, labels, value)."""
+        return [(self.name, {}, self.function())]
+
+
+class Histogram():
+    """Distribution of observed values (in seconds, for the latencies), by the values of its ``labels``."""
+
+    kind = 'histogram'
+    BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    def __init__(self, name, documentation, labels=(), buckets=BUCKETS):
+        """Initialize the histogram, without samples."""
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self.buckets = tuple(sorted(buckets))
+        self.values = {}  # label values -> [count per bucket, then above the last one..., sum]
+        self.lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        """Record the ``value`` for the ``label_values``."""
+        with self.lock:
+            counts = self.values.get(label_values)
+            if counts is None:
+                counts = self.values[label_values] = [0] * (len(self.buckets) + 1) + [0.0]
+            counts[bisect_left(self.buckets, value)] += 1
+            counts[-1] += value
+
+    def samples(self):
+        """Return the samples, as (name, labels, value): the cumulative buckets, the sum and the count."""
+        with self.lock:
+            values = [(label_values, list(counts)) for label_values, counts in self.values.items()]
+        samples = []
+        for label_values, counts in values:
+            labels = dict(zip(self.labels, label_values))
+            total = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                total += count
+                samples.append((self.name + '_bucket', dict(labels, le=str(bound)), total))
+            samples.append((self.name + '_sum', labels, counts[-1]))
+            samples.append((self.name + '_count', labels, total))
+        return samples
+
+
+class Registry():
+    """Collection of metrics, with ``constant_labels`` added to all the samples."""
+
+    def __init__(self):
+        """Initialize the registry, without metrics."""
+        self.metrics = []
+        self.constant_labels = {}
+
+    def register(self, metric):
+        """Add the ``metric``, and return it."""
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        """Return all the samples, in the Prometheus text format."""
+        lines = []
+        for metric in self.metrics:
+            lines.append(f'# HELP {metric.name} {metric.documentation}')
+            lines.append(f'# TYPE {metric.name} {metric.kind}')
+            for name, labels, value in metric.samples():
+                lines.append(_sample(name, dict(self.constant_labels, **labels), value))
+        return '\n'.join(lines) + '\n'
@@ -0,0 +1,194 @@
+# -*- coding: utf-8 -*-
+
+"""Fair dispatch of the messages between users, and bandwidth limits."""
+
+import logging
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from time import monotonic, sleep
+
+LOG = logging.getLogger(__name__)
+
+
+class FairQueue():
+    """Queue dispatching its items fairly between keys (weighted fair queueing).
+
+    Each key gets a share of the dispatches proportional to its weight.
+    A key with a single item, arriving while another one has many, does
+    not wait behind them: it starts at the current virtual time.
+    """
+
+    def __init__(self, weights=None, default_weight=1):
+        """Initialize the queue, with the ``weights`` per key."""
+        self.lock = threading.Lock()
+        self.queues = {}  # key -> deque of items
+        self.finish = {}  # key -> virtual time at which its last dispatched item finished
+        self.vtime = 0
+        self.weights = weights or {}
+        self.default_weight = default_weight
+
+    def __len__(self):
+        """Return the number of items waiting."""
+        with self.lock:
+            return sum(len(q) for q in self.queues.values())
+
+    def put(self, key, item):
+        """Add an ``item`` for ``key``."""
+        with self.lock:
+            self.queues.setdefault(key, deque()).append(item)
+
+    def get(self):
+        """Remove and return the next item, from the key that was served the least, relatively to its weight."""
+        with self.lock:
+            if not self.queues:
+                raise IndexError('get from an empty queue')
+            key = min(self.queues, key=lambda k: max(self.finish.get(k, 0), self.vtime))
+            start = max(self.finish.get(key, 0), self.vtime)
+            self.vtime = start
+            self.finish[key] = start + 1 / self.weights.get(key, self.default_weight)
+            queue = self.queues[key]
+            item = queue.popleft()
+            if not queue:
+                del self.queues[key]
+            # Forget the idle keys that are not ahead anymore
+            for k in [k for k, f in self.finish.items() if f <= self.vtime and k not in self.queues]:
+                del self.finish[k]
+            LOG.debug(f'Dispatching an item for {key} (virtual time: {self.vtime})')
+            return item
+
+    def clear(self):
+        """Remove all the waiting items, and return how many there were."""
+        with self.lock:
+            count = sum(len(q) for q in self.queues.values())
+            self.queues.clear()
+            return count
+
+
+class FairExecutor():
+    """Thread pool running the submitted calls in a fair order between keys, rather than in the submission order.
+
+    ``key`` is called with the first argument of each call.
+    """
+
+    def __init__(self, max_workers, key, weights=None, thread_name_prefix=''):
+        """Initialize the pool of ``max_workers`` threads, and the queue with the ``weights`` per key."""
+        self.pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=thread_name_prefix)
+        self.queue = FairQueue(weights)
+        self.key = key
+
+    def _run_next(self):
+        try:
+            fn, args = self.queue.get()
+        except IndexError:  # cleared by shutdown
+            return None
+        return fn(*args)
+
+    def submit(self, fn, *args):
+        """Schedule ``fn(*args)``.
+
+        Each submission runs the next call from the queue: not necessarily this one.
+        """
+        self.queue.put(self.key(args[0]), (fn, args))
+        return self.pool.submit(self._run_next)
+
+    def shutdown(self, wait=True):
+        """Shut the pool down.
+
+        The calls not started yet are dropped: only the running ones are waited for.
+        """
+        dropped = self.queue.clear()
+        if dropped:
+            LOG.info(f'Dropping {dropped} calls not started yet')
+        self.pool.shutdown(wait=wait)
+
+
+def parse_weights(value):
+    """Parse weights, given as ``key:weight`` pairs separated by commas."""
+    weights = {}
+    for pair in (value or '').split(','):
+        if not pair.strip():
+            continue
+        key, weight = pair.rsplit(':', 1)
+        weights[key.strip()] = float(weight)
+    return weights
+
+
+class TokenBucket():
+    """Byte-rate limit, with bursts of up to one second of traffic."""
+
+    def __init__(self, rate):
+        """Initialize the bucket for ``rate`` bytes per second."""
+        self.rate = rate
+        self.tokens = rate
+        self.last = monotonic()
+        self.lock = threading.Lock()
+
+    def consume(self, n):
+        """Take ``n`` bytes, sleeping if they exceed the rate."""
+        with self.lock:
+            now = monotonic()
+            self.tokens = min(self.rate, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            self.tokens -= n
+            delay = -self.tokens / self.rate if self.tokens < 0 else 0
+        if delay:
+            sleep(delay)
+
+
+class _ThrottledReader():
+    """File object reader, not faster than all its token buckets."""
+
+    def __init__(self, fileobj, buckets):
+        """Wrap ``fileobj``."""
+        self.fileobj = fileobj
+        self.buckets = buckets
+
+    def _throttle(self, n):
+        for bucket in self.buckets:
+            bucket.consume(n)
+
+    def read(self, size=-1):
+        """Read and throttle."""
+        data = self.fileobj.read(size)
+        self._throttle(len(data))
+        return data
+
+    def readinto(self, b):
+        """Read into ``b`` and throttle."""
+        n = self.fileobj.readinto(b)
+        if n:
+            self._throttle(n)
+        return n
+
+
+class Throttle():
+    """Byte-rate limits per user and per worker thread.
+
+    A rate of 0 is unlimited.
+    The users' buckets are shared between the worker threads.
+    """
+
+    def __init__(self, user_rate=0, worker_rate=0):
+        """Initialize the limits, in bytes per second."""
+        self.user_rate = user_rate
+        self.worker_rate = worker_rate
+        self.users = {}
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    def _buckets(self, user):
+        buckets = []
+        if self.user_rate:
+            with self.lock:
+                buckets.append(self.users.setdefault(user, TokenBucket(self.user_rate)))
+        if self.worker_rate:
+            if getattr(self.local, 'bucket', None) is None:
+                self.local.bucket = TokenBucket(self.worker_rate)
+            buckets.append(self.local.bucket)
+        return buckets
+
+    def wrap(self, fileobj, user):
+        """Return a reader of ``fileobj`` within the limits for ``user``, or ``fileobj`` itself if unlimited."""
+        buckets = self._buckets(user)
+        return _ThrottledReader(fileobj, buckets) if buckets else fileobj
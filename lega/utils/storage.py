@@ -3,10 +3,16 @@
 """File I/O for disk or S3 Object storage."""
 
 import os
+import mmap
+import errno
+import fcntl
 import logging
+from collections import deque
 from contextlib import contextmanager
-import shutil
 from pathlib import Path
+from threading import BoundedSemaphore, Event
+from concurrent.futures import ThreadPoolExecutor
+from time import sleep
 
 from ..conf import CONF
 import io
@@ -14,12 +20,248 @@ import io
 LOG = logging.getLogger(__name__)
 
 
+_ALIGN = 4096  # for direct I/O: alignment of the buffers, offsets and lengths
+_MAX_PARTS = 10000  # in an S3 multipart upload
+
+
+class _Checkpoints():
+    """Flush the copied bytes to disk, and record the progress, every ``interval`` bytes.
+
+    With ``drop_cache``, the flushed bytes are also evicted from the page cache.
+    """
+
+    def __init__(self, h, start, checkpoint, interval, drop_cache=False):
+        """Start counting at ``start`` bytes, already in ``h``."""
+        self.h = h
+        self.written = self.saved = start
+        self.checkpoint = checkpoint
+        self.interval = interval
+        self.drop_cache = drop_cache
+
+    def update(self, n):
+        """Count ``n`` more bytes written to ``h``."""
+        self.written += n
+        if (self.checkpoint is None and not self.drop_cache) or self.written - self.saved < self.interval:
+            return
+        self.h.flush()
+        os.fsync(self.h.fileno())  # the checkpoint must not be ahead of the disk
+        if self.drop_cache:  # the pages are clean now, so they can be dropped
+            os.posix_fadvise(self.h.fileno(), self.saved, self.written - self.saved, os.POSIX_FADV_DONTNEED)
+        if self.checkpoint is not None:
+            self.checkpoint({'size': self.written})
+        self.saved = self.written
+
+    def finish(self):
+        """Evict the rest of the file from the page cache, if required."""
+        if self.drop_cache:
+            self.h.flush()
+            os.fdatasync(self.h.fileno())
+            os.posix_fadvise(self.h.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+
+
+def _kernel_copy(fileobj, h, progress):
+    """Copy the rest of ``fileobj``, from its current position, to ``h``, within the kernel.
+
+    Uses ``copy_file_range``, or ``sendfile``, when available.
+    Returns the number of bytes copied, or None if the kernel refused to copy.
+    """
+    src, dst = fileobj.fileno(), h.fileno()
+    offset = fileobj.tell()  # includes what the reader buffered, ie after the header
+    remaining = os.fstat(src).st_size - offset
+    copied = 0
+    copy_file_range = getattr(os, 'copy_file_range', None)  # python 3.8+
+    while remaining > 0:
+        try:
+            if copy_file_range is not None:
+                n = copy_file_range(src, dst, min(remaining, progress.interval), offset_src=offset)
+            else:
+                n = os.sendfile(dst, src, offset, min(remaining, progress.interval))
+        except OSError as e:
+            if copied == 0 and copy_file_range is not None:  # cross-device or unsupported: try sendfile
+                LOG.debug(f'copy_file_range failed: {e!r}')
+                copy_file_range = None
+                continue
+            if copied == 0:
+                LOG.debug(f'sendfile failed: {e!r}')
+                return None
+            raise
+        if n == 0:  # EOF
+            break
+        offset += n
+        remaining -= n
+        copied += n
+        progress.update(n)
+    fileobj.seek(offset)
+    return copied
+
+
+def _buffered_copy(fileobj, h, bufsize, progress):
+    """Copy ``fileobj`` to ``h``, reusing the same buffer for all the chunks."""
+    if not hasattr(fileobj, 'readinto'):
+        while True:
+            data = fileobj.read(bufsize)
+            if not data:
+                return
+            h.write(data)
+            progress.update(len(data))
+
+    buf = bytearray(bufsize)
+    view = memoryview(buf)
+    while True:
+        n = fileobj.readinto(view)
+        if not n:
+            return
+        h.write(view[:n])
+        progress.update(n)
+
+
+def _write_all(h, view, start, end):
+    """Write the whole ``view[start:end]`` to the unbuffered ``h``, whose writes can be short."""
+    while start < end:
+        with view[start:end] as chunk:  # released, even on errors, so that the buffer can be closed
+            n = h.write(chunk)
+        if not n:
+            raise OSError(f'Could not write to {h.name}: {end - start} bytes left')
+        start += n
+
+
+def _direct_copy(fileobj, h, bufsize, progress):
+    """Copy ``fileobj`` to ``h``, opened with ``O_DIRECT``, through an aligned buffer.
+
+    The last block, if partial, is written once ``O_DIRECT`` is turned off.
+    """
+    buf = mmap.mmap(-1, bufsize)  # anonymous mappings are page-aligned
+    view = memoryview(buf)
+    try:
+        filled = 0
+        while True:
+            n = fileobj.readinto(view[filled:])
+            filled += n or 0
+            if filled < bufsize and n:
+                continue
+            aligned = filled - filled % _ALIGN
+            if aligned:
+                _write_all(h, view, 0, aligned)
+            if aligned < filled:
+                _set_direct(h.fileno(), False)
+                _write_all(h, view, aligned, filled)
+            progress.update(filled)
+            if not n:
+                return
+            filled = 0
+    finally:
+        view.release()
+        buf.close()
+
+
+def _set_direct(fd, on):
+    """Turn ``O_DIRECT`` on or off, for the file descriptor ``fd``."""
+    flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+    fcntl.fcntl(fd, fcntl.F_SETFL, (flags | os.O_DIRECT) if on else (flags & ~os.O_DIRECT))
+
+
+class MappedFile():
+    """Read-only file, memory-mapped: ``read`` returns memoryview slices of the mapping, instead of new bytes objects.
+
+    The kernel is told that the file is read sequentially, so it reads ahead aggressively.
+    The slices are only valid while the file is open.
+    """
+
+    def __init__(self, path):
+        """Map the file at ``path``."""
+        with open(path, 'rb') as f:
+            self.size = os.fstat(f.fileno()).st_size
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if self.size else None  # empty files can't be mapped
+        if self.mm is not None and hasattr(self.mm, 'madvise'):  # python 3.8+
+            self.mm.madvise(mmap.MADV_SEQUENTIAL)
+        self.view = memoryview(self.mm if self.mm is not None else b'')
+        self.path = path
+        self.loc = 0
+        self.closed = False
+
+    def read(self, size=-1):
+        """Return a slice of up to ``size`` bytes, from the current position."""
+        if self.closed:
+            raise ValueError('I/O operation on closed file.')
+        end = self.size if size is None or size < 0 else min(self.loc + size, self.size)
+        out = self.view[self.loc:end]
+        self.loc = max(self.loc, end)
+        return out
+
+    read1 = read
+
+    def readinto(self, b):
+        """Copy up to ``len(b)`` bytes into ``b``, and return their number."""
+        data = self.read(len(b))
+        memoryview(b).cast('B')[:len(data)] = data
+        return len(data)
+
+    def seek(self, loc, whence=0):
+        """Change position to the given byte offset."""
+        if whence not in (0, 1, 2):
+            raise ValueError("invalid whence (%s, should be 0, 1 or 2)" % whence)
+        nloc = (0, self.loc, self.size)[whence] + loc
+        if nloc < 0:
+            raise ValueError('Seek before start of file')
+        self.loc = nloc
+        return self.loc
+
+    def tell(self):
+        """Return position."""
+        return self.loc
+
+    def readable(self):
+        """Return True: the file can be read."""
+        return True
+
+    def seekable(self):
+        """Return True: the file supports seek."""
+        return True
+
+    def close(self):
+        """Unmap the file, unless some slices are still in use: it is then unmapped when they are released."""
+        if self.closed:
+            return
+        self.closed = True
+        self.view.release()
+        if self.mm is not None:
+            try:
+                self.mm.close()
+            except BufferError:
+                LOG.debug(f'Slices of {self.path} still in use: unmapped later')
+            self.mm = None
+
+    def __enter__(self):
+        """Set things."""
+        return self
+
+    def __exit__(self, *args):
+        """Unmap the file."""
+        self.close()
+
+    def __str__(self):
+        """Return string representation."""
+        return f"<MappedFile {self.path}>"
+
+    __repr__ = __str__
+
+
 class FileStorage():
     """Storage on disk and related I/O."""
 
     def __init__(self, config_section, user):
         """Initialize backend storage to a POSIX file system."""
         self.prefix = Path(CONF.get_value(config_section, 'location', raw=True) % user)
+        self.zero_copy = CONF.get_value(config_section, 'zero_copy', conv=bool, default=False)
+        self.bufsize = CONF.get_value(config_section, 'copy_buffer_size', conv=int, default=1 << 22)  # 4 MB
+        self.checkpoint_interval = CONF.get_value(config_section, 'checkpoint_interval', conv=int, default=1 << 26)  # 64 MB
+        self.preallocate = CONF.get_value(config_section, 'preallocate', conv=bool, default=False)
+        self.write_mode = CONF.get_value(config_section, 'write_mode', default='buffered')
+        if self.write_mode not in ('buffered', 'dontneed', 'direct'):
+            raise ValueError(f'Unknown write mode: {self.write_mode}')
+        if self.write_mode == 'direct':
+            self.bufsize += -self.bufsize % _ALIGN
+        self.mmap_reads = CONF.get_value(config_section, 'mmap_reads', conv=bool, default=False)
 
     def location(self, file_id):
         """Retrieve file location."""
@@ -29,17 +271,93 @@ class FileStorage():
         target.parent.mkdir(parents=True, exist_ok=True)
         return str(target)
 
-    def copy(self, fileobj, location):
-        """Copy file object at a specific location."""
-        with open(location, 'wb') as h:
-            shutil.copyfileobj(fileobj, h)
-        return os.stat(location).st_size
+    def _open(self, location, start):
+        """Open ``location`` for writing at ``start``, and return the file object and whether it uses direct I/O."""
+        mode = 'r+b' if start else 'wb'
+        if self.write_mode == 'direct' and start % _ALIGN == 0:
+            try:
+                fd = os.open(location, os.O_WRONLY | os.O_CREAT | os.O_DIRECT | (0 if start else os.O_TRUNC), 0o666)
+                return open(fd, 'wb', buffering=0), True  # unbuffered: the writes go straight to the file descriptor
+            except (OSError, AttributeError) as e:  # not supported by that file system, or that OS
+                LOG.warning(f'Direct I/O not possible ({e!r}): falling back to buffered writes')
+        return open(location, mode), False
+
+    def _preallocate(self, h, start, size):
+        """Reserve the disk blocks of the rest of the file, known to be ``size`` bytes in total."""
+        if not self.preallocate or not size or size <= start:
+            return False
+        try:
+            os.posix_fallocate(h.fileno(), start, size - start)
+            return True
+        except OSError as e:  # not supported by that file system
+            LOG.debug(f'Preallocation not possible: {e!r}')
+            return False
+
+    def _copy(self, fileobj, h, direct, progress):
+        """Copy ``fileobj`` to ``h``, and return the number of bytes copied by the kernel, or None."""
+        if direct and hasattr(fileobj, 'readinto'):
+            return _direct_copy(fileobj, h, self.bufsize, progress)
+        if direct:
+            _set_direct(h.fileno(), False)
+        elif self.zero_copy and hasattr(fileobj, 'fileno'):
+            copied = _kernel_copy(fileobj, h, progress)
+            if copied is not None:
+                return copied
+            LOG.warning('Zero-copy not possible: falling back to buffered copy')
+        return _buffered_copy(fileobj, h, self.bufsize, progress)
+
+    def copy(self, fileobj, location, resume=None, checkpoint=None, size=None):
+        """Copy file object at a specific location, and return the size of the file.
+
+        In zero-copy mode, if ``fileobj`` is a regular file, the bytes are copied by the kernel.
+
+        The ``write_mode`` can be ``buffered`` (through the page cache), ``dontneed``
+        (evicting what is written from the page cache) or ``direct`` (bypassing it).
+        If ``preallocate`` is on, and the final ``size`` is given, the disk space is reserved upfront.
+
+        Every ``checkpoint_interval`` bytes, once they are on disk, ``checkpoint`` is called with the current state.
+        Given such a state as ``resume``, the copy continues at the end of the partial file,
+        and ``fileobj`` must be positioned after the bytes already copied.
+        """
+        start = resume['size'] if resume else 0
+        h, direct = self._open(location, start)
+        with h:
+            if resume:
+                LOG.info(f'Resuming the copy to {location} after {start} bytes')
+                h.truncate(start)  # drop what was written after the checkpoint
+                h.seek(start)
+            preallocated = self._preallocate(h, start, size)
+            progress = _Checkpoints(h, start, checkpoint, self.checkpoint_interval, drop_cache=self.write_mode != 'buffered')
+            copied = self._copy(fileobj, h, direct, progress)
+            total = h.tell() if copied is None else start + copied
+            if preallocated and total != size:  # wrong size hint: cut the extra preallocated space
+                h.truncate(total)
+            progress.finish()
+            return total
+
+    def resumable(self, location, state):
+        """Return whether a copy to ``location`` can be resumed from the checkpointed ``state``."""
+        try:
+            return os.stat(location).st_size >= state['size']
+        except (OSError, KeyError, TypeError) as e:
+            LOG.debug(f'Can not resume the copy to {location}: {e!r}')
+            return False
+
+    def abandon(self, location, state=None):
+        """Remove the file of an abandoned copy to ``location``."""
+        try:
+            os.unlink(location)
+        except FileNotFoundError:
+            pass
 
     @contextmanager
     def open(self, path, mode='rb'):
-        """Open stored file."""
+        """Open stored file.
+
+        With ``mmap_reads``, the files opened in ``rb`` mode are memory-mapped (see :class:`MappedFile`).
+        """
         fp = self.prefix / path.lstrip('/')
-        f = open(fp, mode)
+        f = MappedFile(fp) if mode == 'rb' and self.mmap_reads else open(fp, mode)
         yield f
         f.close()
 
@@ -57,9 +375,13 @@ class S3FileReader(object):
     """Implements a few of the BufferedIOBase methods.
 
     see https://docs.python.org/3/library/io.html#io.BufferedIOBase
+
+    With ``readahead``, the object is fetched by blocks of ``blocksize`` bytes,
+    and the next ``readahead`` blocks are fetched in background threads,
+    while the current one is read. They are cancelled when seeking elsewhere, or closing.
     """
 
-    def __init__(self, s3, bucket, path, mode='rb', blocksize=1 << 22):  # 1<<22 = 4194304 = 4MB
+    def __init__(self, s3, bucket, path, mode='rb', blocksize=1 << 22, readahead=0):  # 1<<22 = 4194304 = 4MB
         """Initialize class."""
         if mode != 'rb':  # if mode not in ('rb', 'wb', 'ab'):
             raise NotImplementedError(f"File mode '{mode}' not supported")
@@ -71,14 +393,18 @@ class S3FileReader(object):
         self.end = None
         self.closed = False
         self.bucket = bucket
-        self.info = s3.head_object(Bucket=bucket, Key=path)
+        try:
+            self.info = s3.head_object(Bucket=bucket, Key=path)
+        except Exception as e:
+            self.closed = True  # nothing to close
+            _raise_missing(e, bucket, path)
+            raise
         self.size = self.info['ContentLength']
-        # self.buffer = io.BytesIO() # cache
-        # self.blocksize = blocksize
-        # # If file is less than 5MB, read it all in the buffer
-        # if self.size < blocksize:
-        #     # existing file too small for multi-upload: download
-        #     self.buffer.write(self.read())
+        self.blocksize = blocksize
+        self.readahead = readahead
+        self.pool = None  # created on first read
+        self.blocks = deque()  # (index, future) of the blocks being fetched, in order
+        self.current = None  # (index, data) of the block being read
 
     def tell(self):
         """Return position."""
@@ -96,6 +422,10 @@ class S3FileReader(object):
             raise ValueError("invalid whence (%s, should be 0, 1 or 2)" % whence)
         if nloc < 0:
             raise ValueError('Seek before start of file')
+        if self.blocks:
+            first = self.current[0] if self.current is not None else self.blocks[0][0]
+            if not (first <= nloc // self.blocksize <= self.blocks[-1][0]):
+                self._cancel()  # not reading the blocks ahead anymore
         self.loc = nloc
         return self.loc
 
@@ -111,15 +441,71 @@ class S3FileReader(object):
             length = self.size - self.loc
 
         end = min(self.loc + length, self.size)  # in case it's too much
-        out = self._fetch(self.loc, end)
+        out = self._read_blocks(self.loc, end) if self.readahead else self._fetch(self.loc, end)
         self.loc += len(out)
         return out
 
+    def _read_blocks(self, start, end):
+        """Read from the blocks fetched ahead."""
+        pieces = []
+        while start < end:
+            index = start // self.blocksize
+            offset = index * self.blocksize
+            piece = memoryview(self._block(index))[start - offset:end - offset]
+            if not piece:  # shorter than expected
+                break
+            pieces.append(piece)
+            start += len(piece)
+        return b''.join(pieces)
+
+    def _readinto_blocks(self, start, view):
+        """Copy into ``view`` from the blocks fetched ahead."""
+        n = 0
+        while n < len(view):
+            index = (start + n) // self.blocksize
+            piece = memoryview(self._block(index))[start + n - index * self.blocksize:][:len(view) - n]
+            if not piece:  # shorter than expected
+                break
+            view[n:n + len(piece)] = piece
+            n += len(piece)
+        return n
+
+    def _block(self, index):
+        """Return the block ``index``, and fetch the following ones in the background."""
+        if self.current is not None and self.current[0] == index:
+            return self.current[1]
+        while self.blocks and self.blocks[0][0] != index:  # skipped, or after a seek backwards
+            self.blocks.popleft()[1].cancel()
+        self._schedule(index)
+        _, future = self.blocks.popleft()
+        self.current = (index, future.result())
+        self._schedule(index + 1)
+        return self.current[1]
+
+    def _schedule(self, index):
+        """Fetch, in the background, the ``readahead`` blocks from ``index`` on."""
+        if self.pool is None:
+            self.pool = ThreadPoolExecutor(max_workers=self.readahead, thread_name_prefix='s3-read')
+        last = min(index + self.readahead, -(-self.size // self.blocksize))
+        following = self.blocks[-1][0] + 1 if self.blocks else index
+        for i in range(following, last):
+            start = i * self.blocksize
+            self.blocks.append((i, self.pool.submit(self._fetch, start, min(start + self.blocksize, self.size))))
+
+    def _cancel(self):
+        """Cancel the blocks fetched ahead (those already being downloaded are discarded)."""
+        while self.blocks:
+            self.blocks.popleft()[1].cancel()
+
     def close(self):
         """Close object reader."""
         if self.closed:
             return
         self.closed = True
+        self._cancel()
+        self.current = None
+        if self.pool is not None:
+            self.pool.shutdown(wait=False)
 
     def __del__(self):
         """Prepare for object destruction."""
@@ -145,16 +531,35 @@ class S3FileReader(object):
         """Read and return up to size bytes, with at most one call to the underlying raw stream’s read()."""
         return self.read(length)
 
+    def readable(self):
+        """Return True: the object can be read."""
+        return True
+
+    def seekable(self):
+        """Return True: the reader supports seek."""
+        return True
+
     def detach(self):
         """Raise unssuported operation."""
         raise io.UnsupportedOperation()
 
     def readinto(self, b):
-        """Read bytes into a pre-allocated object b and return the number of bytes read."""
-        datalen = len(b)
-        data = self.read(datalen)
-        b[:datalen] = data
-        return datalen
+        """Read bytes into a pre-allocated object b and return the number of bytes read.
+
+        The object content is written directly into ``b``, without intermediate bytes objects.
+        """
+        if self.closed:
+            raise ValueError('I/O operation on closed file.')
+        length = min(len(b), self.size - self.loc)
+        if length <= 0:
+            return 0
+        view = memoryview(b).cast('B')[:length]
+        if self.readahead:
+            n = self._readinto_blocks(self.loc, view)
+        else:
+            n = self._fetch_into(self.loc, view)
+        self.loc += n
+        return n
 
     def readinto1(self, b):
         """Read bytes into an object."""
@@ -180,12 +585,97 @@ class S3FileReader(object):
             #         raise
             except Exception as e:
                 LOG.debug('Exception %e', e, exc_info=True)
+                _raise_missing(e, self.bucket, self.path)
+                if 'time' in str(e).lower():  # Actual exception type changes often
+                    continue
+                raise
+        raise RuntimeError("Max number of S3 retries exceeded")
+
+    def _fetch_into(self, start, view, max_attempts=10):
+        """Read object from S3, streaming the response body into ``view``."""
+        for i in range(max_attempts):
+            try:
+                resp = self.s3.get_object(Bucket=self.bucket, Key=self.path, Range='bytes=%i-%i' % (start, start + len(view) - 1))
+                return _readinto(resp['Body'], view)
+            except Exception as e:
+                LOG.debug('Exception %e', e, exc_info=True)
+                _raise_missing(e, self.bucket, self.path)
                 if 'time' in str(e).lower():  # Actual exception type changes often
                     continue
                 raise
         raise RuntimeError("Max number of S3 retries exceeded")
 
 
+def _raise_missing(error, bucket, path):
+    """Raise FileNotFoundError, as for a missing file on disk, if the S3 ``error`` is about a missing object."""
+    code = getattr(error, 'response', {}).get('Error', {}).get('Code')
+    if code in ('404', 'NoSuchKey', 'NotFound'):  # 404 for head_object, without a body to carry the code
+        raise FileNotFoundError(errno.ENOENT, 'No such object', f'{bucket}/{path}') from error
+
+
+def _readinto(body, view):
+    """Fill ``view`` from the response ``body``, and return the number of bytes read."""
+    if not hasattr(body, 'readinto'):  # older botocore
+        data = body.read(len(view))
+        view[:len(data)] = data
+        return len(data)
+    n = 0
+    while n < len(view):
+        k = body.readinto(view[n:])
+        if not k:
+            break
+        n += k
+    return n
+
+
+class _UploadProgress():
+    """Parts of a multipart upload, checkpointed when a contiguous run of them is uploaded."""
+
+    def __init__(self, upload_id, part_size, parts, size, checkpoint):
+        """Start after the ``parts`` already uploaded, holding ``size`` bytes."""
+        self.upload_id = upload_id
+        self.part_size = part_size
+        self.parts = parts
+        self.size = self.read = size
+        self.pending = []  # (future, length), in part order
+        self.checkpoint = checkpoint
+
+    def next_part(self):
+        """Return the number of the next part."""
+        return len(self.parts) + len(self.pending) + 1
+
+    def add(self, future, length):
+        """Add the upload of a part of ``length`` bytes."""
+        self.pending.append((future, length))
+        self.read += length
+
+    def advance(self):
+        """Move the uploaded parts out of the pending ones, and checkpoint if there were any."""
+        count = 0
+        while self.pending and self.pending[0][0].done() and not self.pending[0][0].exception():
+            future, length = self.pending.pop(0)
+            self.parts.append(future.result())
+            self.size += length
+            count += 1
+        if count:
+            self.save()
+
+    def finish(self):
+        """Wait for the pending parts."""
+        while self.pending:
+            future, length = self.pending.pop(0)
+            self.parts.append(future.result())
+            self.size += length
+
+    def save(self):
+        """Call the checkpoint with the uploaded parts."""
+        if self.checkpoint is not None:
+            self.checkpoint({'upload_id': self.upload_id,
+                             'part_size': self.part_size,
+                             'parts': list(self.parts),
+                             'size': self.size})
+
+
 class S3Storage():
     """S3 object storage and related I/O."""
 
@@ -211,21 +701,117 @@ class S3Storage():
         except self.s3.exceptions.BucketAlreadyOwnedByYou as e:
             LOG.debug(f'Ignoring ({type(e)}): {e}')
         # No need to close anymore?
+        # Multipart uploads
+        self.part_size = CONF.get_value(config_section, 'part_size', conv=int, default=1 << 23)  # 8 MB, at least 5 MB for S3
+        self.concurrency = CONF.get_value(config_section, 'upload_concurrency', conv=int, default=4)
+        self.retries = CONF.get_value(config_section, 'upload_retries', conv=int, default=3)
+        # Reads: blocks fetched ahead, in the background
+        self.read_blocksize = CONF.get_value(config_section, 'read_blocksize', conv=int, default=1 << 22)  # 4 MB
+        self.readahead = CONF.get_value(config_section, 'readahead', conv=int, default=4)
 
     def location(self, file_id):
         """Retrieve object location."""
         return str(file_id)
 
-    def copy(self, fileobj, location):
-        """Copy file object in a bucket."""
-        self.s3.upload_fileobj(fileobj, self.bucket, location)
-        resp = self.s3.head_object(Bucket=self.bucket, Key=location)
-        return resp['ContentLength']
+    def _upload_part(self, location, upload_id, part_number, data):
+        """Upload one part, retrying ``self.retries`` times."""
+        backoff = 1
+        for attempt in range(self.retries + 1):
+            try:
+                resp = self.s3.upload_part(Bucket=self.bucket, Key=location, UploadId=upload_id,
+                                           PartNumber=part_number, Body=data)
+                return {'PartNumber': part_number, 'ETag': resp['ETag']}
+            except Exception as e:
+                if attempt == self.retries:
+                    raise
+                LOG.debug(f'Uploading part {part_number} of {location} failed ({e!r}), retrying in {backoff} seconds')
+                sleep(backoff)
+                backoff *= 2
+
+    def _upload_parts(self, fileobj, location, data, progress):
+        """Upload ``data`` and the rest of ``fileobj`` as parts, in parallel."""
+        in_flight = BoundedSemaphore(self.concurrency)  # bounds the memory: at most concurrency parts
+        failed = Event()
+
+        def uploaded(future):
+            if future.exception():
+                failed.set()
+            else:
+                LOG.debug(f'Uploaded part {future.result()["PartNumber"]} of {location}')
+            in_flight.release()
+
+        with ThreadPoolExecutor(max_workers=self.concurrency) as pool:
+            while data:
+                in_flight.acquire()
+                if failed.is_set():  # no need to read further
+                    break
+                part_number = progress.next_part()
+                future = pool.submit(self._upload_part, location, progress.upload_id, part_number, data)
+                future.add_done_callback(uploaded)
+                progress.add(future, len(data))
+                LOG.debug(f'Progress for {location}: {progress.read} bytes read, {part_number} part(s)')
+                progress.advance()
+                data = fileobj.read(progress.part_size)
+        progress.finish()  # raises the first error
+
+    def copy(self, fileobj, location, resume=None, checkpoint=None, size=None):
+        """Copy file object in a bucket, and return the size of the object.
+
+        The file object is read sequentially, in parts of ``part_size`` bytes,
+        and up to ``upload_concurrency`` parts are uploaded in parallel.
+        A file smaller than a part is uploaded in one request.
+        If the ``size`` of the file is given, the parts are made large enough to stay within the S3 limit on the number of parts.
+
+        Each time more parts are in the bucket, ``checkpoint`` is called with the upload id and the uploaded parts.
+        Given such a state as ``resume``, the multipart upload continues after the uploaded parts,
+        and ``fileobj`` must be positioned after the bytes they contain.
+        """
+        part_size = resume['part_size'] if resume else max(self.part_size, -(-(size or 0) // _MAX_PARTS))
+        data = fileobj.read(part_size)
+        if resume is None and len(data) < part_size:  # small file
+            self.s3.put_object(Bucket=self.bucket, Key=location, Body=data)
+            return len(data)
+
+        if resume:
+            LOG.info(f'Resuming the multipart upload of {location} (upload id: {resume["upload_id"]})')
+            progress = _UploadProgress(resume['upload_id'], part_size, list(resume['parts']), resume['size'], checkpoint)
+        else:
+            upload_id = self.s3.create_multipart_upload(Bucket=self.bucket, Key=location)['UploadId']
+            LOG.debug(f'Multipart upload of {location} (upload id: {upload_id})')
+            progress = _UploadProgress(upload_id, part_size, [], 0, checkpoint)
+            progress.save()  # so that the upload can be found again
+        try:
+            self._upload_parts(fileobj, location, data, progress)
+            self.s3.complete_multipart_upload(Bucket=self.bucket, Key=location, UploadId=progress.upload_id,
+                                              MultipartUpload={'Parts': progress.parts})
+        except Exception:
+            LOG.error(f'Aborting the multipart upload of {location}')
+            self.s3.abort_multipart_upload(Bucket=self.bucket, Key=location, UploadId=progress.upload_id)
+            raise
+        return progress.size
+
+    def resumable(self, location, state):
+        """Return whether an upload to ``location`` can be resumed from the checkpointed ``state``."""
+        try:
+            self.s3.list_parts(Bucket=self.bucket, Key=location, UploadId=state['upload_id'])
+            return True
+        except Exception as e:  # the upload was completed or aborted
+            LOG.debug(f'Can not resume the upload to {location}: {e!r}')
+            return False
+
+    def abandon(self, location, state=None):
+        """Abort the multipart upload of an abandoned copy to ``location``, from its checkpointed ``state``, and remove the object."""
+        if state:
+            try:
+                self.s3.abort_multipart_upload(Bucket=self.bucket, Key=location, UploadId=state['upload_id'])
+            except Exception as e:  # already completed or aborted
+                LOG.debug(f'Can not abort the upload to {location}: {e!r}')
+        self.s3.delete_object(Bucket=self.bucket, Key=location)
 
     @contextmanager
     def open(self, path, mode='rb'):
         """Open stored object."""
-        f = S3FileReader(self.s3, self.bucket, path, mode=mode)
+        f = S3FileReader(self.s3, self.bucket, path, mode=mode, blocksize=self.read_blocksize, readahead=self.readahead)
         yield f
         f.close()
 
@@ -13,64 +13,193 @@ with the routing key: ``completed``.
 
 import sys
 import os
+import json
 import logging
 from functools import partial
-from urllib.request import urlopen
-from urllib.error import HTTPError
-import hashlib
+from http.client import HTTPException
+from time import monotonic
+from urllib.parse import urlsplit
 
-from legacryptor.crypt4gh import get_key_id, header_to_records, body_decrypt
+from legacryptor.crypt4gh import get_key_id
+from legacryptor import exceptions as crypt_exc
 
 from .conf import CONF
 from .utils import db, exceptions, storage
+from .utils.checksum import Digests
+from .utils.connections import ConnectionPool
+from .utils.crypt4gh import Record, UnlockedKeys, decrypt_header, body_decrypt
 from .utils.amqp import consume, get_connection
 
 LOG = logging.getLogger(__name__)
 
 
+_keys = None  # unlocked keys, created on first use (CONF must be set up)
+
+
+def _unlocked_keys():
+    """Return the cache of unlocked keys."""
+    global _keys
+    if _keys is None:
+        ttl = CONF.get_value('quality_control', 'key_cache_ttl', conv=int, default=3600)
+        _keys = UnlockedKeys(max_size=CONF.get_value('quality_control', 'key_cache_size', conv=int, default=10),
+                             ttl=ttl or None)  # 0 for no expiry
+    return _keys
+
+
+def invalidate_keys(keyid=None):
+    """Forget the unlocked key ``keyid``, or all the unlocked keys: they are then retrieved again from the Keyserver."""
+    if _keys is not None:
+        _keys.invalidate(keyid)
+
+
+_keyservers = {}  # pools of connections to the Keyserver, by host, created on first use
+_stats_logged = None  # when the statistics of the connections were last logged
+
+
+def _keyserver_pool(keyurl):
+    """Return the pool of connections to the host of ``keyurl``.
+
+    The keys and the header decryptions can be served from different hosts: each one has its own pool.
+    """
+    parts = urlsplit(keyurl)
+    host = f'{parts.scheme}://{parts.netloc}'
+    pool = _keyservers.get(host)
+    if pool is None:
+        verify = CONF.get_value('quality_control', 'verify_certificate', conv=bool)
+        pool = _keyservers[host] = ConnectionPool(keyurl,
+                                                  size=CONF.get_value('quality_control', 'keyserver_pool_size', conv=int, default=4),
+                                                  connect_timeout=CONF.get_value('quality_control', 'keyserver_connect_timeout', conv=float, default=5),
+                                                  timeout=CONF.get_value('quality_control', 'keyserver_timeout', conv=float, default=30),
+                                                  nb_try=CONF.get_value('quality_control', 'keyserver_try', conv=int, default=3),
+                                                  try_interval=CONF.get_value('quality_control', 'keyserver_try_interval', conv=float, default=0.5),
+                                                  verify=verify)
+        LOG.info(f'Connection pool to the Keyserver {host} (verify certificate: {verify})')
+    return pool
+
+
+def keyserver_stats():
+    """Return the statistics of the connections to the Keyserver (handshakes, reuses, latencies), by host."""
+    return {host: pool.stats() for host, pool in _keyservers.items()}
+
+
+def _log_keyserver_stats():
+    """Log the statistics of the connections to the Keyserver, at most every ``keyserver_stats_interval`` seconds."""
+    global _stats_logged
+    interval = CONF.get_value('quality_control', 'keyserver_stats_interval', conv=float, default=300)
+    now = monotonic()
+    if _stats_logged is None:
+        _stats_logged = now  # after the first interval
+    if interval and now - _stats_logged >= interval:
+        _stats_logged = now
+        LOG.info(f'Keyserver connections: {keyserver_stats()}')
+
+
+def fetch_key(keyid):
+    """Retrieve the (armored and protected) private key ``keyid`` from Keyserver."""
+    keyurl = CONF.get_value('quality_control', 'keyserver_endpoint', raw=True) % keyid
+    LOG.info(f'Retrieving the Private Key from {keyurl}')
+    pool = _keyserver_pool(keyurl)
+    try:
+        response, privkey = pool.get(keyurl)
+    except (OSError, HTTPException) as e:
+        raise exceptions.KeyserverError(str(e)) from e
+    finally:
+        _log_keyserver_stats()
+
+    if response.status == 404:  # If key not found, then probably wrong key.
+        raise exceptions.PGPKeyError(f'{response.status}: {response.reason}')
+    if response.status != 200:
+        raise exceptions.KeyserverError(f'{response.status}: {response.reason}')
+    if not privkey:  # Correcting a bug in the EGA keyserver
+        # When key not found, it returns a 200 and an empty payload.
+        # It should probably be changed to a 404
+        raise exceptions.PGPKeyError('No PGP key found')
+    return privkey
+
+
+def fetch_records(headers):
+    """Decrypt the ``headers`` on the Keyserver, and return, for each one, its records and key ID, or the exception to raise.
+
+    The private keys are then not retrieved, and stay unlocked on the Keyserver.
+    """
+    url = CONF.get_value('quality_control', 'decrypt_endpoint')
+    LOG.info(f'Decrypting {len(headers)} headers on {url}')
+    pool = _keyserver_pool(url)
+    body = json.dumps({'headers': [header.hex() for header in headers]}).encode()
+    try:
+        response, payload = pool.post(url, body, headers={'Content-Type': 'application/json'})
+    except (OSError, HTTPException) as e:
+        raise exceptions.KeyserverError(str(e)) from e
+    finally:
+        _log_keyserver_stats()
+    if response.status != 200:
+        raise exceptions.KeyserverError(f'{response.status}: {response.reason}')
+    results = []
+    for result in json.loads(payload)['results']:
+        if 'error' in result:
+            error = crypt_exc.InvalidFormatError if result['type'] == 'InvalidFormatError' else exceptions.PGPKeyError
+            results.append(error(result['error']))
+        else:
+            results.append(([Record.from_dict(r) for r in result['records']], result['key_id']))
+    return results
+
+
 def get_records(header):
-    """Retrieve Crypt4GH header information (records) from Keyserver."""
+    """Retrieve Crypt4GH header information (records), with the private key from the cache, or from Keyserver.
+
+    If ``decrypt_endpoint`` is set, the header is decrypted on the Keyserver instead.
+    """
+    if CONF.get_value('quality_control', 'decrypt_endpoint', default=''):
+        result, = fetch_records([header])
+        if isinstance(result, Exception):
+            raise result
+        return result
     keyid = get_key_id(header)
     LOG.info(f'Key ID {keyid}')
-    keyurl = CONF.get_value('quality_control', 'keyserver_endpoint', raw=True) % keyid
-    verify = CONF.get_value('quality_control', 'verify_certificate', conv=bool)
-    LOG.info(f'Retrieving the Private Key from {keyurl} (verify certificate: {verify})')
+    # the PGP unlock is expensive: only once per key
+    with _unlocked_keys().use(keyid, partial(fetch_key, keyid), os.environ['LEGA_PASSWORD']) as key:
+        return decrypt_header(key, header), keyid
 
-    if verify:
-        ctx = None  # nothing to be done: done by default in urlopen
-    else:  # no verification
-        import ssl
-        ctx = ssl.create_default_context()
-        ctx.check_hostname = False
-        ctx.verify_mode = ssl.CERT_NONE
 
+def checksum_body(record, infile, chunk_size, workers=1, algos=()):
+    """Decrypt the remainder of ``infile`` with ``record``, and return the checksums of the original content.
+
+    The first one is the sha256 checksum, which the decryption checks against the MDC.
+    The checksums for the other ``algos`` are computed in the same pass, each in its own thread.
+    """
+    others = [algo for algo in algos if algo != 'sha256']
+    digests = Digests(others)
+    LOG.info('Decrypting (chunk size: %s, workers: %s, checksums: sha256 %s)', chunk_size, workers, ' '.join(others))
     try:
-        with urlopen(keyurl, context=ctx) as response:
-            assert(response.status == 200)
-            privkey = response.read()
-            if not privkey:  # Correcting a bug in the EGA keyserver
-                # When key not found, it returns a 200 and an empty payload.
-                # It should probably be changed to a 404
-                raise exceptions.PGPKeyError('No PGP key found')
-            return header_to_records(privkey, header, os.environ['LEGA_PASSWORD']), keyid
-    except HTTPError as e:
-        LOG.error(e)
-        msg = str(e)
-        if e.code == 404:  # If key not found, then probably wrong key.
-            raise exceptions.PGPKeyError(msg)
-        # Otherwise
-        raise exceptions.KeyserverError(msg)
-    # except Exception as e:
-    #     raise exceptions.KeyserverError(str(e))
+        mdc = body_decrypt(record, infile, process_output=digests.update if others else None,
+                           chunk_size=chunk_size, workers=workers)
+    finally:
+        digests.close()
+    return [{'algorithm': 'sha256', 'value': mdc.hex()}] + digests.checksums()
+
+
+def completed_message(data, digest, checksums=None):
+    """Shape the successful message for CentralEGA.
+
+    ``digest`` is the sha256 checksum of the original content. All its checksums can be added, with ``checksums``.
+    """
+    file_id = data['file_id']
+    org_msg = data['org_msg']
+    org_msg.pop('file_id', None)
+    org_msg['reference'] = file_id
+    org_msg['checksum'] = {'value': digest, 'algorithm': 'sha256'}
+    if checksums:
+        org_msg['checksums'] = checksums
+    LOG.debug(f"Reply message: {org_msg}")
+    return org_msg
 
 
 @db.catch_error
 @db.crypt4gh_to_user_errors
-def work(chunk_size, mover, channel, data):
+def work(chunk_size, workers, algos, mover, channel, data):
     """Verify that the file in the vault can be properly decrypted."""
     LOG.info('Verification | message: %s', data)
 
-    file_id = data['file_id']
     header = bytes.fromhex(data['header'])[16:]  # in hex -> bytes, and take away 16 bytes
     vault_path = data['vault_path']
 
@@ -82,28 +211,16 @@ def work(chunk_size, mover, channel, data):
     # If you can decrypt... the checksum is valid
 
     # Calculate the checksum of the original content
-    md = hashlib.sha256()
-
-    def checksum_content(data):
-        md.update(data)
-
     with mover.open(vault_path, 'rb') as infile:
-        LOG.info('Decrypting (chunk size: %s)', chunk_size)
-        body_decrypt(r, infile, process_output=checksum_content, chunk_size=chunk_size)
+        checksums = checksum_body(r, infile, chunk_size, workers, algos)
+    digest = checksums[0]['value']
 
-    digest = md.hexdigest()
     LOG.info('Verification completed [sha256: %s]', digest)
 
     # Updating the database
-    db.mark_completed(file_id)
+    db.mark_completed(data['file_id'], checksums[0], checksums)
 
-    # Shape successful message
-    org_msg = data['org_msg']
-    org_msg.pop('file_id', None)
-    org_msg['reference'] = file_id
-    org_msg['checksum'] = {'value': digest, 'algorithm': 'sha256'}
-    LOG.debug(f"Reply message: {org_msg}")
-    return org_msg
+    return completed_message(data, digest, checksums)
 
 
 def main(args=None):
@@ -116,8 +233,11 @@ def main(args=None):
     store = getattr(storage, CONF.get_value('vault', 'driver', default='FileStorage'))
     chunk_size = CONF.get_value('vault', 'chunk_size', conv=int, default=1 << 22)  # 4 MB
 
+    workers = CONF.get_value('quality_control', 'decrypt_workers', conv=int, default=0) or os.cpu_count()
+    algos = [algo.strip() for algo in CONF.get_value('quality_control', 'checksums', default='sha256').split(',') if algo.strip()]
+
     broker = get_connection('broker')
-    do_work = partial(work, chunk_size, store('vault', 'lega'), broker.channel())
+    do_work = partial(work, chunk_size, workers, algos, store('vault', 'lega'), broker.channel())
 
     consume(do_work, broker, 'archived', 'completed')
 
@@ -23,6 +23,7 @@ Users are handled throught Central EGA, directly.
           'console_scripts': [
               'ega-ingest = lega.ingest:main',
               'ega-verify = lega.verify:main',
+              'ega-scrub = lega.scrub:main',
               'ega-keyserver = lega.keyserver:main',
               'ega-notifications = lega.notifications:main',
               'ega-finalize = lega.finalize:main',
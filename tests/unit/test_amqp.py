@@ -1,6 +1,7 @@
 import unittest
+import threading
 from unittest import mock
-from lega.utils.amqp import get_connection, publish, consume
+from lega.utils.amqp import get_connection, publish, consume, ThreadSafeChannel
 
 
 class BrokerTest(unittest.TestCase):
@@ -53,3 +54,87 @@ class BrokerTest(unittest.TestCase):
         consume(work, mock_pika, 'queue', 'routing')
         print(dir(mock_pika))
         mock_pika.channel.assert_called()
+
+    @mock.patch('lega.utils.amqp.publish')
+    def test_consume_workers(self, mock_publish):
+        """Testing consume with several workers, should answer and ack on the connection thread."""
+        connection = mock.MagicMock()
+        channel = connection.channel.return_value
+
+        def start_consuming():
+            callback = channel.basic_consume.call_args[0][0]
+            callback(channel, mock.Mock(delivery_tag=1), mock.Mock(correlation_id='1'), '{"a": 1}')
+        channel.start_consuming.side_effect = start_consuming
+        connection.add_callback_threadsafe.side_effect = lambda callback: callback()
+        work = mock.Mock(return_value={'b': 2})
+        consume(work, connection, 'queue', 'routing', workers=2)
+        channel.basic_qos.assert_called_with(prefetch_count=2)
+        work.assert_called_with({'a': 1})
+        mock_publish.assert_called_with({'b': 2}, channel, 'lega', 'routing', correlation_id='1')
+        channel.basic_ack.assert_called_with(delivery_tag=1)
+        connection.close.assert_called()
+
+    @mock.patch('lega.utils.amqp.publish')
+    def test_consume_workers_flush(self, mock_publish):
+        """Testing consume with several workers, should send the queued answers and acks before closing the connection."""
+        connection = mock.MagicMock()
+        channel = connection.channel.return_value
+        queued = []
+
+        def start_consuming():
+            callback = channel.basic_consume.call_args[0][0]
+            callback(channel, mock.Mock(delivery_tag=1), mock.Mock(correlation_id='1'), '{"a": 1}')
+        channel.start_consuming.side_effect = start_consuming
+        connection.add_callback_threadsafe.side_effect = queued.append
+        connection.process_data_events.side_effect = lambda time_limit: [callback() for callback in queued]
+        connection.close.side_effect = lambda: self.assertEqual(1, channel.basic_ack.call_count)
+        consume(mock.Mock(return_value={'b': 2}), connection, 'queue', 'routing', workers=2)
+        connection.close.assert_called()
+
+    @mock.patch('lega.utils.amqp.publish')
+    def test_consume_redelivered(self, mock_publish):
+        """Testing consume with redelivered, should tell the work whether the message was delivered before."""
+        connection = mock.MagicMock()
+        channel = connection.channel.return_value
+
+        def start_consuming():
+            callback = channel.basic_consume.call_args[0][0]
+            callback(channel, mock.Mock(delivery_tag=1, redelivered=True), mock.Mock(correlation_id='1'), '{"a": 1}')
+        channel.start_consuming.side_effect = start_consuming
+        connection.add_callback_threadsafe.side_effect = lambda callback: callback()
+        for workers in (1, 2):
+            work = mock.Mock(return_value=None)
+            consume(work, connection, 'queue', 'routing', workers=workers, redelivered=True)
+            work.assert_called_with(True, {'a': 1})
+
+    @mock.patch('lega.utils.amqp.publish')
+    def test_consume_fair(self, mock_publish):
+        """Testing consume with fair scheduling, should prefetch more messages and work on all of them."""
+        connection = mock.MagicMock()
+        channel = connection.channel.return_value
+
+        done = threading.Semaphore(0)
+
+        def start_consuming():
+            callback = channel.basic_consume.call_args[0][0]
+            for i, user in enumerate(['a', 'a', 'b']):
+                callback(channel, mock.Mock(delivery_tag=i), mock.Mock(correlation_id=str(i)), f'{{"user": "{user}"}}')
+            for _ in range(3):  # consuming until stopped, after the work is done
+                done.acquire(timeout=5)
+        channel.start_consuming.side_effect = start_consuming
+        connection.add_callback_threadsafe.side_effect = lambda callback: callback()
+        work = mock.Mock(return_value=None, side_effect=lambda data: done.release())
+        consume(work, connection, 'queue', 'routing', fair_key=lambda data: data['user'], prefetch=10)
+        channel.basic_qos.assert_called_with(prefetch_count=10)
+        self.assertEqual(3, work.call_count)
+        self.assertEqual(3, channel.basic_ack.call_count)
+
+    def test_threadsafe_channel(self):
+        """Testing the channel proxy, should defer the publication to the connection thread."""
+        connection = mock.MagicMock()
+        channel = mock.MagicMock()
+        proxy = ThreadSafeChannel(connection, channel)
+        publish('message', proxy, 'exchange', 'routing')
+        channel.basic_publish.assert_not_called()
+        connection.add_callback_threadsafe.call_args[0][0]()
+        channel.basic_publish.assert_called()
@@ -1,8 +1,9 @@
-from lega.utils.checksum import instantiate, calculate, is_valid, get_from_companion, supported_algorithms
+from lega.utils.checksum import instantiate, calculate, is_valid, get_from_companion, supported_algorithms, ChecksumReader, Digests
 from lega.utils.exceptions import UnsupportedHashAlgorithm, CompanionNotFound
 from lega.conf.__main__ import main
 from lega.utils.db import _do_exit
 import hashlib
+import shutil
 import unittest
 from unittest import mock
 from lega.utils import get_file_content, sanitize_user_id
@@ -40,6 +41,28 @@ class TestBasicFunctions(unittest.TestCase):
         assert calculate(path, 'md5') == file_hash
         filedir.cleanup()
 
+    def test_checksum_reader(self):
+        """Read through the checksum reader, should count the bytes and compute the digests."""
+        data = b'data' * 1000
+        reader = ChecksumReader(io.BytesIO(data), algos=('md5', 'sha256'))
+        out = io.BytesIO()
+        shutil.copyfileobj(reader, out, 7)
+        self.assertEqual(data, out.getvalue())
+        self.assertEqual(len(data), reader.size)
+        self.assertEqual([{'algorithm': 'md5', 'value': hashlib.md5(data).hexdigest()},
+                          {'algorithm': 'sha256', 'value': hashlib.sha256(data).hexdigest()}], reader.checksums())
+
+    def test_digests(self):
+        """Update the digests in their threads, should compute them all, in order."""
+        data = [bytes([i]) * 5000 for i in range(10)]
+        digests = Digests(['md5', 'sha512'])
+        for chunk in data:
+            digests.update(chunk)
+        self.assertEqual([{'algorithm': 'md5', 'value': hashlib.md5(b''.join(data)).hexdigest()},
+                          {'algorithm': 'sha512', 'value': hashlib.sha512(b''.join(data)).hexdigest()}], digests.checksums())
+        self.assertFalse(any(t.is_alive() for t in digests.threads))
+        digests.close()
+
     def test_calculate_error(self):
         """Test nonexisting file."""
         assert calculate('tests/resources/notexisting.file', 'md5') is None
@@ -89,7 +112,7 @@ class TestBasicFunctions(unittest.TestCase):
     def test_supported_algorithms(self):
         """Should get a tuple of supported algorithms."""
         result = supported_algorithms()
-        self.assertEqual(('md5', 'sha256'), result)
+        self.assertEqual(('md5', 'sha256', 'sha384', 'sha512'), result)
 
     def test_config_main(self):
         """Testing main configuration."""
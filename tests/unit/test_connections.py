@@ -0,0 +1,106 @@
+import unittest
+from unittest import mock
+import ssl
+import threading
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from lega.utils.connections import ConnectionPool
+
+
+class KeepAliveHandler(BaseHTTPRequestHandler):
+    """Respond with the path, on keep-alive connections."""
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        """Return the path."""
+        body = self.path.encode()
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        """Return the request body."""
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        """Keep quiet."""
+        pass
+
+
+class TestConnectionPool(unittest.TestCase):
+    """ConnectionPool.
+
+    Testing the keep-alive connections.
+    """
+
+    def setUp(self):
+        """Start a local server."""
+        self.server = HTTPServer(('127.0.0.1', 0), KeepAliveHandler)
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        self.url = f'http://127.0.0.1:{self.server.server_port}'
+
+    def tearDown(self):
+        """Stop the local server."""
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_keep_alive(self):
+        """Test get, should reuse the connection and count a single handshake."""
+        pool = ConnectionPool(self.url)
+        for i in range(3):
+            response, body = pool.get(f'{self.url}/retrieve/{i}/private')
+            self.assertEqual(200, response.status)
+            self.assertEqual(f'/retrieve/{i}/private'.encode(), body)
+        stats = pool.stats()
+        self.assertEqual(3, stats['requests'])
+        self.assertEqual(1, stats['handshakes'])
+        self.assertEqual(2, stats['reused'])
+        self.assertEqual(1, stats['idle'])
+        pool.close()
+        self.assertEqual(0, pool.stats()['idle'])
+
+    def test_post(self):
+        """Test post, should send the body, on the same connection as the get."""
+        pool = ConnectionPool(self.url)
+        pool.get(self.url)
+        response, body = pool.post(f'{self.url}/decrypt', b'{"headers": []}', headers={'Content-Type': 'application/json'})
+        self.assertEqual(200, response.status)
+        self.assertEqual(b'{"headers": []}', body)
+        self.assertEqual(1, pool.stats()['handshakes'])
+
+    def test_stale_connection(self):
+        """Test get after the server closed the idle connection, should reconnect without retrying."""
+        pool = ConnectionPool(self.url)
+        pool.get(self.url)
+        pool.idle.queue[0].sock.close()  # as if closed by the server
+        response, body = pool.get(self.url)
+        self.assertEqual(b'/', body)
+        self.assertEqual(2, pool.stats()['handshakes'])
+        self.assertEqual(0, pool.stats()['retries'])
+
+    @mock.patch('lega.utils.connections.sleep')
+    def test_retry(self, mock_sleep):
+        """Test get on a closed port, should retry with a doubling backoff, then raise."""
+        self.server.server_close()
+        pool = ConnectionPool(self.url, nb_try=3, try_interval=0.5)
+        with self.assertRaises(OSError):
+            pool.get(self.url)
+        self.assertEqual([mock.call(0.5), mock.call(1.0)], mock_sleep.call_args_list)
+        self.assertEqual(3, pool.stats()['failures'])
+
+    def test_no_verify(self):
+        """Test the TLS context without certificate verification."""
+        pool = ConnectionPool('https://ega_keys:9000/retrieve/%s/private', verify=False)
+        self.assertEqual(ssl.CERT_NONE, pool.context.verify_mode)
+        self.assertFalse(pool.context.check_hostname)
+        self.assertEqual(9000, pool.port)
+
+
+if __name__ == '__main__':
+    unittest.main()
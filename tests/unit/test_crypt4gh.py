@@ -0,0 +1,184 @@
+import unittest
+from unittest import mock
+import io
+import tempfile
+import hashlib
+from contextlib import ExitStack
+from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+from cryptography.hazmat.backends import default_backend
+from legacryptor.exceptions import MDCError, InvalidFormatError
+from lega.utils.crypt4gh import decrypt_header, body_decrypt, header_key_id, UnlockedKeys, Record
+from lega.utils.exceptions import PGPKeyError
+from lega.utils.storage import MappedFile
+from . import pgp_data
+
+
+HEADER_END = 667  # 16 bytes of magic number, version and length, then the PGP message
+
+
+class TestCrypt4GH(unittest.TestCase):
+    """Crypt4GH.
+
+    Testing the header and body decryption.
+    """
+
+    def setUp(self):
+        """Initialise fixtures."""
+        self.raw = bytes.fromhex(pgp_data.ENC_FILE)
+        self.keys = UnlockedKeys()
+        self.stack = ExitStack()
+        self.key = self.stack.enter_context(self.keys.use('key_id', pgp_data.PGP_PRIVKEY, pgp_data.PGP_PASSPHRASE))
+
+    def tearDown(self):
+        """Lock the key again."""
+        self.stack.close()
+        self.keys.invalidate()
+
+    def test_decrypt(self):
+        """Test decrypt_header and body_decrypt, should return the original content."""
+        records = decrypt_header(self.key, self.raw[16:HEADER_END])
+        self.assertEqual(1, len(records))
+        output = io.BytesIO()
+        digest = body_decrypt(records[0], io.BytesIO(self.raw[HEADER_END:]), process_output=output.write, chunk_size=5)
+        self.assertEqual(b'Hello PyTest\n', output.getvalue())
+        self.assertEqual(hashlib.sha256(b'Hello PyTest\n').digest(), digest)
+
+    def test_decrypt_parallel(self):
+        """Test body_decrypt with several workers, should pass the original content in order."""
+        records = decrypt_header(self.key, self.raw[16:HEADER_END])
+        output = []
+        body_decrypt(records[0], io.BytesIO(self.raw[HEADER_END:]), process_output=output.append, chunk_size=5, workers=3)
+        self.assertEqual(b'Hello PyTest\n', b''.join(output))
+        self.assertEqual([b'Hello', b' PyTe', b'st\n'], output)
+
+    def test_decrypt_parallel_large(self):
+        """Test body_decrypt with several workers, on more chunks than workers, not aligned to the AES blocks."""
+        content = bytes(range(256)) * 100
+        record = Record(bytes(range(32)), bytes(range(16)), ciphertext_start=32)
+        encryptor = Cipher(algorithms.AES(record.session_key), modes.CTR(record.iv), backend=default_backend()).encryptor()
+        body = hashlib.sha256(content).digest() + encryptor.update(content)
+        output = io.BytesIO()
+        body_decrypt(record, io.BytesIO(body), process_output=output.write, chunk_size=1000, workers=4)
+        self.assertEqual(content, output.getvalue())
+        with self.assertRaises(MDCError):
+            body_decrypt(record, io.BytesIO(body[:-1]), chunk_size=999, workers=4)
+
+    def test_decrypt_mapped(self):
+        """Test body_decrypt from a memory-mapped file, should decrypt the slices."""
+        records = decrypt_header(self.key, self.raw[16:HEADER_END])
+        with tempfile.NamedTemporaryFile() as f:
+            f.write(self.raw[HEADER_END:])
+            f.flush()
+            with MappedFile(f.name) as infile:
+                output = io.BytesIO()
+                digest = body_decrypt(records[0], infile, process_output=output.write, chunk_size=5, workers=2)
+        self.assertEqual(b'Hello PyTest\n', output.getvalue())
+        self.assertEqual(hashlib.sha256(b'Hello PyTest\n').digest(), digest)
+
+    def test_decrypt_mdc_error(self):
+        """Test body_decrypt of a tampered body, should raise MDCError."""
+        record, = decrypt_header(self.key, self.raw[16:HEADER_END])
+        body = bytearray(self.raw[HEADER_END:])
+        body[-1] ^= 1
+        with self.assertRaises(MDCError):
+            body_decrypt(record, io.BytesIO(body))
+
+    def test_decrypt_header_error(self):
+        """Test decrypt_header with an invalid header, should raise PGPKeyError."""
+        with self.assertRaises(PGPKeyError):
+            decrypt_header(self.key, b'not a header')
+
+    def test_header_key_id(self):
+        """Test header_key_id, should return the key ID, or raise InvalidFormatError."""
+        self.assertEqual(pgp_data.KEY_ID, header_key_id(self.raw[16:HEADER_END]))
+        with self.assertRaises(InvalidFormatError):
+            header_key_id(b'not a header')
+
+    def test_record_dict(self):
+        """Test Record.as_dict and Record.from_dict, should round-trip."""
+        record, = decrypt_header(self.key, self.raw[16:HEADER_END])
+        data = record.as_dict()
+        self.assertEqual(pgp_data.SESSION_KEY, data['session_key'])
+        copy = Record.from_dict(data)
+        self.assertEqual((record.session_key, record.iv, repr(record)), (copy.session_key, copy.iv, repr(copy)))
+
+    def test_body_decrypt_method(self):
+        """Test body_decrypt with an unknown method, should raise InvalidFormatError."""
+        with self.assertRaises(InvalidFormatError):
+            body_decrypt(Record(bytes(32), bytes(16), method=1), io.BytesIO())
+
+
+class TestUnlockedKeys(unittest.TestCase):
+    """UnlockedKeys.
+
+    Testing the cache of unlocked keys.
+    """
+
+    def test_unlock_error(self):
+        """Test use with a wrong passphrase, should raise PGPKeyError."""
+        with self.assertRaises(PGPKeyError):
+            with UnlockedKeys().use('key_id', pgp_data.PGP_PRIVKEY, 'wrong'):
+                pass
+
+    @mock.patch('lega.utils.crypt4gh.pgpy.PGPKey.from_blob')
+    def test_lru(self, mock_blob):
+        """Test use over the size, should evict the least recently used key, and lock it again."""
+        mock_blob.side_effect = lambda armored: (mock.MagicMock(), None)
+        keys = UnlockedKeys(max_size=2)
+        for key_id in ('a', 'b', 'a', 'c'):
+            with keys.use(key_id, 'armored', 'pass') as key:
+                if key_id == 'a':
+                    first = key
+        self.assertEqual(['a', 'c'], list(keys.keys))
+        self.assertEqual(3, mock_blob.call_count)
+        first.unlock.return_value.__exit__.assert_not_called()
+        keys.invalidate('a')
+        first.unlock.return_value.__exit__.assert_called_once()
+        self.assertEqual(['c'], list(keys.keys))
+        keys.invalidate()
+        self.assertEqual(0, len(keys.keys))
+
+    @mock.patch('lega.utils.crypt4gh.pgpy.PGPKey.from_blob')
+    def test_in_use(self, mock_blob):
+        """Test invalidate while the key is in use, should lock it again after its last use only."""
+        mock_blob.return_value = (mock.MagicMock(), None)
+        keys = UnlockedKeys()
+        with keys.use('a', 'armored', 'pass') as key:
+            with keys.use('a', 'armored', 'pass'):
+                keys.invalidate()
+            key.unlock.return_value.__exit__.assert_not_called()
+        key.unlock.return_value.__exit__.assert_called_once()
+
+    @mock.patch('lega.utils.crypt4gh.pgpy.PGPKey.from_blob')
+    def test_use_fetch(self, mock_blob):
+        """Test use with a function for the armored key, should only call it when the key is not cached."""
+        mock_blob.return_value = (mock.MagicMock(), None)
+        keys = UnlockedKeys()
+        fetch = mock.Mock(return_value='armored')
+        for _ in range(2):
+            with keys.use('a', fetch, 'pass'):
+                pass
+        fetch.assert_called_once_with()
+        mock_blob.assert_called_once_with('armored')
+
+    @mock.patch('lega.utils.crypt4gh.monotonic')
+    @mock.patch('lega.utils.crypt4gh.pgpy.PGPKey.from_blob')
+    def test_ttl(self, mock_blob, mock_monotonic):
+        """Test use after the ttl, should unlock the key again."""
+        mock_blob.return_value = (mock.MagicMock(), None)
+        mock_monotonic.return_value = 100
+        keys = UnlockedKeys(ttl=10)
+        with keys.use('a', 'armored', 'pass'):
+            pass
+        mock_monotonic.return_value = 109
+        with keys.use('a', 'armored', 'pass'):
+            pass
+        self.assertEqual(1, mock_blob.call_count)
+        mock_monotonic.return_value = 111
+        with keys.use('a', 'armored', 'pass'):
+            pass
+        self.assertEqual(2, mock_blob.call_count)
+        self.assertEqual(1, len(keys.keys))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -3,6 +3,8 @@ from lega.utils.db import (insert_file,
                            get_errors, set_error,
                            get_info,
                            store_header, set_archived,
+                           get_checkpoint, set_checkpoint, delete_checkpoint, get_duplicate,
+                           get_scrub_position, set_scrub_position,
                            mark_in_progress, mark_completed,
                            set_stable_id,
                            fetch_args, connect)
@@ -83,6 +85,59 @@ class DBTest(unittest.TestCase):
         set_archived("file_id", '/ega/vault/000/000/0a1', 1000)
         mock_connect().__enter__().cursor().__enter__().execute.assert_called()
 
+    @mock.patch('lega.utils.db.connect')
+    def test_set_archived_completed(self, mock_connect):
+        """DB set archived and completed, with the header, in one update."""
+        set_archived("file_id", '/ega/vault/000/000/0a1', 1000, {'algorithm': 'sha256', 'value': 'abc'}, 'header', True)
+        cursor = mock_connect().__enter__().cursor().__enter__()
+        self.assertEqual(1, cursor.execute.call_count)
+        params = cursor.execute.call_args[0][1]
+        self.assertEqual(('COMPLETED', 'header', 'sha256'), (params['status'], params['header'], params['vault_checksum_type']))
+
+    @mock.patch('lega.utils.db.connect')
+    def test_set_checkpoint(self, mock_connect):
+        """DB set checkpoint, should store the state as JSON."""
+        set_checkpoint('file_id', 'header', 1000, {'size': 10})
+        params = mock_connect().__enter__().cursor().__enter__().execute.call_args[0][1]
+        self.assertEqual('{"size": 10}', params['state'])
+
+    @mock.patch('lega.utils.db.connect')
+    def test_delete_checkpoint(self, mock_connect):
+        """DB delete checkpoint."""
+        delete_checkpoint(32)
+        query, params = mock_connect().__enter__().cursor().__enter__().execute.call_args[0]
+        self.assertIn('DELETE FROM local_ega.ingestion_checkpoints', query)
+        self.assertEqual({'file_id': 32}, params)
+
+    @mock.patch('lega.utils.db.connect')
+    def test_get_checkpoint(self, mock_connect):
+        """DB get checkpoint."""
+        mock_connect().__enter__().cursor().__enter__().fetchone.return_value = (1, 'header', 1000, {'size': 10})
+        self.assertEqual((1, 'header', 1000, {'size': 10}), get_checkpoint('filename', 'user_id'))
+
+    @mock.patch('lega.utils.db.connect')
+    def test_get_duplicate(self, mock_connect):
+        """DB get duplicate, should look for the same header and size."""
+        cursor = mock_connect().__enter__().cursor().__enter__()
+        cursor.fetchone.return_value = None
+        self.assertEqual(None, get_duplicate('header', 1000))
+        params = cursor.execute.call_args[0][1]
+        self.assertEqual(('header', 1000), (params['header'], params['vault_filesize']))
+        self.assertEqual(('ERROR', 'DISABLED'), params['statuses'])
+        get_duplicate('header', 1000, 32)
+        query, params = cursor.execute.call_args[0]
+        self.assertIn('WHERE n.id = %(file_id)s', query)  # the submission it just disabled
+        self.assertEqual(32, params['file_id'])
+
+    @mock.patch('lega.utils.db.connect')
+    def test_set_archived_checksums(self, mock_connect):
+        """DB set archived and completed, recording all the checksums of the original content in the same statement."""
+        checksums = [{'algorithm': 'sha256', 'value': 'abc'}, {'algorithm': 'md5', 'value': 'def'}]
+        set_archived('file_id', 'vault/1', 1000, None, 'header', True, checksums[0], checksums)
+        query, params = mock_connect().__enter__().cursor().__enter__().execute.call_args[0]
+        self.assertIn('INSERT INTO local_ega.vault_file_checksums', query)
+        self.assertEqual((['sha256', 'md5'], ['abc', 'def']), (params['algorithms'], params['values']))
+
     @mock.patch('lega.utils.db.connect')
     def test_mark_in_progress(self, mock_connect):
         """DB mark in progress."""
@@ -97,6 +152,37 @@ class DBTest(unittest.TestCase):
         mark_completed('file_id')
         mock_connect().__enter__().cursor().__enter__().execute.assert_called()
 
+    @mock.patch('lega.utils.db.connect')
+    def test_mark_completed_checksum(self, mock_connect):
+        """DB mark completed, with the checksum of the original content."""
+        mark_completed('file_id', {'algorithm': 'sha256', 'value': 'abc'})
+        params = mock_connect().__enter__().cursor().__enter__().execute.call_args[0][1]
+        self.assertEqual(('COMPLETED', 'abc', 'sha256'), (params['status'], params['checksum'], params['checksum_type']))
+
+    @mock.patch('lega.utils.db.connect')
+    def test_mark_completed_checksums(self, mock_connect):
+        """DB mark completed, recording all the checksums of the original content in the same statement."""
+        checksums = [{'algorithm': 'sha256', 'value': 'abc'}, {'algorithm': 'md5', 'value': 'def'}]
+        mark_completed('file_id', checksums[0], checksums)
+        query, params = mock_connect().__enter__().cursor().__enter__().execute.call_args[0]
+        self.assertIn('INSERT INTO local_ega.vault_file_checksums', query)
+        self.assertEqual((['sha256', 'md5'], ['abc', 'def']), (params['algorithms'], params['values']))
+
+    @mock.patch('lega.utils.db.connect')
+    def test_get_scrub_position(self, mock_connect):
+        """DB get scrub position, should be 0 for a new scrubber."""
+        mock_connect().__enter__().cursor().__enter__().fetchone.return_value = None
+        self.assertEqual(0, get_scrub_position('vault'))
+        mock_connect().__enter__().cursor().__enter__().fetchone.return_value = (12,)
+        self.assertEqual(12, get_scrub_position('vault'))
+
+    @mock.patch('lega.utils.db.connect')
+    def test_set_scrub_position(self, mock_connect):
+        """DB set scrub position, should go back to 0 and count the pass when completed."""
+        set_scrub_position('vault', 12, completed=True)
+        params = mock_connect().__enter__().cursor().__enter__().execute.call_args[0][1]
+        self.assertEqual(('vault', 0, 1), (params['name'], params['file_id'], params['passes']))
+
     @mock.patch('lega.utils.db.connect')
     def test_set_stable_id(self, mock_connect):
         """DB mark completed."""
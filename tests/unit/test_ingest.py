@@ -1,10 +1,14 @@
 import unittest
 from lega.ingest import main, work
+from lega.utils.scheduling import Throttle
 from unittest import mock
 from testfixtures import tempdir
 # from pathlib import PosixPath
 from . import pgp_data
 from lega.utils.exceptions import FromUser
+import hashlib
+import io
+import os
 
 
 class testIngest(unittest.TestCase):
@@ -29,6 +33,7 @@ class testIngest(unittest.TestCase):
         """Test ingest worker, should send a messge."""
         # Mocking a lot of stuff, as it is previously tested
         mock_header.return_value = b'beginning', b'header'
+        mock_db.get_checkpoint.return_value = None
         mock_db.insert_file.return_value = 32
         store = mock.MagicMock()
         store.location.return_value = 'smth'
@@ -37,15 +42,235 @@ class testIngest(unittest.TestCase):
         mock_broker.channel.return_value = mock.Mock()
         infile = filedir.write('infile.in', bytearray.fromhex(pgp_data.ENC_FILE))
         data = {'filepath': infile, 'user': 'user_id@elixir-europe.org'}
-        result = work(store, store, mock_broker, data)
+        result = work(store, store, mock_broker, ['sha256'], None, False, Throttle(), False, data)
         mocked = {'filepath': infile, 'user': 'user_id@elixir-europe.org',
                   'file_id': 32,
                   'org_msg': {'filepath': infile, 'user': 'user_id@elixir-europe.org'},
                   'header': '626567696e6e696e67686561646572',
-                  'vault_path': 'smth'}
+                  'vault_path': 'smth',
+                  'vault_checksums': [{'algorithm': 'sha256',
+                                       'value': 'e3b0c44298fc1c149afbf4c8996fb92427ae41e4649b934ca495991b7852b855'}]}
         self.assertEqual(mocked, result)
+        mock_db.get_checkpoint.assert_not_called()  # only for the redelivered messages
         filedir.cleanup()
 
+    @mock.patch('lega.ingest.publish')
+    @mock.patch('lega.verify.body_decrypt')
+    @mock.patch('lega.ingest.get_records')
+    @mock.patch('lega.ingest.get_header')
+    @mock.patch('lega.ingest.db')
+    def test_work_fused(self, mock_db, mock_header, mock_records, mock_decrypt, mock_publish):
+        """Test ingest worker in fused mode, should decrypt while copying and send the completed message."""
+        mock_header.return_value = b'beginning', b'header'
+        mock_db.get_checkpoint.return_value = None
+        mock_db.insert_file.return_value = 32
+        mock_records.return_value = ['record'], 'key_id'
+
+        def decrypt(record, infile, process_output=None, chunk_size=None, workers=1):
+            content = infile.read()
+            if process_output:
+                process_output(content)
+            return hashlib.sha256(content).digest()
+        mock_decrypt.side_effect = decrypt
+        store = mock.MagicMock()
+        store.location.return_value = 'smth'
+        store.copy.side_effect = lambda body, location, **kwargs: len(body.read(10) + body.read())
+        inbox = mock.MagicMock()
+        inbox.return_value.open.return_value.__enter__.return_value = io.BytesIO(b'body' * 1000)
+        data = {'filepath': 'infile.in', 'user': 'user_id@elixir-europe.org'}
+        with mock.patch.dict(os.environ, {'QUALITY_CONTROL_CHECKSUMS': 'sha256, md5'}):
+            result = work(store, inbox, mock.MagicMock(), ['sha256'], 0, False, Throttle(), False, data)
+        self.assertEqual(None, result)
+        mock_records.assert_called_with(b'header')
+        mock_db.insert_file.assert_called_with('infile.in', 'user_id', 'IN_INGESTION')
+        checksums = [{'algorithm': 'sha256', 'value': hashlib.sha256(b'body' * 1000).hexdigest()},
+                     {'algorithm': 'md5', 'value': hashlib.md5(b'body' * 1000).hexdigest()}]
+        mock_db.set_archived.assert_called_with(32, 'smth', 4000, mock.ANY, '626567696e6e696e67686561646572', True,
+                                               checksums[0], checksums)
+        msg, _, exchange, routing = mock_publish.call_args[0]
+        self.assertEqual(('lega', 'completed'), (exchange, routing))
+        self.assertEqual(checksums[0], msg['checksum'])
+        self.assertEqual(checksums, msg['checksums'])
+
+    @mock.patch('lega.ingest.get_records')
+    @mock.patch('lega.ingest.get_header')
+    @mock.patch('lega.ingest.db')
+    def test_work_fused_read_back(self, mock_db, mock_header, mock_records):
+        """Test ingest worker in fused mode, with a read-back policy of always, should let the verify step decrypt."""
+        mock_header.return_value = b'beginning', b'header'
+        mock_db.get_checkpoint.return_value = None
+        mock_db.insert_file.return_value = 32
+        store = mock.MagicMock()
+        store.location.return_value = 'smth'
+        inbox = mock.MagicMock()
+        inbox.return_value.open.return_value.__enter__.return_value = io.BytesIO(b'body')
+        data = {'filepath': 'infile.in', 'user': 'user_id@elixir-europe.org'}
+        result = work(store, inbox, mock.MagicMock(), ['sha256'], 1, False, Throttle(), False, data)
+        self.assertEqual('smth', result['vault_path'])
+        mock_records.assert_not_called()
+
+    @mock.patch('lega.ingest.get_header')
+    @mock.patch('lega.ingest.db')
+    def test_work_resume(self, mock_db, mock_header):
+        """Test ingest worker, should resume an interrupted copy, and still checksum the whole body."""
+        mock_header.return_value = b'beginning', b'header'
+        header_hex = '626567696e6e696e67686561646572'
+        mock_db.get_checkpoint.return_value = (32, header_hex, 4, {'size': 2})
+        store = mock.MagicMock()
+        store.location.return_value = 'smth'
+        store.resumable.return_value = True
+        store.copy.side_effect = lambda body, location, resume=None, checkpoint=None, size=None: resume['size'] + len(body.read())
+        inbox = mock.MagicMock()
+        inbox.return_value.open.return_value.__enter__.return_value = io.BytesIO(b'body')
+        data = {'filepath': 'infile.in', 'user': 'user_id@elixir-europe.org'}
+        result = work(store, inbox, mock.MagicMock(), ['sha256'], None, False, Throttle(), True, data)
+        mock_db.insert_file.assert_not_called()
+        self.assertEqual({'size': 2}, store.copy.call_args[1]['resume'])
+        self.assertEqual(hashlib.sha256(b'body').hexdigest(), result['vault_checksums'][0]['value'])
+        mock_db.set_archived.assert_called_with(32, 'smth', 4, mock.ANY, header_hex, False, None, [])
+
+    @mock.patch('lega.ingest.get_header')
+    @mock.patch('lega.ingest.db')
+    def test_work_resume_changed(self, mock_db, mock_header):
+        """Test ingest worker, should start afresh if the inbox file changed since the checkpoint."""
+        mock_header.return_value = b'beginning', b'header'
+        mock_db.get_checkpoint.return_value = (32, '626567696e6e696e67686561646572', 1000, {'size': 2})
+        mock_db.insert_file.return_value = 33
+        store = mock.MagicMock()
+        store.location.side_effect = lambda file_id: f'vault/{file_id}'
+        inbox = mock.MagicMock()
+        inbox.return_value.open.return_value.__enter__.return_value = io.BytesIO(b'body')
+        data = {'filepath': 'infile.in', 'user': 'user_id@elixir-europe.org'}
+        result = work(store, inbox, mock.MagicMock(), ['sha256'], None, False, Throttle(), True, data)
+        self.assertEqual(33, result['file_id'])
+        self.assertEqual(None, store.copy.call_args[1]['resume'])
+        self.assertEqual('vault/33', store.copy.call_args[0][1])
+        store.abandon.assert_called_once_with('vault/32', {'size': 2})  # the partial copy of the previous ingestion
+        mock_db.delete_checkpoint.assert_called_once_with(32)
+
+    @mock.patch('lega.ingest.get_header')
+    @mock.patch('lega.ingest.db')
+    @mock.patch('lega.utils.db.set_error')
+    def test_work_copy_error(self, mock_set_error, mock_db, mock_header):
+        """Test ingest worker, a failed copy should be removed from the vault, with its checkpoint."""
+        mock_header.return_value = b'beginning', b'header'
+        mock_db.get_checkpoint.return_value = None
+        mock_db.insert_file.return_value = 32
+        store = mock.MagicMock()
+        store.location.side_effect = lambda file_id: f'vault/{file_id}'
+
+        def copy(body, location, resume=None, checkpoint=None, size=None):
+            checkpoint({'size': 2})
+            raise OSError('No space left on device')
+        store.copy.side_effect = copy
+        inbox = mock.MagicMock()
+        inbox.return_value.open.return_value.__enter__.return_value = io.BytesIO(b'body')
+        data = {'filepath': 'infile.in', 'user': 'user_id@elixir-europe.org'}
+        self.assertEqual(None, work(store, inbox, mock.MagicMock(), ['sha256'], None, False, Throttle(), False, data))
+        mock_db.set_checkpoint.assert_called_with(32, '626567696e6e696e67686561646572', 4, {'size': 2})
+        store.abandon.assert_called_once_with('vault/32', {'size': 2})
+        mock_db.delete_checkpoint.assert_called_once_with(32)
+        mock_set_error.assert_called()
+
+    @mock.patch('lega.ingest.get_header')
+    @mock.patch('lega.ingest.db')
+    def test_work_throttle(self, mock_db, mock_header):
+        """Test ingest worker with a bandwidth limit, should copy through the throttled reader."""
+        mock_header.return_value = b'beginning', b'header'
+        mock_db.get_checkpoint.return_value = None
+        mock_db.insert_file.return_value = 32
+        store = mock.MagicMock()
+        store.copy.side_effect = lambda body, location, **kwargs: len(body.read())
+        inbox = mock.MagicMock()
+        inbox.return_value.open.return_value.__enter__.return_value = io.BytesIO(b'body')
+        data = {'filepath': 'infile.in', 'user': 'user_id@elixir-europe.org'}
+        throttle = Throttle(user_rate=1 << 20)
+        result = work(store, inbox, mock.MagicMock(), ['sha256'], None, False, throttle, False, data)
+        self.assertEqual(hashlib.sha256(b'body').hexdigest(), result['vault_checksums'][0]['value'])
+        self.assertIn('user_id', throttle.users)
+
+    @mock.patch('lega.ingest.publish')
+    @mock.patch('lega.ingest.get_header')
+    @mock.patch('lega.ingest.db')
+    def test_work_duplicate(self, mock_db, mock_header, mock_publish):
+        """Test ingest worker, should reuse the vault file of an identical verified file, and send the completed message."""
+        mock_header.return_value = b'beginning', b'header'
+        mock_db.get_checkpoint.return_value = None
+        mock_db.insert_file.return_value = 32
+        digests = [{'algorithm': 'sha256', 'value': 'digest'}, {'algorithm': 'md5', 'value': 'md5digest'}]
+        mock_db.get_duplicate.return_value = (12, 'vault/12', hashlib.sha256(b'body').hexdigest(), 'SHA256', 'digest', digests)
+        store = mock.MagicMock()
+        inbox = mock.MagicMock()
+        inbox.return_value.open.return_value.__enter__.return_value = io.BytesIO(b'body')
+        data = {'filepath': 'infile.in', 'user': 'user_id@elixir-europe.org'}
+        result = work(store, inbox, mock.MagicMock(), ['sha256'], None, True, Throttle(), False, data)
+        self.assertEqual(None, result)
+        store.copy.assert_not_called()
+        mock_db.get_duplicate.assert_called_with('626567696e6e696e67686561646572', 4, 32)
+        mock_db.set_archived.assert_called_with(32, 'vault/12', 4, {'algorithm': 'sha256', 'value': hashlib.sha256(b'body').hexdigest()},
+                                               '626567696e6e696e67686561646572', True, digests[0], digests)
+        msg, _, exchange, routing = mock_publish.call_args[0]
+        self.assertEqual(('lega', 'completed'), (exchange, routing))
+        self.assertEqual({'value': 'digest', 'algorithm': 'sha256'}, msg['checksum'])
+        self.assertEqual(digests, msg['checksums'])
+
+    @mock.patch('lega.ingest.publish')
+    @mock.patch('lega.ingest.get_header')
+    @mock.patch('lega.ingest.db')
+    def test_work_duplicate_same_path(self, mock_db, mock_header, mock_publish):
+        """Test ingest worker, should reuse the vault file of the same file submitted again, which its insertion disabled."""
+        mock_header.return_value = b'beginning', b'header'
+        header_hex = '626567696e6e696e67686561646572'
+        vault_checksum = hashlib.sha256(b'body').hexdigest()
+        # As in the database: a row per submission, the older ones of the same path and user disabled by insert_file
+        files = {12: {'path': 'infile.in', 'user': 'user_id', 'status': 'COMPLETED', 'header': header_hex, 'size': 4},
+                 20: {'path': 'other.in', 'user': 'user_id', 'status': 'DISABLED', 'header': header_hex, 'size': 4}}
+
+        def insert_file(filepath, user_id, status):
+            for row in files.values():
+                if (row['path'], row['user']) == (filepath, user_id) and row['status'] != 'ERROR':
+                    row['status'] = 'DISABLED'
+            files[32] = {'path': filepath, 'user': user_id, 'status': status, 'header': None, 'size': None}
+            return 32
+
+        def get_duplicate(header, size, file_id=None):
+            new = files.get(file_id, {})
+            found = [i for i, row in files.items()
+                     if (row['header'], row['size']) == (header, size) and i != file_id and
+                     (row['status'] not in ('ERROR', 'DISABLED') or
+                      (row['status'] == 'DISABLED' and (row['path'], row['user']) == (new.get('path'), new.get('user'))))]
+            return (max(found), f'vault/{max(found)}', vault_checksum, 'SHA256', 'digest', None) if found else None
+
+        mock_db.get_checkpoint.return_value = None
+        mock_db.insert_file.side_effect = insert_file
+        mock_db.get_duplicate.side_effect = get_duplicate
+        store = mock.MagicMock()
+        inbox = mock.MagicMock()
+        inbox.return_value.open.return_value.__enter__.return_value = io.BytesIO(b'body')
+        data = {'filepath': 'infile.in', 'user': 'user_id@elixir-europe.org'}
+        result = work(store, inbox, mock.MagicMock(), ['sha256'], None, True, Throttle(), False, data)
+        self.assertEqual(None, result)
+        self.assertEqual('DISABLED', files[12]['status'])
+        store.copy.assert_not_called()
+        self.assertEqual((32, 'vault/12'), mock_db.set_archived.call_args[0][:2])
+
+    @mock.patch('lega.ingest.get_header')
+    @mock.patch('lega.ingest.db')
+    def test_work_duplicate_different_body(self, mock_db, mock_header):
+        """Test ingest worker, should copy the file if only the header and size are the same."""
+        mock_header.return_value = b'beginning', b'header'
+        mock_db.get_checkpoint.return_value = None
+        mock_db.insert_file.return_value = 32
+        mock_db.get_duplicate.return_value = (12, 'vault/12', hashlib.sha256(b'BODY').hexdigest(), 'SHA256', 'digest', None)
+        store = mock.MagicMock()
+        store.copy.side_effect = lambda body, location, **kwargs: len(body.read())
+        inbox = mock.MagicMock()
+        inbox.return_value.open.return_value.__enter__.return_value = io.BytesIO(b'body')
+        data = {'filepath': 'infile.in', 'user': 'user_id@elixir-europe.org'}
+        result = work(store, inbox, mock.MagicMock(), ['sha256'], None, True, Throttle(), False, data)
+        self.assertEqual(hashlib.sha256(b'body').hexdigest(), result['vault_checksums'][0]['value'])
+        store.copy.assert_called()
+
     @tempdir()
     @mock.patch('lega.ingest.get_header')
     @mock.patch('lega.ingest.db')
@@ -53,6 +278,7 @@ class testIngest(unittest.TestCase):
         """Test ingest worker, insert_file fails."""
         # Mocking a lot of stuff, as it is previously tested
         mock_header.return_value = b'beginning', b'header'
+        mock_db.get_checkpoint.return_value = None
         mock_db.insert_file.side_effect = Exception("Some strange exception")
 
         store = mock.MagicMock()
@@ -71,11 +297,12 @@ class testIngest(unittest.TestCase):
     @mock.patch('lega.ingest.get_header')
     @mock.patch('lega.ingest.db')
     @mock.patch('lega.utils.db.set_error')
-    def test_mark_in_progress_fail(self, mock_set_error, mock_db, mock_header, filedir):
-        """Test ingest worker, mark_in_progress fails."""
+    def test_set_archived_fail(self, mock_set_error, mock_db, mock_header, filedir):
+        """Test ingest worker, set_archived fails."""
         # Mocking a lot of stuff, as it is previously tested
         mock_header.return_value = b'beginning', b'header'
-        mock_db.mark_in_progress.side_effect = Exception("Some strange exception")
+        mock_db.get_checkpoint.return_value = None
+        mock_db.set_archived.side_effect = Exception("Some strange exception")
 
         store = mock.MagicMock()
         store.location.return_value = 'smth'
@@ -85,7 +312,7 @@ class testIngest(unittest.TestCase):
         infile = filedir.write('infile.in', bytearray.fromhex(pgp_data.ENC_FILE))
 
         data = {'filepath': infile, 'user': 'user_id@elixir-europe.org'}
-        result = work(store, store, mock_broker, data)
+        result = work(store, store, mock_broker, ['sha256'], None, False, Throttle(), False, data)
         self.assertEqual(None, result)
         mock_set_error.assert_called()
         filedir.cleanup()
@@ -96,11 +323,12 @@ class testIngest(unittest.TestCase):
     @mock.patch('lega.utils.db.set_error')
     @mock.patch('lega.utils.db.get_connection')
     @mock.patch('lega.utils.db.publish')
-    def test_mark_in_progress_fail_with_from_user_error(self, mock_publish, mock_get_connection, mock_set_error, mock_db, mock_header, filedir):
-        """Test ingest worker, mark_in_progress fails."""
+    def test_set_archived_fail_with_from_user_error(self, mock_publish, mock_get_connection, mock_set_error, mock_db, mock_header, filedir):
+        """Test ingest worker, set_archived fails."""
         # Mocking a lot of stuff, as it is previously tested
         mock_header.return_value = b'beginning', b'header'
-        mock_db.mark_in_progress.side_effect = FromUser()
+        mock_db.get_checkpoint.return_value = None
+        mock_db.set_archived.side_effect = FromUser()
 
         store = mock.MagicMock()
         store.location.return_value = 'smth'
@@ -110,7 +338,7 @@ class testIngest(unittest.TestCase):
         infile = filedir.write('infile.in', bytearray.fromhex(pgp_data.ENC_FILE))
 
         data = {'filepath': infile, 'user': 'user_id@elixir-europe.org'}
-        result = work(store, store, mock_broker, data)
+        result = work(store, store, mock_broker, ['sha256'], None, False, Throttle(), False, data)
         self.assertEqual(None, result)
         mock_set_error.assert_called()
         mock_publish.assert_called()
@@ -0,0 +1,48 @@
+import unittest
+from lega.utils.metrics import Registry, Counter, Gauge, Histogram
+
+
+class TestMetrics(unittest.TestCase):
+    """Metrics.
+
+    Testing the counters, histograms and the Prometheus text format.
+    """
+
+    def test_counter(self):
+        """Test inc, should count by label values."""
+        counter = Counter('requests_total', 'Requests.', ('route', 'status'))
+        counter.inc('/health', '200')
+        counter.inc('/health', '200', amount=2)
+        counter.inc('/metrics', '200')
+        self.assertEqual(3, counter.get('/health', '200'))
+        self.assertEqual(0, counter.get('/health', '500'))
+        self.assertIn(('requests_total', {'route': '/metrics', 'status': '200'}, 1), counter.samples())
+
+    def test_histogram(self):
+        """Test observe, should return cumulative buckets, the sum and the count."""
+        histogram = Histogram('duration_seconds', 'Durations.', buckets=(0.1, 1))
+        for value in (0.05, 0.1, 0.5, 3):
+            histogram.observe(value)
+        samples = {(name, labels.get('le')): value for name, labels, value in histogram.samples()}
+        self.assertEqual({('duration_seconds_bucket', '0.1'): 2,
+                          ('duration_seconds_bucket', '1'): 3,
+                          ('duration_seconds_bucket', '+Inf'): 4,
+                          ('duration_seconds_sum', None): 3.65,
+                          ('duration_seconds_count', None): 4}, samples)
+
+    def test_render(self):
+        """Test render, should write the help, type and samples, with the constant labels and the escaped values."""
+        registry = Registry()
+        registry.register(Counter('requests_total', 'Requests.', ('route',))).inc('/a"b')
+        registry.register(Gauge('keys', 'Keys.', lambda: 3))
+        registry.constant_labels['pid'] = '42'
+        self.assertEqual('# HELP requests_total Requests.\n'
+                         '# TYPE requests_total counter\n'
+                         'requests_total{pid="42",route="/a\\"b"} 1.0\n'
+                         '# HELP keys Keys.\n'
+                         '# TYPE keys gauge\n'
+                         'keys{pid="42"} 3.0\n', registry.render())
+
+
+if __name__ == '__main__':
+    unittest.main()
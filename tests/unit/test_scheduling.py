@@ -0,0 +1,96 @@
+import unittest
+from unittest import mock
+import io
+import threading
+from lega.utils.scheduling import FairExecutor, FairQueue, TokenBucket, Throttle, parse_weights
+
+
+class TestFairQueue(unittest.TestCase):
+    """FairQueue.
+
+    Testing the fair dispatch between keys.
+    """
+
+    def test_round_robin(self):
+        """Test get, a key with one item should not wait behind a key with many."""
+        queue = FairQueue()
+        for i in range(5):
+            queue.put('bulk', i)
+        self.assertEqual(0, queue.get())
+        queue.put('interactive', 'a')
+        self.assertEqual('a', queue.get())
+        self.assertEqual([1, 2, 3, 4], [queue.get() for _ in range(4)])
+        self.assertEqual(0, len(queue))
+
+    def test_weights(self):
+        """Test get, a key with twice the weight should get twice the dispatches."""
+        queue = FairQueue(weights={'alice': 2})
+        for i in range(6):
+            queue.put('alice', 'alice')
+            queue.put('bob', 'bob')
+        first = [queue.get() for _ in range(6)]
+        self.assertEqual(4, first.count('alice'))
+
+    def test_empty(self):
+        """Test get on an empty queue, should raise IndexError."""
+        with self.assertRaises(IndexError):
+            FairQueue().get()
+
+    def test_shutdown(self):
+        """Shutting the executor down should wait for the running call, and drop the ones not started yet."""
+        executor = FairExecutor(1, key=lambda user: user)
+        started, release = threading.Event(), threading.Event()
+        done = []
+
+        def run(user):
+            started.set()
+            release.wait(5)
+            done.append(user)
+
+        executor.submit(run, 'john')
+        started.wait(5)
+        executor.submit(run, 'jane')
+        executor.submit(run, 'john')
+        threading.Timer(0.1, release.set).start()
+        executor.shutdown(wait=True)
+        self.assertEqual(['john'], done)
+        self.assertEqual(0, len(executor.queue))
+
+    def test_parse_weights(self):
+        """Test parse_weights, should read key:weight pairs."""
+        self.assertEqual({'alice': 2.0, 'bob': 0.5}, parse_weights('alice:2, bob:0.5'))
+        self.assertEqual({}, parse_weights(''))
+
+
+class TestThrottle(unittest.TestCase):
+    """Throttle.
+
+    Testing the bandwidth limits.
+    """
+
+    @mock.patch('lega.utils.scheduling.sleep')
+    @mock.patch('lega.utils.scheduling.monotonic')
+    def test_token_bucket(self, mock_monotonic, mock_sleep):
+        """Test consume, should sleep when the rate is exceeded."""
+        mock_monotonic.return_value = 10
+        bucket = TokenBucket(100)
+        bucket.consume(100)
+        mock_sleep.assert_not_called()
+        bucket.consume(50)
+        mock_sleep.assert_called_with(0.5)
+
+    def test_unlimited(self):
+        """Test wrap without limits, should return the file object itself."""
+        fileobj = io.BytesIO(b'data')
+        self.assertIs(fileobj, Throttle().wrap(fileobj, 'user'))
+
+    @mock.patch('lega.utils.scheduling.sleep')
+    def test_wrap(self, mock_sleep):
+        """Test wrap with limits, should share the user bucket and read through."""
+        throttle = Throttle(user_rate=1000, worker_rate=1000)
+        reader = throttle.wrap(io.BytesIO(b'data'), 'user')
+        self.assertEqual(2, len(reader.buckets))
+        self.assertIs(reader.buckets[0], throttle.wrap(io.BytesIO(), 'user').buckets[0])
+        buf = bytearray(2)
+        self.assertEqual(2, reader.readinto(buf))
+        self.assertEqual(b'ta', reader.read())
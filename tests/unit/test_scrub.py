@@ -0,0 +1,105 @@
+import unittest
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
+from legacryptor.exceptions import MDCError
+from lega.scrub import main, scrub_file, check, scrub_pass
+from lega.utils.exceptions import VaultCorruption, KeyserverError
+from lega.utils.scheduling import Throttle
+from lega.utils.storage import S3FileReader
+from . import pgp_data
+
+
+CONTENT = b'original content'
+
+
+def decrypt(record, infile, process_output=None, chunk_size=None, workers=1):
+    """Pass the original content, and return its sha256 digest."""
+    if process_output:
+        process_output(CONTENT)
+    return hashlib.sha256(CONTENT).digest()
+
+
+class testScrub(unittest.TestCase):
+    """Scrub.
+
+    Testing the vault scrubber.
+    """
+
+    def setUp(self):
+        """Initialise fixtures."""
+        self.store = mock.MagicMock()
+        self.throttle = Throttle()
+
+    @mock.patch('lega.verify.body_decrypt')
+    @mock.patch('lega.scrub.get_records')
+    def test_scrub_file(self, mock_records, mock_decrypt):
+        """Test scrub_file with the recorded checksum, should not raise."""
+        mock_records.return_value = ['record'], 'key_id'
+        mock_decrypt.side_effect = decrypt
+        scrub_file(self.store, self.throttle, 10, (1, 'path', pgp_data.ENC_FILE, hashlib.md5(CONTENT).hexdigest(), 'MD5'))
+        scrub_file(self.store, self.throttle, 10, (1, 'path', pgp_data.ENC_FILE, hashlib.sha256(CONTENT).hexdigest(), 'SHA256'))
+        self.store.open.assert_called_with('path', 'rb')
+
+    @mock.patch('lega.verify.body_decrypt')
+    @mock.patch('lega.scrub.get_records')
+    def test_scrub_file_mismatch(self, mock_records, mock_decrypt):
+        """Test scrub_file with another checksum, should raise VaultCorruption."""
+        mock_records.return_value = ['record'], 'key_id'
+        mock_decrypt.side_effect = decrypt
+        with self.assertRaises(VaultCorruption):
+            scrub_file(self.store, self.throttle, 10, (1, 'path', pgp_data.ENC_FILE, 'other', 'SHA256'))
+
+    @mock.patch('lega.scrub.db')
+    @mock.patch('lega.scrub.scrub_file')
+    def test_check(self, mock_scrub, mock_db):
+        """Test check, should flag the corrupted files only, and not the ones that could not be checked."""
+        row = (1, 'path', 'header', 'checksum', 'SHA256')
+        self.assertTrue(check(self.store, self.throttle, 10, row))
+        mock_scrub.side_effect = KeyserverError('down')
+        self.assertIsNone(check(self.store, self.throttle, 10, row))
+        mock_db.set_error.assert_not_called()
+        error = MDCError('Invalid MDC')
+        mock_scrub.side_effect = error
+        self.assertFalse(check(self.store, self.throttle, 10, row))
+        mock_db.set_error.assert_called_with(1, error)
+
+    @mock.patch('lega.scrub.db')
+    def test_check_missing_object(self, mock_db):
+        """Test check of a vault file missing from S3, should flag it as a missing file on disk is."""
+        error = Exception('An error occurred (404) when calling the HeadObject operation: Not Found')
+        error.response = {'Error': {'Code': '404'}}
+        s3 = mock.MagicMock()
+        s3.head_object.side_effect = error
+        store = mock.MagicMock()
+        store.open.side_effect = lambda path, mode: S3FileReader(s3, 'lega', path, mode)
+        with mock.patch('lega.scrub.get_records', return_value=(['record'], 'key_id')):
+            self.assertFalse(check(store, self.throttle, 10, (1, 'path', '00' * 20, 'checksum', 'SHA256')))
+        self.assertIsInstance(mock_db.set_error.call_args[0][1], FileNotFoundError)
+
+    @mock.patch('lega.scrub.db')
+    def test_scrub_pass(self, mock_db):
+        """Test scrub_pass, should continue from the recorded position, record it after each batch and start over at the end."""
+        mock_db.get_scrub_position.return_value = 2
+        mock_db.get_scrub_batch.side_effect = [[(3,), (4,)], [(7,)], []]
+        results = {3: True, 4: False, 7: None}
+        with ThreadPoolExecutor(max_workers=2) as pool:
+            counts = scrub_pass(lambda row: results[row[0]], pool, 'vault', 2)
+        self.assertEqual((1, 1, 1), counts)
+        self.assertEqual([mock.call(2, 2), mock.call(4, 2), mock.call(7, 2)], mock_db.get_scrub_batch.call_args_list)
+        self.assertEqual([mock.call('vault', 4), mock.call('vault', 7), mock.call('vault', 7, completed=True)],
+                         mock_db.set_scrub_position.call_args_list)
+
+    @mock.patch('lega.scrub.sleep')
+    @mock.patch('lega.scrub.scrub_pass')
+    @mock.patch('lega.scrub.getattr')
+    def test_main(self, mock_getattr, mock_pass, mock_sleep):
+        """Test main scrub, should run the passes."""
+        mock_sleep.side_effect = [None, KeyboardInterrupt]
+        with self.assertRaises(KeyboardInterrupt):
+            main()
+        self.assertEqual(2, mock_pass.call_count)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,8 +1,9 @@
 import unittest
-from lega.utils.storage import FileStorage, S3FileReader, S3Storage
+from lega.utils.storage import FileStorage, S3FileReader, S3Storage, MappedFile, _direct_copy, _ALIGN
 from test.support import EnvironmentVarGuard
 from testfixtures import TempDirectory
 import os
+import io
 from io import UnsupportedOperation, BufferedReader
 from unittest import mock
 import boto3
@@ -39,6 +40,126 @@ class TestFileStorage(unittest.TestCase):
         result = self._store.copy(open(path, 'rb'), path1)
         self.assertEqual(os.stat(path1).st_size, result)
 
+    def test_copy_zero_copy(self):
+        """Test copy file in zero-copy mode, should copy the rest of the file from the current position."""
+        path = self._dir.write('output/lega/test.file', b'header' + b'data1' * 1000)
+        path1 = self._dir.getpath('output/lega/test1.file')
+        self._store.zero_copy = True
+        with open(path, 'rb') as f:
+            f.read(6)  # the reader buffers more than that
+            result = self._store.copy(f, path1)
+            self.assertEqual(f.read(), b'')
+        self.assertEqual(5000, result)
+        with open(path1, 'rb') as f:
+            self.assertEqual(b'data1' * 1000, f.read())
+
+    @mock.patch('lega.utils.storage.os.copy_file_range', side_effect=OSError(18, 'Invalid cross-device link'), create=True)
+    def test_copy_zero_copy_sendfile(self, mock_copy_file_range):
+        """Test copy file in zero-copy mode, should fall back to sendfile."""
+        path = self._dir.write('output/lega/test.file', b'data1' * 1000)
+        path1 = self._dir.getpath('output/lega/test1.file')
+        self._store.zero_copy = True
+        with open(path, 'rb') as f:
+            result = self._store.copy(f, path1)
+        self.assertEqual(5000, result)
+        with open(path1, 'rb') as f:
+            self.assertEqual(b'data1' * 1000, f.read())
+
+    def test_copy_buffered(self):
+        """Test copy file through a small reusable buffer."""
+        path = self._dir.write('output/lega/test.file', b'data1' * 1000)
+        path1 = self._dir.getpath('output/lega/test1.file')
+        self._store.bufsize = 7
+        with open(path, 'rb') as f:
+            result = self._store.copy(f, path1)
+        self.assertEqual(5000, result)
+        with open(path1, 'rb') as f:
+            self.assertEqual(b'data1' * 1000, f.read())
+
+    def test_copy_preallocate(self):
+        """Test copy file with preallocation, should cut the extra space of a wrong size hint."""
+        path = self._dir.write('output/lega/test.file', b'data1' * 1000)
+        path1 = self._dir.getpath('output/lega/test1.file')
+        self._store.preallocate = True
+        with open(path, 'rb') as f:
+            self.assertEqual(5000, self._store.copy(f, path1, size=8000))
+        self.assertEqual(5000, os.stat(path1).st_size)
+
+    def test_copy_direct(self):
+        """Test copy file in direct mode, should write the unaligned tail too."""
+        path = self._dir.write('output/lega/test.file', b'data1' * 2000)
+        path1 = self._dir.getpath('output/lega/test1.file')
+        self._store.write_mode = 'direct'
+        self._store.bufsize = 8192
+        with open(path, 'rb') as f:
+            self.assertEqual(10000, self._store.copy(f, path1))
+        with open(path1, 'rb') as f:
+            self.assertEqual(b'data1' * 2000, f.read())
+
+    @mock.patch('lega.utils.storage._set_direct')
+    def test_direct_copy_short_writes(self, mock_set_direct):
+        """Test the direct copy to a file writing less than asked, should write the rest."""
+        class ShortWriter(io.BytesIO):
+            name = 'short'
+
+            def fileno(self):
+                return -1
+
+            def write(self, b):
+                return super().write(bytes(b[:_ALIGN]))  # one block at a time
+        h = ShortWriter()
+        _direct_copy(io.BytesIO(b'data1' * 2000), h, 8192, mock.MagicMock())
+        self.assertEqual(b'data1' * 2000, h.getvalue())
+        h.write = mock.MagicMock(return_value=0)  # nothing written
+        with self.assertRaises(OSError):
+            _direct_copy(io.BytesIO(b'data1' * 2000), h, 8192, mock.MagicMock())
+
+    @mock.patch('lega.utils.storage.os.posix_fadvise')
+    def test_copy_dontneed(self, mock_fadvise):
+        """Test copy file in dontneed mode, should evict the written pages from the page cache."""
+        path = self._dir.write('output/lega/test.file', b'data1' * 1000)
+        path1 = self._dir.getpath('output/lega/test1.file')
+        self._store.write_mode = 'dontneed'
+        self._store.bufsize = 1000
+        self._store.checkpoint_interval = 2000
+        with open(path, 'rb') as f:
+            self._store.copy(f, path1)
+        self.assertEqual(3, mock_fadvise.call_count)  # twice every 2000 bytes, and the whole file at the end
+
+    def test_copy_checkpoint(self):
+        """Test copy file, should checkpoint the bytes written every checkpoint_interval."""
+        path = self._dir.write('output/lega/test.file', b'data1' * 1000)
+        path1 = self._dir.getpath('output/lega/test1.file')
+        self._store.bufsize = 1000
+        self._store.checkpoint_interval = 2000
+        checkpoint = mock.MagicMock()
+        with open(path, 'rb') as f:
+            self._store.copy(f, path1, checkpoint=checkpoint)
+        self.assertEqual([mock.call({'size': 2000}), mock.call({'size': 4000})], checkpoint.call_args_list)
+
+    def test_copy_resume(self):
+        """Test copy file, should continue after the checkpointed size, dropping what was written after it."""
+        path = self._dir.write('output/lega/test.file', b'data1' * 1000)
+        path1 = self._dir.write('output/lega/test1.file', b'data1' * 10 + b'garbage')
+        self.assertTrue(self._store.resumable(path1, {'size': 50}))
+        with open(path, 'rb') as f:
+            f.seek(50)
+            result = self._store.copy(f, path1, resume={'size': 50})
+        self.assertEqual(5000, result)
+        with open(path1, 'rb') as f:
+            self.assertEqual(b'data1' * 1000, f.read())
+
+    def test_resumable_missing(self):
+        """Test resumable, should be false when the partial file is gone."""
+        self.assertFalse(self._store.resumable(self._dir.getpath('output/lega/missing'), {'size': 50}))
+
+    def test_abandon(self):
+        """Test abandon, should remove the partial file, if still there."""
+        path = self._dir.write('output/lega/test.file', b'data1')
+        self._store.abandon(path, {'size': 5})
+        self.assertFalse(os.path.exists(path))
+        self._store.abandon(path, {'size': 5})
+
     def test_open(self):
         """Test open file."""
         path = self._dir.write('output/lega/test.file', 'data1'.encode('utf-8'))
@@ -46,6 +167,44 @@ class TestFileStorage(unittest.TestCase):
         with self._store.open('test.file') as resource:
             self.assertEqual(BufferedReader, type(resource))
 
+    def test_open_mapped(self):
+        """Test open with mmap_reads, should return slices of the mapped file."""
+        self._dir.write('output/lega/test.file', b'data1')
+        self._store.mmap_reads = True
+        with self._store.open('test.file') as resource:
+            self.assertEqual(MappedFile, type(resource))
+            data = resource.read(4)
+            self.assertIsInstance(data, memoryview)
+            self.assertEqual(b'data', data)
+        with self._store.open('test.file', 'r+b') as resource:
+            self.assertNotEqual(MappedFile, type(resource))
+
+    def test_mapped_file(self):
+        """Test MappedFile, should read, read into, seek, and close even with slices in use."""
+        path = self._dir.write('mapped.file', bytes(range(100)))
+        f = MappedFile(path)
+        self.assertEqual(bytes(range(10)), f.read(10))
+        buf = bytearray(5)
+        self.assertEqual(5, f.readinto(buf))
+        self.assertEqual(bytes(range(10, 15)), buf)
+        self.assertEqual(95, f.seek(-5, 2))
+        self.assertEqual(bytes(range(95, 100)), f.read())
+        self.assertEqual(b'', f.read(10))
+        self.assertEqual(0, f.readinto(buf))
+        f.seek(0)
+        data = f.read(3)
+        f.close()  # the slice is still in use
+        self.assertEqual(b'\x00\x01\x02', data)
+        with self.assertRaises(ValueError):
+            f.read()
+        data.release()
+
+    def test_mapped_file_empty(self):
+        """Test MappedFile on an empty file, should read nothing."""
+        path = self._dir.write('empty.file', b'')
+        with MappedFile(path) as f:
+            self.assertEqual(b'', f.read())
+
 
 class TestS3Storage(unittest.TestCase):
     """S3Storage.
@@ -87,13 +246,103 @@ class TestS3Storage(unittest.TestCase):
     @mock.patch.object(boto3, 'client')
     def test_upload(self, mock_boto):
         """Test copy to S3, should call boto3 client."""
-        path = self._dir.write('test.file', 'data1'.encode('utf-8'))
         storage = S3Storage('vault', 'lega')
-        storage.copy(path, 'lega')
+        storage.copy(io.BytesIO(b'data1'), 'lega')
         mock_boto.assert_called_with('s3', aws_access_key_id='test', aws_secret_access_key='test',
                                      endpoint_url='http://localhost:5000', region_name='lega',
                                      use_ssl=False, verify=False)
 
+    @mock.patch.object(boto3, 'client')
+    def test_upload_size(self, mock_boto):
+        """Test copy to S3 of a small file, should be uploaded in one request and return the number of bytes uploaded."""
+        storage = S3Storage('vault', 'lega')
+        self.assertEqual(5, storage.copy(io.BytesIO(b'data1'), 'lega'))
+        mock_boto.return_value.put_object.assert_called_with(Bucket='lega', Key='lega', Body=b'data1')
+        mock_boto.return_value.head_object.assert_not_called()
+
+    @mock.patch.object(boto3, 'client')
+    def test_upload_multipart(self, mock_boto):
+        """Test copy to S3 of a large file, should upload the parts and complete the multipart upload."""
+        client = mock_boto.return_value
+        client.create_multipart_upload.return_value = {'UploadId': 'upload'}
+        client.upload_part.side_effect = lambda **kwargs: {'ETag': kwargs['Body']}
+        storage = S3Storage('vault', 'lega')
+        storage.part_size = 2
+        self.assertEqual(5, storage.copy(io.BytesIO(b'data1'), 'lega'))
+        parts = [{'PartNumber': 1, 'ETag': b'da'}, {'PartNumber': 2, 'ETag': b'ta'}, {'PartNumber': 3, 'ETag': b'1'}]
+        client.complete_multipart_upload.assert_called_with(Bucket='lega', Key='lega', UploadId='upload',
+                                                            MultipartUpload={'Parts': parts})
+
+    @mock.patch.object(boto3, 'client')
+    def test_upload_part_size(self, mock_boto):
+        """Test copy to S3 of a file too large for the part size, should use larger parts."""
+        client = mock_boto.return_value
+        client.create_multipart_upload.return_value = {'UploadId': 'upload'}
+        client.upload_part.side_effect = lambda **kwargs: {'ETag': kwargs['Body']}
+        storage = S3Storage('vault', 'lega')
+        storage.part_size = 1
+        with mock.patch('lega.utils.storage._MAX_PARTS', 2):
+            storage.copy(io.BytesIO(b'data1'), 'lega', size=5)
+        self.assertEqual(2, client.upload_part.call_count)
+
+    @mock.patch.object(boto3, 'client')
+    def test_upload_multipart_checkpoint(self, mock_boto):
+        """Test copy to S3 of a large file, should checkpoint the upload id and the uploaded parts."""
+        client = mock_boto.return_value
+        client.create_multipart_upload.return_value = {'UploadId': 'upload'}
+        client.upload_part.side_effect = lambda **kwargs: {'ETag': kwargs['Body']}
+        storage = S3Storage('vault', 'lega')
+        storage.part_size = 2
+        checkpoint = mock.MagicMock()
+        storage.copy(io.BytesIO(b'data1'), 'lega', checkpoint=checkpoint)
+        self.assertEqual({'upload_id': 'upload', 'part_size': 2, 'parts': [], 'size': 0}, checkpoint.call_args_list[0][0][0])
+        for (state,), _ in checkpoint.call_args_list:
+            self.assertEqual(min(2 * len(state['parts']), 5), state['size'])
+
+    @mock.patch.object(boto3, 'client')
+    def test_upload_multipart_resume(self, mock_boto):
+        """Test copy to S3, resuming a multipart upload should only upload the remaining parts."""
+        client = mock_boto.return_value
+        client.upload_part.side_effect = lambda **kwargs: {'ETag': kwargs['Body']}
+        storage = S3Storage('vault', 'lega')
+        fileobj = io.BytesIO(b'data1')
+        fileobj.seek(2)
+        state = {'upload_id': 'upload', 'part_size': 2, 'parts': [{'PartNumber': 1, 'ETag': b'da'}], 'size': 2}
+        self.assertTrue(storage.resumable('lega', state))
+        self.assertEqual(5, storage.copy(fileobj, 'lega', resume=state))
+        client.create_multipart_upload.assert_not_called()
+        self.assertEqual(2, client.upload_part.call_count)
+        parts = [{'PartNumber': 1, 'ETag': b'da'}, {'PartNumber': 2, 'ETag': b'ta'}, {'PartNumber': 3, 'ETag': b'1'}]
+        client.complete_multipart_upload.assert_called_with(Bucket='lega', Key='lega', UploadId='upload',
+                                                            MultipartUpload={'Parts': parts})
+
+    @mock.patch.object(boto3, 'client')
+    def test_abandon(self, mock_boto):
+        """Test abandon, should abort the checkpointed multipart upload and remove the object."""
+        client = mock_boto.return_value
+        client.abort_multipart_upload.side_effect = Exception('NoSuchUpload')
+        storage = S3Storage('vault', 'lega')
+        storage.abandon('lega', {'upload_id': 'upload', 'part_size': 2, 'parts': [], 'size': 0})
+        client.abort_multipart_upload.assert_called_with(Bucket='lega', Key='lega', UploadId='upload')
+        client.delete_object.assert_called_with(Bucket='lega', Key='lega')
+
+    @mock.patch('lega.utils.storage.sleep')
+    @mock.patch.object(boto3, 'client')
+    def test_upload_multipart_error(self, mock_boto, mock_sleep):
+        """Test copy to S3, failing part upload should be retried and the multipart upload aborted."""
+        client = mock_boto.return_value
+        client.create_multipart_upload.return_value = {'UploadId': 'upload'}
+        client.upload_part.side_effect = Exception('Some S3 error')
+        storage = S3Storage('vault', 'lega')
+        storage.part_size = 2
+        storage.concurrency = 1
+        storage.retries = 2
+        with self.assertRaises(Exception):
+            storage.copy(io.BytesIO(b'data1'), 'lega')
+        client.abort_multipart_upload.assert_called_with(Bucket='lega', Key='lega', UploadId='upload')
+        client.complete_multipart_upload.assert_not_called()
+        self.assertEqual(2, mock_sleep.call_count)
+
     @mock.patch.object(boto3, 'client')
     def test_open(self, mock_boto):
         """Test open , should call S3FileReader."""
@@ -184,6 +433,35 @@ class TestS3FileReader(unittest.TestCase):
         data = []
         self.assertEqual(0, self._reader.readinto(data))
 
+    def test_readinto_data(self):
+        """Test readinto, should write into the buffer and return the number of bytes read, even at the end."""
+        data = bytes(range(100))
+        for readahead in (0, 2):
+            reader = self._readahead_reader(data, 30, readahead)
+            reader.seek(90)
+            buf = bytearray(16)
+            self.assertEqual(10, reader.readinto(buf))
+            self.assertEqual(data[90:], buf[:10])
+            self.assertEqual(0, reader.readinto(buf))
+            reader.seek(20)
+            self.assertEqual(16, reader.readinto(memoryview(buf)))
+            self.assertEqual(data[20:36], buf)
+            reader.close()
+
+    def test_buffered(self):
+        """Test wrapping the reader in io.BufferedReader, should read through readinto."""
+        data = bytes(range(100))
+        buffered = io.BufferedReader(self._readahead_reader(data, 30, 0), buffer_size=8)
+        self.assertEqual(data[:50], buffered.read(50))
+        self.assertEqual(data[50:], buffered.read())
+
+    def test_readinto_no_readinto(self):
+        """Test readinto with a response body without readinto, should read it."""
+        self._s3.get_object.return_value = {'Body': mock.Mock(spec=['read'], **{'read.return_value': b'abc'})}
+        buf = bytearray(5)
+        self.assertEqual(3, self._reader.readinto(buf))
+        self.assertEqual(b'abc', buf[:3])
+
     def test_readinto1(self):
         """Test readinto1."""
         self._reader.readinto = mock.Mock()
@@ -196,6 +474,57 @@ class TestS3FileReader(unittest.TestCase):
         self._reader._fetch(1, 9, max_attempts=1)
         self._s3.get_object.assert_called()
 
+    def test_missing(self):
+        """Test a missing object, should raise FileNotFoundError, as a missing file."""
+        error = Exception('An error occurred (404) when calling the HeadObject operation: Not Found')
+        error.response = {'Error': {'Code': '404', 'Message': 'Not Found'}}
+        self._s3.head_object.side_effect = error
+        with self.assertRaises(FileNotFoundError):
+            S3FileReader(self._s3, 'lega', '/path', 'rb', 10)
+        error.response = {'Error': {'Code': 'NoSuchKey'}}  # deleted after being opened
+        self._s3.get_object.side_effect = error
+        self._reader.size = 10
+        with self.assertRaises(FileNotFoundError):
+            self._reader._fetch(1, 9, max_attempts=1)
+
+    def _readahead_reader(self, data, blocksize, readahead):
+        """Return a reader of ``data``, served by ranges."""
+        def get_object(Bucket, Key, Range):
+            start, end = map(int, Range[len('bytes='):].split('-'))
+            return {'Body': io.BytesIO(data[start:end + 1])}
+        self._s3.head_object.return_value = {'ContentLength': len(data)}
+        self._s3.get_object.side_effect = get_object
+        return S3FileReader(self._s3, 'lega', '/path', 'rb', blocksize, readahead)
+
+    def test_readahead(self):
+        """Test read with readahead, should fetch whole blocks, ahead, and read across them."""
+        data = bytes(range(100))
+        reader = self._readahead_reader(data, 10, 3)
+        self.assertEqual(data[:4], reader.read(4))
+        self.assertEqual([1, 2, 3], [i for i, _ in reader.blocks])
+        self.assertEqual(data[4:27], reader.read(23))
+        self.assertEqual([3, 4, 5], [i for i, _ in reader.blocks])
+        self.assertEqual(data[27:], reader.read())
+        self.assertEqual(b'', reader.read())
+        self.assertEqual(10, self._s3.get_object.call_count)
+        reader.close()
+
+    def test_readahead_seek(self):
+        """Test seek outside the blocks fetched ahead, should cancel them."""
+        data = bytes(range(100))
+        reader = self._readahead_reader(data, 10, 2)
+        reader.read(5)
+        reader.seek(8)
+        self.assertEqual([1, 2], [i for i, _ in reader.blocks])
+        reader.seek(75)
+        self.assertEqual([], list(reader.blocks))
+        self.assertEqual(data[75:90], reader.read(15))
+        reader.seek(2)
+        self.assertEqual(data[2:4], reader.read(2))
+        reader.close()
+        self.assertEqual([], list(reader.blocks))
+        self.assertIsNone(reader.current)
+
     def test_close(self):
         """Testing close of the file reader."""
         self._reader.close()
@@ -1,47 +1,23 @@
 import unittest
-from lega.verify import main, get_records, work
+import hashlib
+import json
+import os
+from lega.verify import main, get_records, work, invalidate_keys, keyserver_stats, _keyserver_pool, _log_keyserver_stats
 from unittest import mock
 from test.support import EnvironmentVarGuard
 from testfixtures import tempdir, TempDirectory
 from . import pgp_data
-import io
-from urllib.error import HTTPError
 from lega.utils.exceptions import PGPKeyError, KeyserverError
 
 
-class PatchContextManager:
-    """Patch Context Manger.
-
-    Following: https://stackoverflow.com/a/32127557 example.
-    """
-
-    def __init__(self, method, enter_return, exit_return=False):
-        """Init for class."""
-        self._patched = mock.patch(method)
-        self._enter_return = enter_return
-        self._exit_return = exit_return
-
-    def __enter__(self):
-        """Define enter function."""
-        res = self._patched.__enter__()
-        res.context = mock.MagicMock()
-        res.context.__enter__.return_value = self._enter_return
-        res.context.__exit__.return_value = self._exit_return
-        res.return_value = res.context
-        return res
-
-    def __exit__(self, type, value, tb):
-        """Define exit function."""
-        return self._patched.__exit__()
-
-
 class KeyServerResponse:
     """Mock keyserver Reponse."""
 
-    def __init__(self, status, response):
+    def __init__(self, status, response, reason='OK'):
         """Init for class."""
         self.status = status
         self.response = response
+        self.reason = reason
 
     def status(self):
         """Return response status."""
@@ -65,7 +41,7 @@ class testVerify(unittest.TestCase):
         self.outputdir = self._dir.makedir('output')
         self.env = EnvironmentVarGuard()
         self.env.set('VAULT_LOCATION', self.outputdir + '/%s/')
-        self.env.set('LEGA_PASSWORD', 'value')
+        self.env.set('LEGA_PASSWORD', pgp_data.PGP_PASSPHRASE)
         self.env.set('QUALITY_CONTROL_VERIFY_CERTIFICATE', 'True')
 
     def tearDown(self):
@@ -74,73 +50,158 @@ class testVerify(unittest.TestCase):
         self._dir.cleanup_all()
         self.env.unset('LEGA_PASSWORD')
         self.env.unset('QUALITY_CONTROL_VERIFY_CERTIFICATE')
+        invalidate_keys()
 
     @tempdir()
-    @mock.patch('lega.verify.header_to_records')
+    @mock.patch('lega.verify.decrypt_header')
     @mock.patch('lega.verify.get_key_id')
-    def test_get_records(self, mock_key, mock_records, filedir):
+    @mock.patch('lega.verify._keyserver_pool')
+    def test_get_records(self, mock_pool, mock_key, mock_records, filedir):
         """Should call the url in order to provide the records."""
         infile = filedir.write('infile.in', bytearray.fromhex(pgp_data.ENC_FILE))
-        returned_data = KeyServerResponse(200, io.BytesIO(pgp_data.PGP_PRIVKEY.encode()))
-        with PatchContextManager('lega.verify.urlopen', returned_data) as mocked:
-            print(returned_data.status)
-            with open(infile, 'rb') as f:
-                get_records(f)
-            mocked.assert_called()
+        mock_pool.return_value.get.return_value = (KeyServerResponse(200, None), pgp_data.PGP_PRIVKEY.encode())
+        with open(infile, 'rb') as f:
+            get_records(f)
+        mock_pool.return_value.get.assert_called()
+        mock_records.assert_called()
+        filedir.cleanup()
+
+    @tempdir()
+    @mock.patch('lega.verify.decrypt_header')
+    @mock.patch('lega.verify.get_key_id')
+    @mock.patch('lega.verify._keyserver_pool')
+    def test_get_records_cached(self, mock_pool, mock_key, mock_records, filedir):
+        """Should retrieve and unlock the key once, and reuse it until invalidated."""
+        infile = filedir.write('infile.in', bytearray.fromhex(pgp_data.ENC_FILE))
+        mock_pool.return_value.get.return_value = (KeyServerResponse(200, None), pgp_data.PGP_PRIVKEY.encode())
+        with open(infile, 'rb') as f:
+            get_records(f)
+            get_records(f)
+        self.assertEqual(1, mock_pool.return_value.get.call_count)
+        self.assertIs(mock_records.call_args_list[0][0][0], mock_records.call_args_list[1][0][0])
+        invalidate_keys(mock_key.return_value)
+        with open(infile, 'rb') as f:
+            get_records(f)
+        self.assertEqual(2, mock_pool.return_value.get.call_count)
         filedir.cleanup()
 
     @tempdir()
-    @mock.patch('lega.verify.header_to_records')
+    @mock.patch('lega.verify.decrypt_header')
     @mock.patch('lega.verify.get_key_id')
-    def test_get_records_no_verify(self, mock_key, mock_records, filedir):
-        """Should call the url in order to provide the records even without a verify turned off."""
-        self.env.set('QUALITY_CONTROL_VERIFY_CERTIFICATE', 'False')
+    @mock.patch('lega.verify._keyserver_pool')
+    def test_get_records_empty(self, mock_pool, mock_key, mock_records, filedir):
+        """The keyserver returned an empty payload, should raise PGPKeyError error."""
         infile = filedir.write('infile.in', bytearray.fromhex(pgp_data.ENC_FILE))
-        returned_data = KeyServerResponse(200, io.BytesIO(pgp_data.PGP_PRIVKEY.encode()))
-        with PatchContextManager('lega.verify.urlopen', returned_data) as mocked:
+        mock_pool.return_value.get.return_value = (KeyServerResponse(200, None), b'')
+        with self.assertRaises(PGPKeyError):
             with open(infile, 'rb') as f:
                 get_records(f)
-            mocked.assert_called()
         filedir.cleanup()
 
     @tempdir()
-    @mock.patch('lega.verify.header_to_records')
+    @mock.patch('lega.verify.decrypt_header')
     @mock.patch('lega.verify.get_key_id')
-    def test_get_records_key_error(self, mock_key, mock_records, filedir):
+    @mock.patch('lega.verify._keyserver_pool')
+    def test_get_records_key_error(self, mock_pool, mock_key, mock_records, filedir):
         """The PGP key was not found, should raise PGPKeyError error."""
         infile = filedir.write('infile.in', bytearray.fromhex(pgp_data.ENC_FILE))
-        with mock.patch('lega.verify.urlopen') as urlopen_mock:
-            urlopen_mock.side_effect = HTTPError('url', 404, 'msg', None, None)
-            with self.assertRaises(PGPKeyError):
-                with open(infile, 'rb') as f:
-                    get_records(f)
+        mock_pool.return_value.get.return_value = (KeyServerResponse(404, None, 'Not Found'), b'')
+        with self.assertRaises(PGPKeyError):
+            with open(infile, 'rb') as f:
+                get_records(f)
         filedir.cleanup()
 
     @tempdir()
-    @mock.patch('lega.verify.header_to_records')
+    @mock.patch('lega.verify.decrypt_header')
     @mock.patch('lega.verify.get_key_id')
-    def test_get_records_server_error(self, mock_key, mock_records, filedir):
+    @mock.patch('lega.verify._keyserver_pool')
+    def test_get_records_server_error(self, mock_pool, mock_key, mock_records, filedir):
         """Some keyserver error occured, should raise KeyserverError error."""
         infile = filedir.write('infile.in', bytearray.fromhex(pgp_data.ENC_FILE))
-        with mock.patch('lega.verify.urlopen') as urlopen_mock:
-            urlopen_mock.side_effect = HTTPError('url', 400, 'msg', None, None)
-            with self.assertRaises(KeyserverError):
-                with open(infile, 'rb') as f:
-                    get_records(f)
+        mock_pool.return_value.get.return_value = (KeyServerResponse(400, None, 'Bad Request'), b'')
+        with self.assertRaises(KeyserverError):
+            with open(infile, 'rb') as f:
+                get_records(f)
         filedir.cleanup()
 
     @tempdir()
-    @mock.patch('lega.verify.header_to_records')
+    @mock.patch('lega.verify.decrypt_header')
     @mock.patch('lega.verify.get_key_id')
-    def test_get_records_error(self, mock_key, mock_records, filedir):
-        """Some general error occured, should raise Exception error."""
-        self.env.set('QUALITY_CONTROL_VERIFY_CERTIFICATE', 'False')
+    @mock.patch('lega.verify._keyserver_pool')
+    def test_get_records_error(self, mock_pool, mock_key, mock_records, filedir):
+        """The keyserver could not be reached, should raise KeyserverError error."""
         infile = filedir.write('infile.in', bytearray.fromhex(pgp_data.ENC_FILE))
-        with mock.patch('lega.verify.urlopen') as urlopen_mock:
-            urlopen_mock.side_effect = Exception
-            with self.assertRaises(Exception):
-                with open(infile, 'rb') as f:
-                    get_records(f)
+        mock_pool.return_value.get.side_effect = ConnectionRefusedError
+        with self.assertRaises(KeyserverError):
+            with open(infile, 'rb') as f:
+                get_records(f)
+        filedir.cleanup()
+
+    @mock.patch('lega.verify._keyserver_pool')
+    def test_get_records_remote(self, mock_pool):
+        """With a decrypt endpoint, should decrypt the header on the keyserver, and raise its errors."""
+        record = {'session_key': pgp_data.SESSION_KEY, 'iv': '00' * 16, 'plaintext_start': 0, 'plaintext_end': 10,
+                  'ciphertext_start': 32, 'ctr_offset': 0, 'method': 0}
+        payload = {'results': [{'key_id': pgp_data.KEY_ID, 'records': [record]}]}
+        mock_pool.return_value.post.return_value = (KeyServerResponse(200, None), json.dumps(payload).encode())
+        with mock.patch.dict(os.environ, {'QUALITY_CONTROL_DECRYPT_ENDPOINT': 'https://ega_keys:9000/decrypt'}):
+            records, key_id = get_records(b'header')
+            self.assertEqual(pgp_data.KEY_ID, key_id)
+            self.assertEqual(bytes.fromhex(pgp_data.SESSION_KEY), records[0].session_key)
+            self.assertEqual(json.dumps({'headers': ['686561646572']}).encode(), mock_pool.return_value.post.call_args[0][1])
+            payload = {'results': [{'key_id': pgp_data.KEY_ID, 'error': 'Key not found', 'type': 'PGPKeyError'}]}
+            mock_pool.return_value.post.return_value = (KeyServerResponse(200, None), json.dumps(payload).encode())
+            with self.assertRaises(PGPKeyError):
+                get_records(b'header')
+            mock_pool.return_value.post.return_value = (KeyServerResponse(500, None, 'Error'), b'')
+            with self.assertRaises(KeyserverError):
+                get_records(b'header')
+
+    @mock.patch.dict('lega.verify._keyservers', clear=True)
+    def test_keyserver_pool(self):
+        """Test the pools of connections, should be one per host, reused for all its URLs."""
+        pool = _keyserver_pool('https://keys:443/retrieve/%s/private')
+        self.assertIs(pool, _keyserver_pool('https://keys:443/decrypt'))
+        self.assertIsNot(pool, _keyserver_pool('https://decrypt:443/decrypt'))
+        self.assertEqual(2, len(keyserver_stats()))
+
+    @mock.patch('lega.verify.LOG')
+    @mock.patch('lega.verify.monotonic')
+    @mock.patch('lega.verify._stats_logged', None)
+    @mock.patch.dict('lega.verify._keyservers', {'https://keys:443': mock.Mock(**{'stats.return_value': {'requests': 3}})},
+                     clear=True)
+    def test_log_keyserver_stats(self, mock_monotonic, mock_log):
+        """Test the statistics of the keyserver connections, should be logged at most every interval."""
+        with mock.patch.dict(os.environ, {'QUALITY_CONTROL_KEYSERVER_STATS_INTERVAL': '300'}):
+            for now in (100, 200, 400, 500, 700):
+                mock_monotonic.return_value = now
+                _log_keyserver_stats()
+        mock_log.info.assert_called_with("Keyserver connections: {'https://keys:443': {'requests': 3}}")
+        self.assertEqual(2, mock_log.info.call_count)  # at 400 and 700
+
+    @tempdir()
+    @mock.patch('lega.verify.db')
+    @mock.patch('lega.verify.body_decrypt')
+    @mock.patch('lega.verify.get_records')
+    def test_work_checksums(self, mock_records, mock_decrypt, mock_db, filedir):
+        """Test verify worker with several checksums, should compute them in the decryption pass, record and send them all."""
+        content = b'original content' * 1000
+
+        def decrypt(record, infile, process_output=None, chunk_size=None, workers=1):
+            for i in range(0, len(content), 1000):
+                process_output(content[i:i + 1000])
+            return hashlib.sha256(content).digest()
+        mock_records.return_value = ['data'], 'key_id'
+        mock_decrypt.side_effect = decrypt
+        infile = filedir.write('infile.in', b'text')
+        data = {'header': pgp_data.ENC_FILE, 'stable_id': '1', 'vault_path': infile, 'file_id': '123', 'org_msg': {}}
+        result = work(10, 1, ['md5', 'sha256', 'sha512'], mock.MagicMock(), mock.MagicMock(), data)
+        checksums = [{'algorithm': 'sha256', 'value': hashlib.sha256(content).hexdigest()},
+                     {'algorithm': 'md5', 'value': hashlib.md5(content).hexdigest()},
+                     {'algorithm': 'sha512', 'value': hashlib.sha512(content).hexdigest()}]
+        mock_db.mark_completed.assert_called_with('123', checksums[0], checksums)
+        self.assertEqual(checksums, result['checksums'])
+        self.assertEqual(checksums[0], result['checksum'])
         filedir.cleanup()
 
     @mock.patch('lega.ingest.getattr')
@@ -168,6 +229,6 @@ class testVerify(unittest.TestCase):
         mock_broker.channel.return_value = mock.Mock()
         infile = filedir.write('infile.in', 'text'.encode("utf-8"))
         data = {'header': pgp_data.ENC_FILE, 'stable_id': '1', 'vault_path': infile, 'file_id': '123', 'org_msg': {}}
-        result = work('10', store, mock_broker, data)
+        result = work('10', 1, ['sha256'], store, mock_broker, data)
         self.assertTrue({'status': {'state': 'COMPLETED', 'details': '1'}}, result)
         filedir.cleanup()